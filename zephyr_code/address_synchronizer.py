@@ -93,6 +93,16 @@ class AddressSynchronizer(Logger):
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
+        # the remaining cleanup is slow for large wallets, do not wait for it
+        self._cleanup_thread = threading.Thread(target=self._remove_unreferenced_data,
+                                                name='wallet-db-cleanup', daemon=True)
+        self._cleanup_thread.start()
+
+    def _remove_unreferenced_data(self):
+        try:
+            self.db.remove_unreferenced_data(self.transaction_lock)
+        except Exception:
+            self.logger.exception('db cleanup failed')
 
     def is_mine(self, address):
         return self.db.is_addr_in_history(address)
@@ -165,12 +175,14 @@ class AddressSynchronizer(Logger):
                 self.verifier = None
             self.network.unregister_callback(self.on_blockchain_updated)
             self.storage.put('stored_height', self.get_local_height())
+        self._cleanup_thread.join()
         if write_to_disk:
             self.storage.write()
 
     def add_address(self, address):
         if not self.db.get_addr_history(address):
-            self.db.history[address] = []
+            if not self.db.is_addr_in_history(address):
+                self.db.set_addr_history(address, [])
             self.set_up_to_date(False)
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -507,6 +519,8 @@ class AddressSynchronizer(Logger):
             with self.lock:
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.add_pending_tx(tx_hash, tx_height)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
@@ -527,28 +541,31 @@ class AddressSynchronizer(Logger):
         with self.lock:
             return dict(self.unverified_tx)  # copy
 
+    def get_unverified_tx_height(self, tx_hash) -> Optional[int]:
+        with self.lock:
+            return self.unverified_tx.get(tx_hash)
+
     def undo_verifications(self, blockchain, above_height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
         with self.lock:
-            for tx_hash in self.db.list_verified_tx():
+            for tx_hash in self.db.list_verified_tx_above_height(above_height):
                 info = self.db.get_verified_tx(tx_hash)
                 tx_height = info.height
-                if tx_height > above_height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.db.remove_verified_tx(tx_hash)
-                        # NOTE: we should add these txns to self.unverified_tx,
-                        # but with what height?
-                        # If on the new fork after the reorg, the txn is at the
-                        # same height, we will not get a status update for the
-                        # address. If the txn is not mined or at a diff height,
-                        # we should get a status update. Unless we put tx into
-                        # unverified_tx, it will turn into local. So we put it
-                        # into unverified_tx with the old height, and if we get
-                        # a status update, that will overwrite it.
-                        self.unverified_tx[tx_hash] = tx_height
-                        txs.add(tx_hash)
+                header = blockchain.read_header(tx_height)
+                if not header or hash_header(header) != info.header_hash:
+                    self.db.remove_verified_tx(tx_hash)
+                    # NOTE: we should add these txns to self.unverified_tx,
+                    # but with what height?
+                    # If on the new fork after the reorg, the txn is at the
+                    # same height, we will not get a status update for the
+                    # address. If the txn is not mined or at a diff height,
+                    # we should get a status update. Unless we put tx into
+                    # unverified_tx, it will turn into local. So we put it
+                    # into unverified_tx with the old height, and if we get
+                    # a status update, that will overwrite it.
+                    self.unverified_tx[tx_hash] = tx_height
+                    txs.add(tx_hash)
         return txs
 
     def get_local_height(self):
@@ -807,3 +824,7 @@ class AddressSynchronizer(Logger):
 
     def synchronize(self):
         pass
+
+    def is_in_gap_limit_window(self, address) -> bool:
+        """Whether a history change of address can make synchronize create addresses."""
+        return False
@@ -21,14 +21,22 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
+import mmap
+import time
+import struct
+from array import array
+from bisect import bisect_left
 import threading
-from typing import Optional, Dict, Mapping, Sequence
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Dict, Mapping, Sequence, Tuple, List, Callable
 
 from . import util
-from .bitcoin import hash_encode, int_to_hex, rev_hex
+from .bitcoin import hash_encode, hash_decode
 from .crypto import sha256d
 from . import constants
-from .util import bfh, bh2u
+from .util import bfh, bh2u, LRUCache, CacheInfo
 from .simple_config import SimpleConfig
 from .crypto import PoWHash
 from .logging import get_logger, Logger
@@ -42,6 +50,13 @@ ZC_HEADER_SIZE = 112
 MAX_TARGET = 0x00000FFFFF000000000000000000000000000000000000000000000000000000
 POW_TARGET_SPACING = int(1 * 60)  # PIVX: 1 minute
 DGW_PAST_BLOCKS = 24
+HEADER_CACHE_SIZE = 2 * 2016  # decoded headers kept per chain
+CHAINWORK_SIZE = 32  # bytes per entry of a chainwork index
+CHAINWORK_RECORD_SIZE = 64  # tail hash and number of entries, at the start of the index file
+CHAINWORK_SYNC_LIMIT = 10 * 2016  # headers indexed on the spot; more are indexed in a thread
+CHAINWORK_BATCH_SIZE = 2016  # headers indexed per lock acquisition by that thread
+HEADERS_FSYNC_INTERVAL = 10  # seconds; single appended headers are synced at most this late
+FORK_MANIFEST_VERSION = 2
 
 class MissingHeader(Exception):
     pass
@@ -50,15 +65,19 @@ class InvalidHeader(Exception):
     pass
 
 def serialize_header(header_dict: dict) -> str:
-    s = int_to_hex(header_dict['version'], 4) \
-        + rev_hex(header_dict['prev_block_hash']) \
-        + rev_hex(header_dict['merkle_root']) \
-        + int_to_hex(int(header_dict['timestamp']), 4) \
-        + int_to_hex(int(header_dict['bits']), 4) \
-        + int_to_hex(int(header_dict['nonce']), 4)
-
-    if header_dict['version'] >= ZC_VERSION and header_dict['version'] != 7:
-        s += rev_hex(header_dict['accumulator_checkpoint'])
+    return bh2u(serialize_header_bytes(header_dict))
+
+def serialize_header_bytes(header_dict: dict) -> bytes:
+    version = header_dict['version']
+    s = version.to_bytes(4, byteorder='little') \
+        + hash_decode(header_dict['prev_block_hash']) \
+        + hash_decode(header_dict['merkle_root']) \
+        + int(header_dict['timestamp']).to_bytes(4, byteorder='little') \
+        + int(header_dict['bits']).to_bytes(4, byteorder='little') \
+        + int(header_dict['nonce']).to_bytes(4, byteorder='little')
+
+    if version >= ZC_VERSION and version != 7:
+        s += hash_decode(header_dict['accumulator_checkpoint'])
     return s
 
 def deserialize_header(s: bytes, height: int) -> dict:
@@ -91,21 +110,97 @@ def hash_header(header: dict) -> str:
         return '0' * 64
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
-    return hash_raw_header(serialize_header(header))
+    return hash_raw_header_bytes(serialize_header_bytes(header))
 
 
 def hash_raw_header(headerStr: str) -> str:
-    header = bfh(headerStr)
+    return hash_raw_header_bytes(bfh(headerStr))
+
+
+def hash_raw_header_bytes(header: bytes) -> str:
     if header[0] >= ZC_VERSION:
         return hash_encode(sha256d(header))
     else:
         return hash_encode(PoWHash(header))
 
 
+def hash_padded_header(header: bytes) -> str:
+    """Hash of a header as stored on disk, i.e. padded to ZC_HEADER_SIZE."""
+    version = int.from_bytes(header[0:4], byteorder='little')
+    if version >= ZC_VERSION and version != 7:
+        return hash_raw_header_bytes(header[:ZC_HEADER_SIZE])
+    return hash_raw_header_bytes(header[:HEADER_SIZE])
+
+
+def pad_chunk(data: bytes) -> bytearray:
+    """Servers send headers before the zerocoin upgrade without the
+    accumulator checkpoint; pad those to ZC_HEADER_SIZE like on disk.
+    """
+    offset = 0
+    while offset < len(data) and data[offset] < 4:
+        offset += HEADER_SIZE
+    num_short = (min(offset, len(data)) + HEADER_SIZE - 1) // HEADER_SIZE
+    padded = bytearray(num_short * ZC_HEADER_SIZE + max(0, len(data) - offset))
+    for i in range(num_short):
+        short_header = data[i*HEADER_SIZE:(i+1)*HEADER_SIZE]
+        padded[i*ZC_HEADER_SIZE:i*ZC_HEADER_SIZE+len(short_header)] = short_header
+    if offset < len(data):
+        padded[num_short*ZC_HEADER_SIZE:] = data[offset:]
+    return padded
+
+
+def _check_pow_of_raw_headers(data: bytes, start_height: int, zc_version: int, pos_block: int) -> List[str]:
+    """Runs in a worker process. Hashes the headers in data and checks their
+    proof of work against the target encoded in their own bits. Whether
+    those bits are the expected ones is checked sequentially by verify_chunk.
+    """
+    global ZC_VERSION, POS_BLOCK
+    ZC_VERSION, POS_BLOCK = zc_version, pos_block
+    hashes = []
+    for i in range(len(data) // ZC_HEADER_SIZE):
+        raw_header = data[i*ZC_HEADER_SIZE:(i+1)*ZC_HEADER_SIZE]
+        height = start_height + i
+        _hash = hash_padded_header(raw_header)
+        if 0 < height < pos_block:
+            target = Blockchain.bits_to_target(int.from_bytes(raw_header[72:76], byteorder='little'))
+            block_hash_as_num = int.from_bytes(bfh(_hash), byteorder='big')
+            if block_hash_as_num > target:
+                raise Exception(f"insufficient proof of work at height {height}: "
+                                f"{block_hash_as_num} vs target {target}")
+        hashes.append(_hash)
+    return hashes
+
+
+_pow_executor = None  # type: Optional[ProcessPoolExecutor]
+_pow_executor_workers = 0
+_pow_executor_lock = threading.Lock()
+
+
+def get_pow_executor(num_workers: int) -> ProcessPoolExecutor:
+    global _pow_executor, _pow_executor_workers
+    with _pow_executor_lock:
+        if _pow_executor is not None and _pow_executor_workers != num_workers:
+            _pow_executor.shutdown(wait=False)
+            _pow_executor = None
+        if _pow_executor is None:
+            _pow_executor = ProcessPoolExecutor(max_workers=num_workers)
+            _pow_executor_workers = num_workers
+        return _pow_executor
+
+
+def shutdown_pow_executor() -> None:
+    global _pow_executor
+    with _pow_executor_lock:
+        if _pow_executor is not None:
+            _pow_executor.shutdown(wait=False)
+            _pow_executor = None
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
 blockchains_lock = threading.RLock()
+_fork_manifest_dirty = False  # headers changed since write_fork_manifest
 
 
 def read_blockchains(config: 'SimpleConfig'):
@@ -115,12 +210,16 @@ def read_blockchains(config: 'SimpleConfig'):
                             forkpoint_hash=constants.net.GENESIS,
                             prev_hash=None)
     blockchains[constants.net.GENESIS] = best_chain
+    manifest = read_fork_manifest(config)
     # consistency checks
-    if best_chain.height() > constants.net.max_checkpoint():
+    if best_chain.height() > constants.net.max_checkpoint() \
+            and not best_chain.matches_manifest_entry(manifest.get(os.path.basename(best_chain.path()))):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_mmap()
             os.unlink(best_chain.path())
+            delete_chainwork_index(config, os.path.basename(best_chain.path()))
             best_chain.update_size()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
@@ -132,6 +231,7 @@ def read_blockchains(config: 'SimpleConfig'):
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
         os.unlink(os.path.join(fdir, filename))
+        delete_chainwork_index(config, filename)
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -142,24 +242,33 @@ def read_blockchains(config: 'SimpleConfig'):
         if forkpoint <= constants.net.max_checkpoint():
             delete_chain(filename, "deleting fork below max checkpoint")
             return
+        entry = manifest.get(filename)
         # find parent (sorting by forkpoint guarantees it's already instantiated)
-        for parent in blockchains.values():
-            if parent.check_hash(forkpoint - 1, prev_hash):
-                break
-        else:
-            delete_chain(filename, "cannot find parent for chain")
-            return
+        parent = blockchains.get(entry['parent']) if entry else None
+        if parent is None or not parent.check_hash(forkpoint - 1, prev_hash):
+            for parent in blockchains.values():
+                if parent.check_hash(forkpoint - 1, prev_hash):
+                    break
+            else:
+                delete_chain(filename, "cannot find parent for chain")
+                return
         b = Blockchain(config=config,
                        forkpoint=forkpoint,
                        parent=parent,
                        forkpoint_hash=first_hash,
                        prev_hash=prev_hash)
+        if b.matches_manifest_entry(entry):
+            # checked when the manifest was written; the headers file has not changed since
+            blockchains[b.get_id()] = b
+            return
         # consistency checks
         h = b.read_header(b.forkpoint)
-        if first_hash != hash_header(h):
+        if h is None or first_hash != hash_header(h):
+            b.close_mmap()
             delete_chain(filename, "incorrect first hash for chain")
             return
         if not b.parent.can_connect(h, check_height=False):
+            b.close_mmap()
             delete_chain(filename, "cannot connect chain to parent")
             return
         chain_id = b.get_id()
@@ -173,10 +282,225 @@ def read_blockchains(config: 'SimpleConfig'):
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
+
+def get_fork_manifest_path(config: 'SimpleConfig') -> str:
+    return os.path.join(util.get_headers_dir(config), 'forks', 'manifest.json')
+
+
+def read_fork_manifest(config: 'SimpleConfig') -> Dict[str, dict]:
+    """Returns map: headers file name -> manifest entry, see write_fork_manifest."""
+    path = get_fork_manifest_path(config)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != FORK_MANIFEST_VERSION:
+            return {}
+        return {entry['filename']: entry for entry in manifest['chains']}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        _logger.info(f"ignoring fork manifest {path}: {repr(e)}")
+        return {}
+
+
+def write_fork_manifest(config: 'SimpleConfig') -> None:
+    """Record the chains that passed the consistency checks of
+    read_blockchains, so that the next startup can skip them for every
+    chain whose headers file still ends with the recorded header, and
+    as long as the checkpoints they were checked against did not change.
+    """
+    global _fork_manifest_dirty
+    with blockchains_lock:
+        chains = [b for b in blockchains.values() if isinstance(b, Blockchain)]
+        _fork_manifest_dirty = False
+    entries = []
+    for b in chains:
+        with b.lock:
+            entries.append({
+                'filename': os.path.basename(b.path()),
+                'forkpoint': b.forkpoint,
+                'parent': b.parent.get_id() if b.parent is not None else None,
+                'size': b.size(),
+                'tip_hash': b._get_raw_header_hash(b.size() - 1),
+                'chainwork': b.get_chainwork(),
+                'max_checkpoint': constants.net.max_checkpoint(),
+                'checkpoint_hash': _get_checkpoint_hash(),
+            })
+    path = get_fork_manifest_path(config)
+    temp_path = "%s.tmp.%s" % (path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': FORK_MANIFEST_VERSION, 'chains': entries}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def is_fork_manifest_dirty() -> bool:
+    return _fork_manifest_dirty
+
+
+def _set_fork_manifest_dirty() -> None:
+    global _fork_manifest_dirty
+    _fork_manifest_dirty = True
+
+
+def _get_checkpoint_hash() -> Optional[str]:
+    checkpoints = constants.net.CHECKPOINTS
+    return checkpoints[-1][0] if checkpoints else None
+
+
+def sync_headers_files(*, only_due: bool=False) -> None:
+    """fsync headers that were appended without syncing, see Blockchain.write."""
+    with blockchains_lock: chains = list(blockchains.values())
+    for b in chains:
+        b.sync_headers_file(only_due=only_due)
+
+
+def work_of_target(target: int) -> int:
+    return ((2 ** 256 - target - 1) // (target + 1)) + 1
+
+
+def get_chainwork_index_path(config: 'SimpleConfig', headers_filename: str) -> str:
+    return os.path.join(util.get_headers_dir(config), 'chainwork', headers_filename)
+
+
+def delete_chainwork_index(config: 'SimpleConfig', headers_filename: str) -> None:
+    try:
+        os.unlink(get_chainwork_index_path(config, headers_filename))
+    except FileNotFoundError:
+        pass
+
+
+class ChainworkIndex:
+    """Cumulative chain work up to and including each header of a
+    headers file, stored under the same name in the 'chainwork'
+    directory next to the headers.
+
+    The file starts with a record holding the hash of the last indexed
+    header and the number of entries, followed by one 32 byte big-endian
+    entry per header. The record is written after the entries, and is
+    checked against the headers file when the index is opened; an index
+    that does not match is discarded and rebuilt by the caller.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._count = 0
+        self._written_count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def open(self, get_tail_hash: Callable[[int], Optional[str]]) -> None:
+        """get_tail_hash(n) must return the hash of the n-th header of
+        the headers file (0-based), or None if there is no such header.
+        """
+        self.close()
+        count = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                record = f.read(CHAINWORK_RECORD_SIZE)
+            file_size = os.path.getsize(self.path)
+            if len(record) == CHAINWORK_RECORD_SIZE:
+                count = int.from_bytes(record[32:40], byteorder='little')
+                tail_hash = hash_encode(record[:32])
+                if file_size < CHAINWORK_RECORD_SIZE + count * CHAINWORK_SIZE:
+                    count = 0
+                elif count > 0 and get_tail_hash(count - 1) != tail_hash:
+                    count = 0
+        else:
+            util.make_dir(os.path.dirname(self.path))
+            open(self.path, 'wb').close()
+        self._count = self._written_count = count
+        self._remap()
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def get(self, n: int) -> int:
+        if not 0 <= n < self._count:
+            raise IndexError(n)
+        offset = CHAINWORK_RECORD_SIZE + n * CHAINWORK_SIZE
+        return int.from_bytes(self._mmap[offset:offset + CHAINWORK_SIZE], byteorder='big')
+
+    def invalidate(self, n: int) -> None:
+        """Forget the entries from the n-th on. Takes effect on disk
+        with the next call to extend.
+        """
+        self._count = min(self._count, n)
+
+    def extend(self, chainworks: Sequence[int], tail_hash: Optional[str]) -> None:
+        if not chainworks and self._count == self._written_count:
+            return
+        self.close()
+        offset = CHAINWORK_RECORD_SIZE + self._count * CHAINWORK_SIZE
+        count = self._count + len(chainworks)
+        record = bytes(32) if tail_hash is None else hash_decode(tail_hash)
+        record = (record + count.to_bytes(8, byteorder='little')).ljust(CHAINWORK_RECORD_SIZE, b'\0')
+        with open(self.path, 'rb+') as f:
+            f.seek(offset)
+            f.truncate()
+            f.write(b''.join(w.to_bytes(CHAINWORK_SIZE, byteorder='big') for w in chainworks))
+            f.flush()
+            f.seek(0)
+            f.write(record)
+        self._count = self._written_count = count
+        self._remap()
+
+    def _remap(self) -> None:
+        self.close()
+        if self._count == 0:
+            return
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), CHAINWORK_RECORD_SIZE + self._count * CHAINWORK_SIZE,
+                                   access=mmap.ACCESS_READ)
+
+
+class HeaderTimeIndex:
+    """Timestamp and bits of each header of a headers file, as columns of
+    32 bit integers, for time <-> height queries without decoding headers.
+
+    A third column holds the running maximum of the timestamps, as block
+    timestamps are not monotonic, which is what first_at_least bisects.
+    That is 12 bytes per header: about 60 MB for 5 million headers, roughly
+    the size of the PIVX main chain; forks only index their own headers.
+    """
+
+    _struct = struct.Struct('<68xII36x')  # timestamp and bits of a ZC_HEADER_SIZE header
+
+    def __init__(self):
+        self.timestamps = array('I')
+        self.bits = array('I')
+        self._max_timestamps = array('I')
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def truncate(self, n: int) -> None:
+        del self.timestamps[n:]
+        del self.bits[n:]
+        del self._max_timestamps[n:]
+
+    def extend(self, data: bytes) -> None:
+        """Append the headers in data, a whole number of ZC_HEADER_SIZE headers."""
+        max_timestamp = self._max_timestamps[-1] if self._max_timestamps else 0
+        for timestamp, bits in self._struct.iter_unpack(data):
+            max_timestamp = max(max_timestamp, timestamp)
+            self.timestamps.append(timestamp)
+            self.bits.append(bits)
+            self._max_timestamps.append(max_timestamp)
+
+    def max_timestamp(self, n: int) -> int:
+        return self._max_timestamps[n]
+
+    def first_at_least(self, timestamp: int) -> int:
+        """Returns the first n such that one of the headers up to n has a
+        timestamp >= timestamp, or len(self) if there is none.
+        """
+        return bisect_left(self._max_timestamps, timestamp)
 
 
 class Blockchain(Logger):
@@ -198,10 +522,22 @@ class Blockchain(Logger):
         global ZC_VERSION
         ZC_VERSION = constants.net.ZC_VERSION
         self.forkpoint = forkpoint  # height of first header
+        self._parent = None  # type: Optional[Blockchain]
+        self._children = {}  # type: Dict[Blockchain, None]  # ordered set; may contain unregistered chains
         self.parent = parent
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._mmap = None  # type: Optional[mmap.mmap]
+        # height -> (header, block hash or None if not yet computed)
+        self._header_cache = LRUCache(HEADER_CACHE_SIZE)
+        self._chainwork_index = None  # type: Optional[ChainworkIndex]
+        self._chainwork_thread = None  # type: Optional[threading.Thread]
+        self._time_index = HeaderTimeIndex()  # filled in lazily, see _get_time_index
+        self._unsynced = False  # written to the headers file but not fsynced yet
+        self._last_sync = time.monotonic()
+        self._size = 0
+        self._truncate_torn_headers()
         self.update_size()
 
     def with_lock(func):
@@ -214,6 +550,19 @@ class Blockchain(Logger):
     def checkpoints(self):
         return constants.net.CHECKPOINTS
 
+    @property
+    def parent(self) -> Optional['Blockchain']:
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent: Optional['Blockchain']) -> None:
+        with blockchains_lock:
+            if self._parent is not None:
+                self._parent._children.pop(self, None)
+            self._parent = parent
+            if parent is not None:
+                parent._children[self] = None
+
     def get_max_child(self) -> Optional[int]:
         children = self.get_direct_children()
         return max([x.forkpoint for x in children]) if children else None
@@ -227,7 +576,7 @@ class Blockchain(Logger):
 
     def get_direct_children(self) -> Sequence['Blockchain']:
         with blockchains_lock:
-            return list(filter(lambda y: y.parent==self, blockchains.values()))
+            return [y for y in self._children if blockchains.get(y.get_id()) is y]
 
     def get_parent_heights(self) -> Mapping['Blockchain', int]:
         """Returns map: (parent chain -> height of last common block)"""
@@ -302,23 +651,124 @@ class Blockchain(Logger):
     @with_lock
     def update_size(self) -> None:
         p = self.path()
+        old_size = self._size
         self._size = os.path.getsize(p)//ZC_HEADER_SIZE if os.path.exists(p) else 0
+        self._remap()
+        if self._size < old_size:
+            self._drop_cached_headers(self.height() + 1)
+        if len(self._time_index) > self._size:
+            self._time_index.truncate(self._size)
+        self._update_chainwork_index()
+
+    @with_lock
+    def _truncate_torn_headers(self) -> None:
+        """Cut a partially written header off the end of the headers file,
+        and trailing headers that are all zeroes because they were not
+        synced to disk before a crash. Zeroed headers in the checkpoint
+        region are chunks that were not downloaded yet, and are kept.
+        """
+        p = self.path()
+        if not os.path.exists(p):
+            return
+        file_size = os.path.getsize(p)
+        size = file_size // ZC_HEADER_SIZE
+        min_size = max(0, len(self.checkpoints) * 2016 - self.forkpoint)
+        with open(p, 'rb') as f:
+            while size > min_size:
+                f.seek((size - 1) * ZC_HEADER_SIZE)
+                if f.read(ZC_HEADER_SIZE) != bytes(ZC_HEADER_SIZE):
+                    break
+                size -= 1
+        if size * ZC_HEADER_SIZE == file_size:
+            return
+        self.logger.info(f"truncating torn headers file {p} from {file_size} to {size * ZC_HEADER_SIZE} bytes")
+        with open(p, 'rb+') as f:
+            f.truncate(size * ZC_HEADER_SIZE)
+
+    @with_lock
+    def _drop_cached_headers(self, from_height: int) -> None:
+        for height in [h for h in self._header_cache.keys() if h >= from_height]:
+            del self._header_cache[height]
+
+    @with_lock
+    def header_cache_info(self) -> CacheInfo:
+        return self._header_cache.cache_info()
+
+    @with_lock
+    def close_mmap(self) -> None:
+        """Release the read-only mappings of the headers file and its
+        chainwork index. Must be called before the files are truncated,
+        replaced or deleted.
+        """
+        self._close_headers_mmap()
+        if self._chainwork_index is not None:
+            self._chainwork_index.close()
+            self._chainwork_index = None
+
+    @with_lock
+    def _close_headers_mmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    @with_lock
+    def _remap(self) -> None:
+        # one read-only mapping per chain file, covering all complete headers
+        self._close_headers_mmap()
+        if self._size == 0:
+            return
+        with open(self.path(), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), self._size * ZC_HEADER_SIZE, access=mmap.ACCESS_READ)
+
+    @with_lock
+    def _read_raw_header(self, delta: int) -> bytes:
+        if self._mmap is None:
+            self.assert_headers_file_available(self.path())
+            raise Exception('headers file of chain {} is not mapped'.format(self.forkpoint))
+        h = self._mmap[delta * ZC_HEADER_SIZE:(delta + 1) * ZC_HEADER_SIZE]
+        if len(h) < ZC_HEADER_SIZE:
+            raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        return h
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
         _hash = hash_header(header)
+        cls._verify_header_fields(_hash, header.get('prev_block_hash'), header.get('bits'),
+                                  header.get('block_height'), prev_hash, target, expected_header_hash)
+
+    @classmethod
+    def verify_raw_header(cls, raw_header: bytes, height: int, prev_hash: str, target: int,
+                          expected_header_hash: str=None, header_hash: str=None) -> str:
+        """Same checks as verify_header, for a header as stored on disk.
+        Returns the hash of the header.
+        If header_hash is given, its proof of work must already have been
+        checked against the header's own bits (see _check_pow_of_raw_headers).
+        """
+        check_pow = header_hash is None
+        _hash = hash_padded_header(raw_header) if check_pow else header_hash
+        header_prev_hash = hash_encode(raw_header[4:36])
+        header_bits = int.from_bytes(raw_header[72:76], byteorder='little')
+        cls._verify_header_fields(_hash, header_prev_hash, header_bits,
+                                  height, prev_hash, target, expected_header_hash, check_pow=check_pow)
+        return _hash
+
+    @classmethod
+    def _verify_header_fields(cls, _hash: str, header_prev_hash: str, header_bits: int, height: int,
+                              prev_hash: str, target: int, expected_header_hash: Optional[str],
+                              *, check_pow: bool=True) -> None:
         if expected_header_hash and expected_header_hash != _hash:
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
-        if prev_hash != header.get('prev_block_hash'):
-            raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
+        if prev_hash != header_prev_hash:
+            raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header_prev_hash))
 
-        height = header.get('block_height')
         if (height == 0) or (height >= POS_BLOCK) or (constants.net.REGTEST):
             return
 
         bits = cls.target_to_bits(target)
-        if bits != header.get('bits'):
-            raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
+        if bits != header_bits:
+            raise Exception("bits mismatch: %s vs %s" % (bits, header_bits))
+        if not check_pow:
+            return
         block_hash_as_num = int.from_bytes(bfh(_hash), byteorder='big')
         if block_hash_as_num > target:
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
@@ -327,7 +777,8 @@ class Blockchain(Logger):
         start_height = index * 2016
         num = len(data) // ZC_HEADER_SIZE
         prev_hash = self.get_hash(start_height - 1)
-        chunk_headers = {'empty': True}
+        dgw_window = DGWWindow.from_chain(self, start_height)
+        header_hashes = self._check_pow_in_workers(start_height, data)
         for i in range(num):
             height = start_height + i
             try:
@@ -335,17 +786,35 @@ class Blockchain(Logger):
             except MissingHeader:
                 expected_header_hash = None
             raw_header = data[i*ZC_HEADER_SIZE : (i+1)*ZC_HEADER_SIZE]
-            height = index * 2016 + i
-            header = deserialize_header(raw_header, height)
-            target = self.get_target(height, chunk_headers)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-
-            chunk_headers[height] = header
-            if i == 0:
-                chunk_headers['min_height'] = height
-                chunk_headers['empty'] = False
-            chunk_headers['max_height'] = height
-            prev_hash = hash_header(header)
+            if len(raw_header) != ZC_HEADER_SIZE:
+                raise InvalidHeader('Invalid header length: {}'.format(len(raw_header)))
+            target = dgw_window.next_target()
+            prev_hash = self.verify_raw_header(raw_header, height, prev_hash, target, expected_header_hash,
+                                               header_hash=header_hashes[i] if header_hashes else None)
+            dgw_window.push(int.from_bytes(raw_header[68:72], byteorder='little'),
+                            int.from_bytes(raw_header[72:76], byteorder='little'))
+
+    def _check_pow_in_workers(self, start_height: int, data: bytes) -> Optional[List[str]]:
+        """Hash the headers of a chunk and check their proof of work in
+        parallel, if enabled with the 'header_verification_workers' option.
+        Returns None if the chunk should be verified in-process.
+        """
+        num_workers = self.config.get('header_verification_workers', 0)
+        if not num_workers or constants.net.REGTEST or start_height >= POS_BLOCK:
+            return None
+        num = len(data) // ZC_HEADER_SIZE
+        if num == 0:
+            return None
+        executor = get_pow_executor(num_workers)
+        per_worker = -(-num // num_workers)
+        futures = [executor.submit(_check_pow_of_raw_headers,
+                                   bytes(data[i*ZC_HEADER_SIZE:(i+per_worker)*ZC_HEADER_SIZE]),
+                                   start_height + i, ZC_VERSION, POS_BLOCK)
+                   for i in range(0, num, per_worker)]
+        header_hashes = []
+        for fut in futures:
+            header_hashes.extend(fut.result())
+        return header_hashes
 
     @with_lock
     def path(self):
@@ -360,6 +829,9 @@ class Blockchain(Logger):
             filename = os.path.join('forks', basename)
         return os.path.join(d, filename)
 
+    def chainwork_index_path(self) -> str:
+        return get_chainwork_index_path(self.config, os.path.basename(self.path()))
+
     @with_lock
     def save_chunk(self, index: int, chunk: bytes):
         assert index >= 0, index
@@ -420,6 +892,7 @@ class Blockchain(Logger):
         # parent's new name will be something new (not child's old name)
         self.assert_headers_file_available(self.path())
         child_old_name = self.path()
+        child_old_chainwork_path = self.chainwork_index_path()
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         self.assert_headers_file_available(parent.path())
@@ -433,10 +906,15 @@ class Blockchain(Logger):
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
-        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:ZC_HEADER_SIZE]))
+        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_padded_header(parent_data[:ZC_HEADER_SIZE])
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self.close_mmap()
+        parent.close_mmap()
+        self._header_cache.clear()
+        parent._header_cache.clear()
         os.replace(child_old_name, parent.path())
+        os.replace(child_old_chainwork_path, parent.chainwork_index_path())
         self.update_size()
         parent.update_size()
         # update pointers
@@ -458,9 +936,23 @@ class Blockchain(Logger):
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
     @with_lock
-    def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+    def write(self, data: bytes, offset: int, truncate: bool=True, *, sync: bool=True) -> None:
+        """Write data to the headers file at offset.
+        With sync=False the data is only fsynced once the
+        'headers_fsync_interval' has passed since the last sync, or by
+        sync_headers_file; a crash in between may lose or tear the last
+        headers, which are dropped when the file is loaded again.
+        """
         filename = self.path()
         self.assert_headers_file_available(filename)
+        self._close_headers_mmap()
+        _set_fork_manifest_dirty()
+        if offset < self._size * ZC_HEADER_SIZE:
+            self._drop_cached_headers(self.forkpoint + offset // ZC_HEADER_SIZE)
+            # work in the checkpoint region does not depend on the stored headers
+            first_changed = max(offset // ZC_HEADER_SIZE, len(self.checkpoints) * 2016 - self.forkpoint)
+            self._chainwork_index.invalidate(first_changed)
+            self._time_index.truncate(offset // ZC_HEADER_SIZE)
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * ZC_HEADER_SIZE:
                 f.seek(offset)
@@ -468,17 +960,47 @@ class Blockchain(Logger):
             f.seek(offset)
             f.write(data)
             f.flush()
-            os.fsync(f.fileno())
+            self._unsynced = True
+            if sync or self._is_sync_due():
+                self._fsync(f)
         self.update_size()
 
+    def _is_sync_due(self) -> bool:
+        interval = self.config.get('headers_fsync_interval', HEADERS_FSYNC_INTERVAL)
+        return time.monotonic() - self._last_sync >= interval
+
+    def _fsync(self, f) -> None:
+        os.fsync(f.fileno())
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+
+    def sync_headers_file(self, *, only_due: bool=False) -> None:
+        # fsync can take long; do not hold up header processing meanwhile
+        with self.lock:
+            if not self._unsynced or (only_due and not self._is_sync_due()):
+                return
+            filename = self.path()
+            self._unsynced = False
+            self._last_sync = time.monotonic()
+        try:
+            with open(filename, 'rb+') as f:
+                os.fsync(f.fileno())
+        except FileNotFoundError:
+            self._unsynced = True  # e.g. renamed while swapping with a fork
+        except BaseException:
+            self._unsynced = True
+            raise
+
     @with_lock
     def save_header(self, header: dict) -> None:
         delta = header.get('block_height') - self.forkpoint
-        data = bfh(serialize_header(header)).ljust(ZC_HEADER_SIZE, bfh("00"))
+        data = serialize_header_bytes(header).ljust(ZC_HEADER_SIZE, bfh("00"))
         # headers are only _appended_ to the end:
         assert delta == self.size(), (delta, self.size())
         assert len(data) == ZC_HEADER_SIZE
-        self.write(data, delta*ZC_HEADER_SIZE)
+        # single headers are synced on chunk boundaries; see write()
+        at_chunk_boundary = (header.get('block_height') + 1) % 2016 == 0
+        self.write(data, delta*ZC_HEADER_SIZE, sync=at_chunk_boundary)
         self.swap_with_parent()
 
     @with_lock
@@ -489,17 +1011,70 @@ class Blockchain(Logger):
             return self.parent.read_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * ZC_HEADER_SIZE)
-            h = f.read(ZC_HEADER_SIZE)
-            if len(h) < ZC_HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*ZC_HEADER_SIZE:
+        item = self._get_cached_header(height)
+        if item is None:
+            return None
+        return dict(item[0])
+
+    @with_lock
+    def _get_cached_header(self, height: int) -> Optional[Tuple[dict, Optional[str]]]:
+        """Returns (header, block hash) for a height stored in our own file.
+        The hash is computed lazily, see _get_header_hash.
+        """
+        item = self._header_cache.get(height)
+        if item is None:
+            h = self._read_raw_header(height - self.forkpoint)
+            if h == bytes([0])*ZC_HEADER_SIZE:
+                return None
+            item = (deserialize_header(h, height), None)
+            self._header_cache[height] = item
+        return item
+
+    @with_lock
+    def _get_header_hash(self, height: int) -> str:
+        if height < self.forkpoint:
+            return self.parent._get_header_hash(height)
+        item = self._get_cached_header(height) if 0 <= height <= self.height() else None
+        if item is None:
+            raise MissingHeader(height)
+        header, header_hash = item
+        if header_hash is None:
+            header_hash = hash_padded_header(self._read_raw_header(height - self.forkpoint))
+            self._header_cache[height] = (header, header_hash)
+        return header_hash
+
+    @with_lock
+    def _get_time_index(self) -> HeaderTimeIndex:
+        index = self._time_index
+        if len(index) < self._size:
+            index.extend(self._mmap[len(index) * ZC_HEADER_SIZE:self._size * ZC_HEADER_SIZE])
+        return index
+
+    @with_lock
+    def get_timestamp(self, height: int) -> Optional[int]:
+        """Timestamp of the header at height, without decoding it."""
+        if height < 0 or height > self.height():
             return None
-        return deserialize_header(h, height)
+        if height < self.forkpoint:
+            return self.parent.get_timestamp(height)
+        index = self._get_time_index()
+        delta = height - self.forkpoint
+        if index.bits[delta] == 0:
+            return None  # not downloaded (checkpoint region)
+        return index.timestamps[delta]
+
+    @with_lock
+    def get_height_at_timestamp(self, timestamp: int) -> int:
+        """Returns the lowest height such that a header up to that height
+        has a timestamp >= timestamp, or self.height() + 1 if there is none.
+        All blocks below the returned height were mined before timestamp,
+        as far as their timestamps tell.
+        """
+        if self.parent is not None and self.forkpoint > 0:
+            parent_height = self.parent.get_height_at_timestamp(timestamp)
+            if parent_height < self.forkpoint:
+                return parent_height
+        return self.forkpoint + self._get_time_index().first_at_least(timestamp)
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -521,10 +1096,7 @@ class Blockchain(Logger):
             h, t, extra_headers = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
-                raise MissingHeader(height)
-            return hash_header(header)
+            return self._get_header_hash(height)
 
     def get_target(self, height: int, chunk_headers: Optional[dict]=None) -> int:
         if chunk_headers is None:
@@ -604,34 +1176,172 @@ class Blockchain(Logger):
             bitsBase >>= 8
         return bitsN << 24 | bitsBase
 
-    def chainwork_of_header_at_height(self, height: int) -> int:
-        """work done by single header at given height"""
-        target = self.get_target(height)
-        work = ((2 ** 256 - target - 1) // (target + 1)) + 1
-        return work
+    @classmethod
+    def _are_bits_verified(cls, height: int) -> bool:
+        # see _verify_header_fields; the genesis header is checked by its hash
+        return height == 0 or (height < POS_BLOCK and not constants.net.REGTEST)
+
+    def _target_of_raw_header(self, height: int, raw_header: bytes,
+                              expected_target: Optional[int]=None) -> Optional[int]:
+        """Target whose work the header at given height, as stored on disk,
+        is credited with. Headers whose bits are not verified (see
+        _are_bits_verified) cannot claim more work than expected_target,
+        the target DGW gives for that height.
+        Returns None if the header does no work.
+        """
+        if height // 2016 < len(self.checkpoints):
+            # the region may not be downloaded; use the checkpointed target
+            return self.checkpoints[height // 2016][1]
+        try:
+            target = self.bits_to_target(int.from_bytes(raw_header[72:76], byteorder='little'))
+        except Exception:
+            return expected_target
+        if expected_target is not None:
+            target = max(target, expected_target)
+        return target
+
+    @with_lock
+    def _update_chainwork_index(self) -> None:
+        """Bring the chainwork index in line with the headers file,
+        opening it first if needed. Only headers that are not indexed
+        yet are read. If that is a lot of them, e.g. the first time the
+        wallet starts, they are indexed in a thread, and get_chainwork
+        estimates the work meanwhile.
+        """
+        if self._chainwork_index is None:
+            self._chainwork_index = ChainworkIndex(self.chainwork_index_path())
+            self._chainwork_index.open(self._get_raw_header_hash)
+        index = self._chainwork_index
+        index.invalidate(self._size)
+        if self._chainwork_thread is not None:
+            return
+        if self._size - len(index) > CHAINWORK_SYNC_LIMIT or not self._can_extend_chainwork_index():
+            self._chainwork_thread = threading.Thread(target=self._build_chainwork_index,
+                                                      name='chainwork-index', daemon=True)
+            self._chainwork_thread.start()
+            return
+        self._extend_chainwork_index(self._size)
+
+    def _build_chainwork_index(self) -> None:
+        while True:
+            with self.lock:
+                index = self._chainwork_index
+                if index is None:
+                    # closed, e.g. to delete the chain; update_size starts over
+                    self._chainwork_thread = None
+                    return
+                if len(index) == self._size:
+                    self._chainwork_thread = None
+                    _set_fork_manifest_dirty()  # write the exact chainwork
+                    return
+                if self._can_extend_chainwork_index():
+                    self._extend_chainwork_index(min(self._size, len(index) + CHAINWORK_BATCH_SIZE))
+                    continue
+            time.sleep(0.1)  # the parent is still being indexed
+
+    @with_lock
+    def _can_extend_chainwork_index(self) -> bool:
+        # the first entry builds on the exact work of the parent
+        return (len(self._chainwork_index) > 0 or self.parent is None
+                or self.parent.is_chainwork_indexed(self.forkpoint - 1))
+
+    @with_lock
+    def is_chainwork_indexed(self, height: int) -> bool:
+        if height < self.forkpoint:
+            return self.parent is None or self.parent.is_chainwork_indexed(height)
+        return height - self.forkpoint < len(self._chainwork_index)
+
+    @with_lock
+    def _extend_chainwork_index(self, size: int) -> None:
+        """Index the headers up to size, from the first one not indexed."""
+        index = self._chainwork_index
+        n = len(index)
+        if n > 0:
+            total = index.get(n - 1)
+        elif self.parent is not None:
+            total = self.parent.get_chainwork(self.forkpoint - 1)
+        else:
+            total = 0
+        chainworks = []
+        dgw_window = None
+        for delta in range(n, size):
+            height = self.forkpoint + delta
+            raw_header = self._read_raw_header(delta)
+            if self._are_bits_verified(height) or height // 2016 < len(self.checkpoints):
+                target = self._target_of_raw_header(height, raw_header)
+            else:
+                if dgw_window is None:
+                    dgw_window = DGWWindow.from_chain(self, height)
+                try:
+                    expected_target = dgw_window.next_target()
+                except Exception:
+                    # missing headers, or a target out of range
+                    expected_target = MAX_TARGET  # the least work any header does
+                target = self._target_of_raw_header(height, raw_header, expected_target)
+                # the window averages the capped targets, so forged bits do not
+                # lower the targets expected for the following headers either
+                dgw_window.push_target(int.from_bytes(raw_header[68:72], byteorder='little'), target)
+            if target is not None:
+                total += work_of_target(target)
+            chainworks.append(total)
+        index.extend(chainworks, self._get_raw_header_hash(size - 1))
+
+    @with_lock
+    def _estimate_chainwork(self, height: int) -> int:
+        """Chain work up to height, for heights that are not indexed yet.
+        Of the headers not indexed, only every 2016th is read, and credited
+        with the work of the 2016 headers from it on.
+        """
+        index = self._chainwork_index
+        n = len(index)
+        if n > 0:
+            total = index.get(n - 1)
+        elif self.parent is not None:
+            total = self.parent.get_chainwork(self.forkpoint - 1)
+        else:
+            total = 0
+        for start in range(self.forkpoint + n, height + 1, 2016):
+            target = self._target_of_raw_header(start, self._read_raw_header(start - self.forkpoint))
+            if target is not None:
+                total += min(2016, height + 1 - start) * work_of_target(target)
+        return total
+
+    def matches_manifest_entry(self, entry: Optional[dict]) -> bool:
+        """Whether a fork manifest entry describes our headers file as it is."""
+        if not entry:
+            return False
+        try:
+            return (entry['forkpoint'] == self.forkpoint
+                    and entry['size'] == self.size()
+                    and entry['tip_hash'] == self._get_raw_header_hash(self.size() - 1)
+                    and entry['chainwork'] == self.get_chainwork()
+                    and entry['max_checkpoint'] == constants.net.max_checkpoint()
+                    and entry['checkpoint_hash'] == _get_checkpoint_hash())
+        except Exception:
+            return False
+
+    @with_lock
+    def _get_raw_header_hash(self, delta: int) -> Optional[str]:
+        if not 0 <= delta < self._size:
+            return None
+        return hash_padded_header(self._read_raw_header(delta))
 
     @with_lock
     def get_chainwork(self, height=None) -> int:
+        """Total work of the chain up to and including the given height,
+        computing the work of each header from its bits.
+        """
         if height is None:
-            height = max(0, self.height())
-        last_retarget = height // 2016 * 2016 - 1
-        cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
-                break
-            cached_height -= 2016
-        assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-        while cached_height < last_retarget:
-            cached_height += 2016
-            work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-            work_in_chunk = 2016 * work_in_single_header
-            running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-        cached_height = height
-        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-        work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
-        return running_total + work_in_last_partial_chunk
+            height = self.height()
+        if height < 0:
+            return 0
+        if height < self.forkpoint:
+            return self.parent.get_chainwork(height)
+        if height > self.height():
+            raise MissingHeader(height)
+        if not self.is_chainwork_indexed(height):
+            return self._estimate_chainwork(height)
+        return self._chainwork_index.get(height - self.forkpoint)
 
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
@@ -660,15 +1370,8 @@ class Blockchain(Logger):
     def connect_chunk(self, idx: int, hexdata: str) -> bool:
         assert idx >= 0, idx
         try:
-            start = idx * 2016
             data = bfh(hexdata)
-            h_data = bytes()
-            for i in range(0, len(data), HEADER_SIZE):
-                if data[i] >= 4:
-                    h_data += data[i:]
-                    break
-                h_data += data[i:i+HEADER_SIZE].ljust(ZC_HEADER_SIZE, bfh("00"))
-
+            h_data = pad_chunk(data)
             self.verify_chunk(idx, h_data)
             self.save_chunk(idx, h_data)
             return True
@@ -687,21 +1390,71 @@ class Blockchain(Logger):
             if len(h.strip('0')) == 0:
                 raise Exception('%s file has not enough data.' % self.path())
             dgw3_headers = []
-            if os.path.exists(self.path()):
-                with open(self.path(), 'rb') as f:
-                    lower_header = height - DGW_PAST_BLOCKS
-                    for height in range(height, lower_header-1, -1):
-                        f.seek(height*ZC_HEADER_SIZE)
-                        hd = f.read(ZC_HEADER_SIZE)
-                        if len(hd) < ZC_HEADER_SIZE:
-                            raise Exception(
-                                'Expected to read a full header.'
-                                ' This was only {} bytes'.format(len(hd)))
-                        dgw3_headers.append((height, bh2u(hd)))
+            lower_header = height - DGW_PAST_BLOCKS
+            for height in range(height, lower_header-1, -1):
+                hd = self._read_raw_header(height - self.forkpoint)
+                dgw3_headers.append((height, bh2u(hd)))
             cp.append((h, target, dgw3_headers))
         return cp
 
 
+class DGWWindow:
+    """Rolling window of (timestamp, target) of the DGW_PAST_BLOCKS headers
+    preceding the next height. Produces the same targets as
+    Blockchain.get_target_dgw_v3, but consecutive heights only cost one push
+    instead of re-reading and decoding the whole window.
+    """
+
+    def __init__(self, height: int):
+        self.height = height  # next height, whose target next_target() returns
+        self._window = deque(maxlen=DGW_PAST_BLOCKS)  # oldest first; target None for missing headers
+
+    @classmethod
+    def from_chain(cls, chain: Blockchain, height: int) -> 'DGWWindow':
+        """Seed the window with the headers of chain just below height."""
+        window = cls(max(0, height - DGW_PAST_BLOCKS))
+        for h in range(window.height, height):
+            header = chain.read_header(h)
+            try:
+                target = Blockchain.bits_to_target(header['bits']) if header else None
+            except Exception:
+                target = None  # bits of headers after POS_BLOCK are not verified
+            window.push_target(header['timestamp'] if header else None, target)
+        return window
+
+    def push(self, timestamp: int, bits: int) -> None:
+        """Append the header at self.height."""
+        self.push_target(timestamp, Blockchain.bits_to_target(bits))
+
+    def push_target(self, timestamp: int, target: int) -> None:
+        self._window.append((timestamp, target))
+        self.height += 1
+
+    def next_target(self) -> int:
+        if self.height <= 24:
+            return MAX_TARGET
+        if len(self._window) < DGW_PAST_BLOCKS or any(target is None for _, target in self._window):
+            raise MissingHeader()
+        # walk backwards from the newest header, with the same
+        # rounding as get_target_dgw_v3
+        last_time, past_target_avg = self._window[-1]
+        for count_blocks, (reading_time, reading_target) in enumerate(reversed(self._window), start=1):
+            past_target_avg = \
+                (past_target_avg * count_blocks + reading_target) // \
+                    (count_blocks + 1)
+
+        new_target = past_target_avg
+        actual_timespan = last_time - reading_time
+        target_timespan = DGW_PAST_BLOCKS * POW_TARGET_SPACING
+        actual_timespan = max(actual_timespan, target_timespan // 3)
+        actual_timespan = min(actual_timespan, target_timespan * 3)
+        new_target *= actual_timespan
+        new_target //= target_timespan
+        if new_target > MAX_TARGET:
+            return MAX_TARGET
+        return Blockchain.bits_to_target(Blockchain.target_to_bits(new_target))
+
+
 def check_header(header: dict) -> Optional[Blockchain]:
     if type(header) is not dict:
         return None
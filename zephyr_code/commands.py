@@ -43,7 +43,6 @@ from .bip32 import BIP32Node
 from .i18n import _
 from .transaction import Transaction, multisig_script, TxOutput
 from .paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
-from .synchronizer import Notifier
 from .wallet import Abstract_Wallet, create_new_wallet, restore_wallet_from_text
 from .address_synchronizer import TX_HEIGHT_LOCAL
 
@@ -691,17 +690,24 @@ class Commands:
     @command('w')
     def clearrequests(self):
         """Remove all payment requests"""
-        for k in list(self.wallet.receive_requests.keys()):
+        for k in self.wallet.db.get_copy('payment_requests'):
             self.wallet.remove_payment_request(k, self.config)
 
     @command('n')
     def notify(self, address: str, URL: str):
-        """Watch an address. Every time the address changes, a http POST is sent to the URL."""
-        if not hasattr(self, "_notifier"):
-            self._notifier = Notifier(self.network)
-        self.network.run_from_another_thread(self._notifier.start_watching_queue.put((address, URL)))
+        """Watch an address. Every time the address changes, a http POST is sent to the URL.
+        Call with an empty URL to stop watching an address."""
+        if not is_address(address):
+            raise Exception("Invalid address: {}".format(address))
+        notifier = self.network.get_notifier()
+        self.network.run_from_another_thread(notifier.start_watching_queue.put((address, URL)))
         return True
 
+    @command('n')
+    def getnotifierstats(self):
+        """Return delivery counters of the address notifier."""
+        return self.network.get_notifier().get_metrics()
+
     @command('wn')
     def is_synchronized(self):
         """ return wallet synchronization status """
@@ -245,7 +245,8 @@ class Daemon(DaemonThread):
         if path in self.wallets:
             wallet = self.wallets[path]
             return wallet
-        storage = WalletStorage(path, manual_upgrades=True)
+        storage = WalletStorage(path, manual_upgrades=True,
+                                incremental=self.config.get('incremental_wallet_writes', False))
         if not storage.file_exists():
             return
         if storage.is_encrypted():
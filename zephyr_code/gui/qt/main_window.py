@@ -2697,7 +2697,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, Logger):
 
     def do_export_labels(self):
         def export_labels(filename):
-            export_meta(self.wallet.labels, filename)
+            export_meta(self.wallet.db.get_copy('labels'), filename)
         export_meta_gui(self, _('labels'), export_labels)
 
     def sweep_key_dialog(self):
@@ -28,7 +28,7 @@ import ssl
 import sys
 import traceback
 import asyncio
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Dict
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address
 import itertools
@@ -59,6 +59,9 @@ ca_path = certifi.where()
 
 BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
+# number of 'blockchain.block.headers' requests kept in flight during catch-up
+HEADER_DOWNLOAD_WINDOW = 4
+
 
 class NetworkTimeout:
     # seconds
@@ -77,6 +80,8 @@ class NotificationSession(RPCSession):
         super(NotificationSession, self).__init__(*args, **kwargs)
         self.subscriptions = defaultdict(list)
         self.cache = {}
+        self._subscription_requests = {}  # key -> future, done when the request is answered
+        self._dropped_subscriptions = set()  # keys the server may still send notifications for
         self.default_timeout = NetworkTimeout.Generic.NORMAL
         self._msg_counter = itertools.count(start=1)
         self.interface = None  # type: Optional[Interface]
@@ -92,6 +97,8 @@ class NotificationSession(RPCSession):
                     self.cache[key] = result
                     for queue in self.subscriptions[key]:
                         await queue.put(request.args)
+                elif key in self._dropped_subscriptions:
+                    pass
                 else:
                     raise Exception(f'unexpected notification')
             else:
@@ -115,29 +122,106 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_batch_requests(self, requests: List[Tuple[str, List]]) -> List:
+        """Send several requests as one JSON-RPC batch.
+        Returns the results in order. A request that failed on the server
+        has the RPCError in place of its result.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(requests)} (id: {msg_id})")
+        try:
+            async with self.send_batch() as batch:
+                for method, params in requests:
+                    batch.add_request(method, params)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'batch request timed out: {len(requests)} requests (id: {msg_id})') from e
+        self.maybe_log(f"--> {batch.results} (id: {msg_id})")
+        return list(batch.results)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
 
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
-        # note: until the cache is written for the first time,
-        # each 'subscribe' call might make a request on the network.
-        key = self.get_hashable_key_for_rpc_call(method, params)
-        self.subscriptions[key].append(queue)
-        if key in self.cache:
-            result = self.cache[key]
-        else:
-            result = await self.send_request(method, params)
-            self.cache[key] = result
-        await queue.put(params + [result])
+        await self.subscribe_batch(method, [params], queue)
+
+    async def subscribe_batch(self, method: str, params_list: List[List], queue: asyncio.Queue):
+        """Subscribe queue to several params at once.
+        Every job on this session shares the subscriptions: a key that is
+        cached or already being requested is not requested again.
+        If the server returned errors, the first one is raised after the
+        successful subscriptions have been put in the queue.
+        """
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            self.subscriptions[key].append(queue)
+            self._dropped_subscriptions.discard(key)
+        errors = await self._request_subscriptions(method, params_list)
+        for key, params in zip(keys, params_list):
+            if key in self.cache:
+                await queue.put(params + [self.cache[key]])
+        if errors:
+            raise errors[0]
+
+    async def _request_subscriptions(self, method: str, params_list: List[List]) -> List[Exception]:
+        """Get the results of subscription requests into self.cache.
+        Returns the errors the server returned.
+        """
+        to_request = {}  # key -> params
+        waiting = set()
+        for params in params_list:
+            key = self.get_hashable_key_for_rpc_call(method, params)
+            if key in self.cache or key in to_request:
+                continue
+            if key in self._subscription_requests:
+                waiting.add(self._subscription_requests[key])
+            else:
+                to_request[key] = params
+        errors = []
+        if to_request:
+            done = asyncio.get_event_loop().create_future()
+            for key in to_request:
+                self._subscription_requests[key] = done
+            try:
+                if len(to_request) == 1:
+                    try:
+                        results = [await self.send_request(method, *to_request.values())]
+                    except aiorpcx.jsonrpc.RPCError as e:
+                        results = [e]
+                else:
+                    results = await self.send_batch_requests([(method, params) for params in to_request.values()])
+                for key, result in zip(to_request, results):
+                    if isinstance(result, Exception):
+                        errors.append(result)
+                    else:
+                        self.cache[key] = result
+            finally:
+                for key in to_request:
+                    del self._subscription_requests[key]
+                done.set_result(None)
+        if waiting:
+            await asyncio.wait(waiting)
+            # requests of other jobs that failed are made again
+            retry = [params for params in params_list
+                     if self.get_hashable_key_for_rpc_call(method, params) not in self.cache
+                     and self.get_hashable_key_for_rpc_call(method, params) not in to_request]
+            if retry:
+                errors += await self._request_subscriptions(method, retry)
+        return errors
 
     def unsubscribe(self, queue):
-        """Unsubscribe a callback to free object references to enable GC."""
-        # note: we can't unsubscribe from the server, so we keep receiving
-        # subsequent notifications
-        for v in self.subscriptions.values():
-            if queue in v:
-                v.remove(queue)
+        """Unsubscribe a callback to free object references to enable GC.
+        Subscriptions no queue is interested in any more are dropped.
+        """
+        for key, queues in list(self.subscriptions.items()):
+            if queue in queues:
+                queues.remove(queue)
+            if not queues:
+                # note: we can't unsubscribe from the server, so we keep
+                # receiving notifications, and ignore them
+                del self.subscriptions[key]
+                self.cache.pop(key, None)
+                self._dropped_subscriptions.add(key)
 
     @classmethod
     def get_hashable_key_for_rpc_call(cls, method, params):
@@ -200,6 +284,7 @@ class Interface(Logger):
         self.cert_path = os.path.join(network.config.path, 'certs', self.host)
         self.blockchain = None
         self._requested_chunks = set()
+        self._prefetched_chunks = {}  # type: Dict[int, Tuple[Interface, asyncio.Future]]
         self.network = network
         self._set_proxy(proxy)
         self.session = None  # type: NotificationSession
@@ -397,18 +482,101 @@ class Interface(Logger):
         if can_return_early and index in self._requested_chunks:
             return
         self.logger.info(f"requesting chunk from height {height}")
-        size = 2016
-        if tip is not None:
-            size = min(size, tip - index * 2016 + 1)
-            size = max(size, 0)
+        res = await self._fetch_chunk(index, tip)
+        conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn:
+            return conn, 0
+        return conn, res['count']
+
+    async def _fetch_chunk(self, index, tip=None) -> dict:
         try:
             self._requested_chunks.add(index)
-            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+            return await self._send_chunk_request(index, tip)
         finally:
             try: self._requested_chunks.remove(index)
             except KeyError: pass
+
+    async def _send_chunk_request(self, index, tip=None) -> dict:
+        size = 2016
+        if tip is not None:
+            size = min(size, tip - index * 2016 + 1)
+            size = max(size, 0)
+        return await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+
+    def _header_download_window(self) -> int:
+        window = self.network.config.get('header_download_window', HEADER_DOWNLOAD_WINDOW)
+        return max(1, int(window))
+
+    def _chunk_sources(self, last_height: int) -> List['Interface']:
+        """Interfaces that can serve headers up to last_height on our chain.
+        We always come first; chunks from the others are verified by
+        connect_chunk like any other chunk.
+        """
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        sources = [self]
+        for interface in interfaces:
+            if interface is self or interface.blockchain != self.blockchain:
+                continue
+            if not interface.ready.done() or interface.ready.cancelled():
+                continue
+            if not interface.session or interface.session.is_closing():
+                continue
+            if interface.tip < last_height:
+                continue
+            sources.append(interface)
+        return sources
+
+    async def _prefetch_chunk(self, source: 'Interface', index, tip):
+        # errors are returned, not raised: a failing request must not
+        # take down self.group, in which this runs
+        try:
+            if source is self:
+                return await self._fetch_chunk(index, tip)
+            return await source._send_chunk_request(index, tip)
+        except Exception as e:
+            return e
+
+    async def _prefetch_chunks(self, index, tip):
+        last_index = min(index + self._header_download_window() - 1, tip // 2016)
+        for i in range(index, last_index + 1):
+            if i in self._prefetched_chunks:
+                continue
+            sources = self._chunk_sources(min(tip, i * 2016 + 2015))
+            source = sources[i % len(sources)]
+            task = await self.group.spawn(self._prefetch_chunk(source, i, tip))
+            self._prefetched_chunks[i] = source, task
+
+    def _cancel_prefetched_chunks(self):
+        for source, task in self._prefetched_chunks.values():
+            task.cancel()
+        self._prefetched_chunks.clear()
+
+    async def _request_chunk_pipelined(self, height, tip):
+        """Like request_chunk, but keeps up to 'header_download_window'
+        requests for the following chunks in flight, possibly spread over
+        other interfaces on the same chain. Chunks are still connected
+        strictly in order.
+        """
+        index = height // 2016
+        await self._prefetch_chunks(index, tip)
+        source, task = self._prefetched_chunks.pop(index)
+        self.logger.info(f"requesting chunk from height {height}")
+        res = await task
+        if source is self:
+            if isinstance(res, Exception):
+                raise res
+        else:
+            if not isinstance(res, Exception):
+                conn = self.blockchain.connect_chunk(index, res['hex'])
+                if conn:
+                    return conn, res['count']
+            # the other server failed or disagrees; ask ours before giving up
+            self.logger.info(f"chunk {index} from {source.diagnostic_name()} failed, refetching")
+            res = await self._fetch_chunk(index, tip)
         conn = self.blockchain.connect_chunk(index, res['hex'])
         if not conn:
+            self._cancel_prefetched_chunks()
             return conn, 0
         return conn, res['count']
 
@@ -494,22 +662,25 @@ class Interface(Logger):
         if next_height is None:
             next_height = self.tip
         last = None
-        while last is None or height <= next_height:
-            prev_last, prev_height = last, height
-            if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
-                if not could_connect:
-                    if height <= constants.net.max_checkpoint():
-                        raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+        try:
+            while last is None or height <= next_height:
+                prev_last, prev_height = last, height
+                if next_height > height + 10:
+                    could_connect, num_headers = await self._request_chunk_pipelined(height, next_height)
+                    if not could_connect:
+                        if height <= constants.net.max_checkpoint():
+                            raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
+                        last, height = await self.step(height)
+                        continue
+                    self.network.trigger_callback('network_updated')
+                    height = (height // 2016 * 2016) + num_headers
+                    assert height <= next_height+1, (height, self.tip)
+                    last = 'catchup'
+                else:
                     last, height = await self.step(height)
-                    continue
-                self.network.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
-                assert height <= next_height+1, (height, self.tip)
-                last = 'catchup'
-            else:
-                last, height = await self.step(height)
-            assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+                assert (prev_last, prev_height) != (last, height), 'had to prevent infinite loop in interface.sync_until'
+        finally:
+            self._cancel_prefetched_chunks()
         return last, height
 
     async def step(self, height, header=None):
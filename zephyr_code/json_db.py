@@ -26,12 +26,13 @@ import os
 import ast
 import json
 import copy
+import bisect
 import threading
-from collections import defaultdict
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Sequence
 
 from . import util, bitcoin
-from .util import profiler, WalletFileException, multisig_type, TxMinedInfo
+from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, history_status
 from .keystore import bip44_derivation
 from .transaction import Transaction
 from .logging import Logger
@@ -42,26 +43,122 @@ NEW_SEED_VERSION = 11       # electrum versions >= 2.0
 FINAL_SEED_VERSION = 18     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
+TRANSACTION_CACHE_SIZE = 1000  # deserialized transactions kept in memory
+CLEANUP_CHUNK_SIZE = 1000  # items checked per lock acquisition by remove_unreferenced_data
+
+
+def _hex_to_bytes(s):
+    # hashes and raw transactions are kept in memory as bytes, half the size
+    if not isinstance(s, str):
+        return s
+    try:
+        return bytes.fromhex(s)
+    except ValueError:
+        return s  # not hex, keep as is
+
+
+def _bytes_to_hex(b):
+    return b.hex() if isinstance(b, bytes) else b
+
+
+# note: this is not a NamedTuple as then its json encoding cannot be customized
+class TxiRecord(object):
+    """Value of a wallet address spent by a transaction, and the outpoint it came from."""
+    __slots__ = ('prevout_hash', 'prevout_n', 'value')
+
+    def __init__(self, prevout_hash, prevout_n: int, value: int):
+        self.prevout_hash = prevout_hash  # bytes
+        self.prevout_n = prevout_n
+        self.value = value
+
+    @classmethod
+    def from_ser(cls, ser: str, value: int) -> 'TxiRecord':
+        prevout_hash, prevout_n = ser.rsplit(':', 1)
+        return cls(_hex_to_bytes(prevout_hash), int(prevout_n), value)
+
+    def ser(self) -> str:
+        return '%s:%d' % (_bytes_to_hex(self.prevout_hash), self.prevout_n)
+
+    def __repr__(self):
+        return 'TxiRecord(%s, %d)' % (self.ser(), self.value)
+
+    def __eq__(self, other):
+        return (self.prevout_hash == other.prevout_hash
+                and self.prevout_n == other.prevout_n
+                and self.value == other.value)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash((self.prevout_hash, self.prevout_n, self.value))
+
+
+class TxoRecord(NamedTuple):
+    n: int             # output index
+    value: int
+    is_coinbase: bool
+
 
 class JsonDBJsonEncoder(util.MyEncoder):
     def default(self, obj):
         if isinstance(obj, Transaction):
             return str(obj)
+        if isinstance(obj, bytes):
+            return obj.hex()
+        if isinstance(obj, TxiRecord):
+            return [obj.ser(), obj.value]
         return super().default(obj)
 
 
+def _is_json_scalar(value):
+    return value is None or isinstance(value, (str, int, float))
+
+
+def _check_json_serializable(value):
+    # scalars are the common case, and need no encoding
+    if not _is_json_scalar(value):
+        json.dumps(value, cls=JsonDBJsonEncoder)
+
+
+def _changed_subkeys(old, new) -> Optional[list]:
+    """Keys of the entries that differ between dicts old and new, or None
+    if recording the whole new value is as good.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return None
+    changed = [k for k in old if k not in new]
+    # a container shared with the stored value compares equal to itself,
+    # but may have been modified in place
+    changed += [k for k, v in new.items()
+                if k not in old or old[k] != v or old[k] is v and not _is_json_scalar(v)]
+    # the keys of a path must be strings, ints are list indices
+    if 2 * len(changed) > len(new) or not all(isinstance(k, str) for k in changed):
+        return None
+    return changed
+
+
+def _path_sort_key(path):
+    # list indices sort numerically, so that appends are replayed in order
+    return [(0, x, '') if isinstance(x, int) else (1, 0, x) for x in path]
+
+
 class JsonDB(Logger):
 
-    def __init__(self, raw, *, manual_upgrades):
+    def __init__(self, raw, *, manual_upgrades, log: Sequence[list] = ()):
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.data = {}
         self._modified = False
+        # paths into self.data changed since the last dump_changes()
+        self._changed_paths = set()
+        self._num_changes = 0
+        self._untracked_changes = False  # set when a change cannot be expressed as paths
         self.manual_upgrades = manual_upgrades
         self.upgrade_done = False
         self._called_load_transactions = False
         if raw:  # loading existing db
-            self.load_data(raw)
+            self.load_data(raw, log)
         else:  # creating new db
             self.put('seed_version', FINAL_SEED_VERSION)
             self.load_transactions()
@@ -77,9 +174,20 @@ class JsonDB(Logger):
         def wrapper(self, *args, **kwargs):
             with self.lock:
                 self._modified = True
-                return func(self, *args, **kwargs)
+                num_changes = self._num_changes
+                r = func(self, *args, **kwargs)
+                if self._num_changes == num_changes:
+                    self._untracked_changes = True
+                return r
         return wrapper
 
+    def _changed(self, *path):
+        """Record that the value at path in self.data was set or removed.
+        Every modifier must call this for what it changes.
+        """
+        self._changed_paths.add(path)
+        self._num_changes += 1
+
     def locked(func):
         def wrapper(self, *args, **kwargs):
             with self.lock:
@@ -88,24 +196,54 @@ class JsonDB(Logger):
 
     @locked
     def get(self, key, default=None):
+        """Return the stored value itself, not a copy. Do not modify it:
+        the change would race with dump() on other threads, and is only
+        saved once the value is put() back. Use put_item() for entries
+        of dicts.
+        """
         v = self.data.get(key)
         if v is None:
             v = default
-        else:
-            v = copy.deepcopy(v)
         return v
 
+    @locked
+    def get_copy(self, key) -> dict:
+        """Return a shallow copy of the dict stored under key, which is
+        safe to iterate while other threads put_item() into it.
+        """
+        return dict(self.data.get(key) or {})
+
     @modifier
     def put(self, key, value):
+        """Store value, without copying it.
+
+        Replacing a dict with another records only the entries that
+        differ as changed. Putting back the object already stored under
+        key, after modifying it, is cheap, but records the whole value:
+        its old entries are gone, so each change appends all of it to
+        the log until the storage compacts it. Use put_item() to change
+        single entries.
+        """
+        if value is self.data.get(key) and not _is_json_scalar(value):
+            # it may have been modified in place
+            self._changed(key)
+            return True
         try:
-            json.dumps(key, cls=JsonDBJsonEncoder)
-            json.dumps(value, cls=JsonDBJsonEncoder)
+            _check_json_serializable(key)
+            _check_json_serializable(value)
         except:
             self.logger.info(f"json error: cannot save {repr(key)} ({repr(value)})")
             return False
+        subkeys = _changed_subkeys(self.data.get(key), value)
+        if subkeys is None:
+            self._changed(key)
+        else:
+            for subkey in subkeys:
+                self._changed(key, subkey)
+            self._num_changes += 1  # even if equal, so that modifier does not flag it
         if value is not None:
             if self.data.get(key) != value:
-                self.data[key] = copy.deepcopy(value)
+                self.data[key] = value
                 return True
         elif key in self.data:
             # clear current contents in case of references
@@ -118,6 +256,34 @@ class JsonDB(Logger):
             return True
         return False
 
+    @modifier
+    def put_item(self, path: Sequence[str], value) -> bool:
+        """Set the entry at path, a key followed by keys into the dicts
+        stored under it, creating dicts on the way. A value of None
+        removes the entry. The change is made under the lock, and only
+        the entry is recorded as changed.
+        """
+        self._changed(*path)
+        try:
+            _check_json_serializable(value)
+        except:
+            self.logger.info(f"json error: cannot save {repr(path)} ({repr(value)})")
+            return False
+        container = self.data
+        for key in path[:-1]:
+            if key not in container:
+                if value is None:
+                    return False
+                container[key] = {}
+            container = container[key]
+        key = path[-1]
+        if value is None:
+            return container.pop(key, None) is not None
+        if container.get(key) == value:
+            return False
+        container[key] = value
+        return True
+
     def commit(self):
         pass
 
@@ -125,7 +291,61 @@ class JsonDB(Logger):
     def dump(self):
         return json.dumps(self.data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
 
-    def load_data(self, s):
+    @locked
+    def dump_changes(self) -> Optional[str]:
+        """Return the changes since the previous call as a log record,
+        a JSON list of ["set", path, value] and ["remove", path] operations.
+        Returns None if some change was not tracked, in which case only
+        a full dump() can save it.
+        """
+        paths, self._changed_paths = self._changed_paths, set()
+        untracked, self._untracked_changes = self._untracked_changes, False
+        if untracked:
+            return None
+        ops = []
+        for path in sorted(paths, key=_path_sort_key):
+            if any(path[:i] in paths for i in range(1, len(path))):
+                continue  # covered by the value of a parent
+            container = self.data
+            for key in path[:-1]:
+                try:
+                    container = container[key]
+                except (KeyError, IndexError):
+                    break
+            else:
+                key = path[-1]
+                if isinstance(container, list) and key < len(container) \
+                        or isinstance(container, dict) and key in container:
+                    ops.append(["set", path, container[key]])
+                    continue
+            ops.append(["remove", path])
+        return json.dumps(ops, cls=JsonDBJsonEncoder)
+
+    def _apply_log(self, log: Sequence[list]):
+        for record in log:
+            for op in record:
+                path = op[1]
+                container = self.data
+                for key, next_key in zip(path[:-1], path[1:]):
+                    if isinstance(container, dict) and key not in container:
+                        if op[0] == "remove":
+                            break
+                        container[key] = [] if isinstance(next_key, int) else {}
+                    container = container[key]
+                else:
+                    key = path[-1]
+                    if op[0] == "set":
+                        if isinstance(container, list) and key == len(container):
+                            container.append(op[2])
+                        else:
+                            container[key] = op[2]
+                    elif op[0] == "remove":
+                        if isinstance(container, dict):
+                            container.pop(key, None)
+                    else:
+                        raise WalletFileException(f"unknown wallet log operation: {op[0]}")
+
+    def load_data(self, s, log: Sequence[list] = ()):
         try:
             self.data = json.loads(s)
         except:
@@ -145,6 +365,10 @@ class JsonDB(Logger):
                 self.data[key] = value
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
+        try:
+            self._apply_log(log)
+        except (KeyError, IndexError, TypeError) as e:
+            raise WalletFileException(f"Malformed wallet log: {repr(e)}") from e
 
         if not self.manual_upgrades and self.requires_split():
             raise WalletFileException("This wallet has multiple accounts and must be split")
@@ -192,6 +416,7 @@ class JsonDB(Logger):
     @profiler
     def upgrade(self):
         self.logger.info('upgrading wallet format')
+        self._untracked_changes = True  # the conversions edit self.data directly
         if not self._called_load_transactions:
             # note: not sure if this is how we should go about this...
             # alternatively, we could make sure load_transactions is always called after upgrade
@@ -394,16 +619,11 @@ class JsonDB(Logger):
 
         self.put('pruned_txo', None)
 
-        transactions = self.get('transactions', {})  # txid -> Transaction
-        spent_outpoints = defaultdict(dict)
-        for txid, tx in transactions.items():
-            for txin in tx.inputs():
+        for txid in self.list_transactions():
+            for txin in self.get_transaction(txid).inputs():
                 if txin['type'] == 'coinbase':
                     continue
-                prevout_hash = txin['prevout_hash']
-                prevout_n = txin['prevout_n']
-                spent_outpoints[prevout_hash][prevout_n] = txid
-        self.put('spent_outpoints', spent_outpoints)
+                self.set_spent_outpoint(txin['prevout_hash'], txin['prevout_n'], txid)
 
         self.put('seed_version', 17)
 
@@ -492,31 +712,35 @@ class JsonDB(Logger):
 
     @locked
     def get_txi_addr(self, tx_hash, address):
-        return self.txi.get(tx_hash, {}).get(address, [])
+        return [(r.ser(), r.value) for r in self.txi.get(tx_hash, {}).get(address, ())]
 
     @locked
     def get_txo_addr(self, tx_hash, address):
-        return self.txo.get(tx_hash, {}).get(address, [])
+        return self.txo.get(tx_hash, {}).get(address, ())
 
     @modifier
     def add_txi_addr(self, tx_hash, addr, ser, v):
         if tx_hash not in self.txi:
             self.txi[tx_hash] = {}
         d = self.txi[tx_hash]
-        if addr not in d:
-            # note that as this is a set, we can ignore "duplicates"
-            d[addr] = set()
-        d[addr].add((ser, v))
+        records = d.get(addr, ())
+        r = TxiRecord.from_ser(ser, v)
+        # ignore "duplicates"
+        if r not in records:
+            d[addr] = records + (r,)
+        self._changed('txi', tx_hash, addr)
 
     @modifier
     def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
         if tx_hash not in self.txo:
             self.txo[tx_hash] = {}
         d = self.txo[tx_hash]
-        if addr not in d:
-            # note that as this is a set, we can ignore "duplicates"
-            d[addr] = set()
-        d[addr].add((n, v, is_coinbase))
+        records = d.get(addr, ())
+        r = TxoRecord(n, v, is_coinbase)
+        # ignore "duplicates"
+        if r not in records:
+            d[addr] = records + (r,)
+        self._changed('txo', tx_hash, addr)
 
     @locked
     def list_txi(self):
@@ -529,10 +753,12 @@ class JsonDB(Logger):
     @modifier
     def remove_txi(self, tx_hash):
         self.txi.pop(tx_hash, None)
+        self._changed('txi', tx_hash)
 
     @modifier
     def remove_txo(self, tx_hash):
         self.txo.pop(tx_hash, None)
+        self._changed('txo', tx_hash)
 
     @locked
     def list_spent_outpoints(self):
@@ -543,36 +769,59 @@ class JsonDB(Logger):
 
     @locked
     def get_spent_outpoints(self, prevout_hash):
-        return list(self.spent_outpoints.get(prevout_hash, {}).keys())
+        return [str(n) for n in self.spent_outpoints.get(prevout_hash, {}).keys()]
 
     @locked
     def get_spent_outpoint(self, prevout_hash, prevout_n):
-        return self.spent_outpoints.get(prevout_hash, {}).get(str(prevout_n))
+        return _bytes_to_hex(self.spent_outpoints.get(prevout_hash, {}).get(int(prevout_n)))
 
     @modifier
     def remove_spent_outpoint(self, prevout_hash, prevout_n):
-        self.spent_outpoints[prevout_hash].pop(prevout_n, None)  # FIXME
+        self.spent_outpoints[prevout_hash].pop(int(prevout_n), None)
         if not self.spent_outpoints[prevout_hash]:
             self.spent_outpoints.pop(prevout_hash)
+        self._changed('spent_outpoints', prevout_hash)
 
     @modifier
     def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
         if prevout_hash not in self.spent_outpoints:
             self.spent_outpoints[prevout_hash] = {}
-        self.spent_outpoints[prevout_hash][str(prevout_n)] = tx_hash
+        self.spent_outpoints[prevout_hash][int(prevout_n)] = _hex_to_bytes(tx_hash)
+        self._changed('spent_outpoints', prevout_hash)
+
+    def _cache_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        self._tx_cache[tx_hash] = tx
+        self._tx_cache.move_to_end(tx_hash)
+        if len(self._tx_cache) > TRANSACTION_CACHE_SIZE:
+            self._tx_cache.popitem(last=False)
 
     @modifier
     def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
         assert isinstance(tx, Transaction)
-        self.transactions[tx_hash] = tx
+        self.transactions[tx_hash] = _hex_to_bytes(str(tx))
+        self._cache_transaction(tx_hash, tx)
+        self._changed('transactions', tx_hash)
 
     @modifier
     def remove_transaction(self, tx_hash) -> Optional[Transaction]:
-        return self.transactions.pop(tx_hash, None)
+        tx = self.get_transaction(tx_hash)
+        self._tx_cache.pop(tx_hash, None)
+        self.transactions.pop(tx_hash, None)
+        self._changed('transactions', tx_hash)
+        return tx
 
     @locked
     def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
-        return self.transactions.get(tx_hash)
+        tx = self._tx_cache.get(tx_hash)
+        if tx is not None:
+            self._tx_cache.move_to_end(tx_hash)
+            return tx
+        raw = self.transactions.get(tx_hash)
+        if raw is None:
+            return None
+        tx = Transaction(_bytes_to_hex(raw))
+        self._cache_transaction(tx_hash, tx)
+        return tx
 
     @locked
     def list_transactions(self):
@@ -590,18 +839,35 @@ class JsonDB(Logger):
     def get_addr_history(self, addr):
         return self.history.get(addr, [])
 
+    @locked
+    def get_addr_history_status(self, addr):
+        """Return the status of the stored history of addr, as the server reports it."""
+        if addr not in self._addr_history_status:
+            self._addr_history_status[addr] = history_status(self.history.get(addr, []))
+        return self._addr_history_status[addr]
+
     @modifier
     def set_addr_history(self, addr, hist):
         self.history[addr] = hist
+        self._addr_history_status.pop(addr, None)
+        self._changed('addr_history', addr)
 
     @modifier
     def remove_addr_history(self, addr):
         self.history.pop(addr, None)
+        self._addr_history_status.pop(addr, None)
+        self._changed('addr_history', addr)
 
     @locked
     def list_verified_tx(self):
         return list(self.verified_tx.keys())
 
+    @locked
+    def list_verified_tx_above_height(self, height):
+        """Return the txids of verified txs mined above height, lowest first."""
+        i = bisect.bisect_left(self._verified_tx_by_height, (height + 1,))
+        return [txid for tx_height, txid in self._verified_tx_by_height[i:]]
+
     @locked
     def get_verified_tx(self, txid):
         if txid not in self.verified_tx:
@@ -615,17 +881,32 @@ class JsonDB(Logger):
 
     @modifier
     def add_verified_tx(self, txid, info):
+        self._remove_verified_tx_height(txid)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        bisect.insort(self._verified_tx_by_height, (info.height, txid))
+        self._changed('verified_tx3', txid)
 
     @modifier
     def remove_verified_tx(self, txid):
+        self._remove_verified_tx_height(txid)
         self.verified_tx.pop(txid, None)
+        self._changed('verified_tx3', txid)
+
+    def _remove_verified_tx_height(self, txid):
+        if txid not in self.verified_tx:
+            return
+        key = (self.verified_tx[txid][0], txid)
+        i = bisect.bisect_left(self._verified_tx_by_height, key)
+        if i < len(self._verified_tx_by_height) and self._verified_tx_by_height[i] == key:
+            del self._verified_tx_by_height[i]
 
     def is_in_verified_tx(self, txid):
         return txid in self.verified_tx
 
     @modifier
     def update_tx_fees(self, d):
+        for txid in d:
+            self._changed('tx_fees', txid)
         return self.tx_fees.update(d)
 
     @locked
@@ -635,6 +916,7 @@ class JsonDB(Logger):
     @modifier
     def remove_tx_fee(self, txid):
         self.tx_fees.pop(txid, None)
+        self._changed('tx_fees', txid)
 
     @locked
     def get_data_ref(self, name):
@@ -661,11 +943,13 @@ class JsonDB(Logger):
     @modifier
     def add_change_address(self, addr):
         self._addr_to_addr_index[addr] = (True, len(self.change_addresses))
+        self._changed('addresses', 'change', len(self.change_addresses))
         self.change_addresses.append(addr)
 
     @modifier
     def add_receiving_address(self, addr):
         self._addr_to_addr_index[addr] = (False, len(self.receiving_addresses))
+        self._changed('addresses', 'receiving', len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
 
     @locked
@@ -675,10 +959,12 @@ class JsonDB(Logger):
     @modifier
     def add_imported_address(self, addr, d):
         self.imported_addresses[addr] = d
+        self._changed('addresses', addr)
 
     @modifier
     def remove_imported_address(self, addr):
         self.imported_addresses.pop(addr)
+        self._changed('addresses', addr)
 
     @locked
     def has_imported_address(self, addr):
@@ -713,33 +999,65 @@ class JsonDB(Logger):
     def load_transactions(self):
         self._called_load_transactions = True
         # references in self.data
-        self.txi = self.get_data_ref('txi')  # txid -> address -> list of (prev_outpoint, value)
-        self.txo = self.get_data_ref('txo')  # txid -> address -> list of (output_index, value, is_coinbase)
-        self.transactions = self.get_data_ref('transactions')   # type: Dict[str, Transaction]
-        self.spent_outpoints = self.get_data_ref('spent_outpoints')
+        self.txi = self.get_data_ref('txi')  # txid -> address -> tuple of TxiRecord
+        self.txo = self.get_data_ref('txo')  # txid -> address -> tuple of TxoRecord
+        self.transactions = self.get_data_ref('transactions')   # txid -> raw tx, as bytes
+        # LRU of the Transaction objects built by get_transaction
+        self._tx_cache = OrderedDict()  # type: OrderedDict[str, Transaction]
+        self.spent_outpoints = self.get_data_ref('spent_outpoints')  # prevout_hash -> prevout_n -> spending txid
         self.history = self.get_data_ref('addr_history')  # address -> list of (txid, height)
+        self._addr_history_status = {}  # address -> history_status(self.history[address]), filled lazily
         self.verified_tx = self.get_data_ref('verified_tx3')  # txid -> (height, timestamp, txpos, header_hash)
+        # sorted list of (height, txid) of self.verified_tx, for reorgs
+        self._verified_tx_by_height = sorted((v[0], txid) for txid, v in self.verified_tx.items())
         self.tx_fees = self.get_data_ref('tx_fees')
-        # convert raw hex transactions to Transaction objects
+        # convert to the compact in-memory representation. Transaction
+        # objects are built by get_transaction.
         for tx_hash, raw_tx in self.transactions.items():
-            self.transactions[tx_hash] = Transaction(raw_tx)
-        # convert list to set
-        for t in self.txi, self.txo:
-            for d in t.values():
-                for addr, lst in d.items():
-                    d[addr] = set([tuple(x) for x in lst])
-        # remove unreferenced tx
-        for tx_hash in list(self.transactions.keys()):
-            if not self.get_txi(tx_hash) and not self.get_txo(tx_hash):
-                self.logger.info(f"removing unreferenced tx: {tx_hash}")
-                self.transactions.pop(tx_hash)
-        # remove unreferenced outpoints
-        for prevout_hash in self.spent_outpoints.keys():
-            d = self.spent_outpoints[prevout_hash]
-            for prevout_n, spending_txid in list(d.items()):
-                if spending_txid not in self.transactions:
-                    self.logger.info("removing unreferenced spent outpoint")
-                    d.pop(prevout_n)
+            self.transactions[tx_hash] = _hex_to_bytes(raw_tx)
+        from_ser = TxiRecord.from_ser
+        for d in self.txi.values():
+            for addr, lst in d.items():
+                d[addr] = tuple(x if isinstance(x, TxiRecord) else from_ser(*x) for x in lst)
+        make_txo = TxoRecord._make
+        for d in self.txo.values():
+            for addr, lst in d.items():
+                d[addr] = tuple(map(make_txo, lst))
+        for prevout_hash, d in self.spent_outpoints.items():
+            self.spent_outpoints[prevout_hash] = {int(n): _hex_to_bytes(txid) for n, txid in d.items()}
+
+    def remove_unreferenced_data(self, lock) -> None:
+        """Remove transactions not referred to by txi or txo, and spent
+        outpoints whose spending transaction we do not have.
+
+        This is slow for large wallets, so it is not done by
+        load_transactions but in the background once the wallet is usable.
+        lock, the wallet lock that serializes its history updates, is held
+        while checking each chunk of items.
+        """
+        tx_hashes = self.list_transactions()
+        for i in range(0, len(tx_hashes), CLEANUP_CHUNK_SIZE):
+            with lock, self.lock:
+                for tx_hash in tx_hashes[i:i+CLEANUP_CHUNK_SIZE]:
+                    if tx_hash in self.transactions and not self.txi.get(tx_hash) and not self.txo.get(tx_hash):
+                        self.logger.info(f"removing unreferenced tx: {tx_hash}")
+                        self.transactions.pop(tx_hash)
+                        self._tx_cache.pop(tx_hash, None)
+                        self._changed('transactions', tx_hash)
+                        self._modified = True
+        prevout_hashes = list(self.spent_outpoints.keys())
+        for i in range(0, len(prevout_hashes), CLEANUP_CHUNK_SIZE):
+            with lock, self.lock:
+                for prevout_hash in prevout_hashes[i:i+CLEANUP_CHUNK_SIZE]:
+                    d = self.spent_outpoints.get(prevout_hash, {})
+                    for prevout_n, spending_txid in list(d.items()):
+                        if _bytes_to_hex(spending_txid) not in self.transactions:
+                            self.logger.info("removing unreferenced spent outpoint")
+                            d.pop(prevout_n)
+                            self._changed('spent_outpoints', prevout_hash)
+                            self._modified = True
+                    if prevout_hash in self.spent_outpoints and not d:
+                        self.spent_outpoints.pop(prevout_hash)
 
     @modifier
     def clear_history(self):
@@ -747,6 +1065,12 @@ class JsonDB(Logger):
         self.txo.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self._tx_cache.clear()
         self.history.clear()
+        self._addr_history_status.clear()
         self.verified_tx.clear()
+        self._verified_tx_by_height.clear()
         self.tx_fees.clear()
+        for name in ('txi', 'txo', 'spent_outpoints', 'transactions',
+                     'addr_history', 'verified_tx3', 'tx_fees'):
+            self._changed(name)
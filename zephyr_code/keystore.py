@@ -151,7 +151,9 @@ class Imported_KeyStore(Software_KeyStore):
 
     def __init__(self, d):
         Software_KeyStore.__init__(self, d)
-        self.keypairs = d.get('keypairs', {})
+        # copied both ways, as storage does not copy: modifying a dict
+        # shared with the db would race with writes of the wallet file
+        self.keypairs = dict(d.get('keypairs', {}))
 
     def is_deterministic(self):
         return False
@@ -162,7 +164,7 @@ class Imported_KeyStore(Software_KeyStore):
     def dump(self):
         return {
             'type': self.type,
-            'keypairs': self.keypairs,
+            'keypairs': dict(self.keypairs),
             'pw_hash_version': self.pw_hash_version,
         }
 
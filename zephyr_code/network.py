@@ -25,20 +25,21 @@ import queue
 import os
 import random
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import threading
 import socket
 import json
 import sys
 import ipaddress
 import asyncio
+import functools
 from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple
 import traceback
 
 import dns
 import dns.resolver
 import aiorpcx
-from aiorpcx import TaskGroup
+from aiorpcx import TaskGroup, run_in_thread
 from aiohttp import ClientResponse
 
 from . import util
@@ -64,6 +65,8 @@ _logger = get_logger(__name__)
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+FORK_MANIFEST_INTERVAL = 60
+TX_CACHE_SIZE = 1000  # raw transactions shared by all wallets
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_RECENT_SERVERS = 20
 
@@ -216,6 +219,60 @@ class UntrustedServerReturnedError(Exception):
         return f"<UntrustedServerReturnedError original_exception: {repr(self.original_exception)}>"
 
 
+class SharedBatchRequests:
+    """Dedupes batch requests that several jobs, e.g. the synchronizers
+    of different wallets, make for the same keys. Keys already in flight
+    are waited for instead of being requested again, and the successful
+    results of the last cache_size keys are kept.
+    """
+
+    def __init__(self, request_batch, *, cache_size=0):
+        self._request_batch = request_batch  # coroutine: list of keys -> list of results
+        self._in_flight = {}  # key -> future
+        self._cache = OrderedDict()  # key -> result, least recently used first
+        self._cache_size = cache_size
+
+    async def get(self, keys: Sequence) -> list:
+        results = {}
+        waiting = {}
+        to_request = []
+        for key in dict.fromkeys(keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                results[key] = self._cache[key]
+            elif key in self._in_flight:
+                waiting[key] = self._in_flight[key]
+            else:
+                to_request.append(key)
+        if to_request:
+            await self._request(to_request, results)
+        if waiting:
+            await asyncio.wait(waiting.values())
+            # requests of other jobs that failed are made again
+            retry = [key for key, fut in waiting.items() if fut.cancelled()]
+            results.update((key, fut.result()) for key, fut in waiting.items() if not fut.cancelled())
+            if retry:
+                results.update(zip(retry, await self.get(retry)))
+        return [results[key] for key in keys]
+
+    async def _request(self, keys, results):
+        loop = asyncio.get_event_loop()
+        futs = {key: loop.create_future() for key in keys}
+        self._in_flight.update(futs)
+        try:
+            for key, result in zip(keys, await self._request_batch(keys)):
+                results[key] = result
+                futs[key].set_result(result)
+                if self._cache_size and not isinstance(result, Exception):
+                    self._cache[key] = result
+                    if len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+        finally:
+            for key, fut in futs.items():
+                del self._in_flight[key]
+                fut.cancel()  # no-op if it has a result
+
+
 INSTANCE = None
 
 
@@ -258,6 +315,8 @@ class Network(Logger):
             self.tor_on = False
 
         blockchain.read_blockchains(self.config)
+        blockchain.write_fork_manifest(self.config)
+        self.fork_manifest_time = time.time()
         self.logger.info(f"blockchains {list(map(lambda b: b.forkpoint, blockchain.blockchains.values()))}")
         self._blockchain_preferred_block = self.config.get('blockchain_preferred_block', None)  # type: Optional[Dict]
         self._blockchain = blockchain.get_best_chain()
@@ -278,9 +337,15 @@ class Network(Logger):
         # locks
         self.restart_lock = asyncio.Lock()
         self.bhi_lock = asyncio.Lock()
+        # transactions and merkle proofs requested by several wallets are fetched once
+        self._shared_tx_requests = SharedBatchRequests(
+            self._get_transactions_batch, cache_size=self.config.get('tx_cache_size', TX_CACHE_SIZE))
+        self._shared_merkle_requests = SharedBatchRequests(self._get_merkles_batch)
         self.callback_lock = threading.Lock()
         self.recent_servers_lock = threading.RLock()       # <- re-entrant
         self.interfaces_lock = threading.Lock()            # for mutating/iterating self.interfaces
+        self.notifier_lock = threading.Lock()
+        self._notifier = None  # created by start if there are watched addresses, or by 'notify'
 
         self.server_peers = {}  # returned by interface (servers that the main interface knows about)
         self.recent_servers = self._read_recent_servers()  # note: needs self.recent_servers_lock
@@ -370,6 +435,17 @@ class Network(Logger):
         except:
             pass
 
+    def get_notifier(self):
+        """Returns the Notifier serving the 'notify' command.
+        There is one per network, so its watched addresses and HTTP
+        connections are shared by all callers.
+        """
+        from .synchronizer import Notifier
+        with self.notifier_lock:
+            if self._notifier is None:
+                self._notifier = Notifier(self)
+            return self._notifier
+
     def get_server_height(self):
         interface = self.interface
         return interface.tip if interface else 0
@@ -813,15 +889,16 @@ class Network(Logger):
         filename = b.path()
         len_checkpoints = len(constants.net.CHECKPOINTS)
         length = ZC_HEADER_SIZE * len_checkpoints * 2016
-        if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                for i in range(len_checkpoints):
-                    for height, header_data in b.checkpoints[i][2]:
-                        f.seek(height*ZC_HEADER_SIZE)
-                        bin_header = util.bfh(header_data).ljust(ZC_HEADER_SIZE, util.bfh("00"))
-                        f.write(bin_header)
-            util.ensure_sparse_file(filename)
         with b.lock:
+            if not os.path.exists(filename) or os.path.getsize(filename) < length:
+                b.close_mmap()
+                with open(filename, 'wb') as f:
+                    for i in range(len_checkpoints):
+                        for height, header_data in b.checkpoints[i][2]:
+                            f.seek(height*ZC_HEADER_SIZE)
+                            bin_header = util.bfh(header_data).ljust(ZC_HEADER_SIZE, util.bfh("00"))
+                            f.write(bin_header)
+                util.ensure_sparse_file(filename)
             b.update_size()
 
     def best_effort_reliable(func):
@@ -872,6 +949,30 @@ class Network(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
+    async def get_merkles_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> list:
+        """Request the merkle branches of (tx_hash, tx_height) pairs in one batch.
+        A request the server returned an error for has an
+        UntrustedServerReturnedError in place of its result.
+        """
+        return await self._shared_merkle_requests.get([tuple(tx) for tx in txs])
+
+    @best_effort_reliable
+    async def _get_merkles_batch(self, txs: Sequence[Tuple[str, int]]) -> list:
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        requests = [('blockchain.transaction.get_merkle', [tx_hash, tx_height])
+                    for tx_hash, tx_height in txs]
+        return await self._send_batch_requests(requests)
+
+    async def _send_batch_requests(self, requests):
+        results = await self.interface.session.send_batch_requests(requests)
+        return [UntrustedServerReturnedError(original_exception=r)
+                if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in results]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx, *, timeout=None) -> None:
         if timeout is None:
@@ -1104,6 +1205,21 @@ class Network(Logger):
         return await self.interface.session.send_request('blockchain.transaction.get', [tx_hash],
                                                          timeout=timeout)
 
+    async def get_transactions(self, tx_hashes: Sequence[str]) -> list:
+        """Request several raw transactions in one batch.
+        A request the server returned an error for has an
+        UntrustedServerReturnedError in place of its result.
+        """
+        return await self._shared_tx_requests.get(tx_hashes)
+
+    @best_effort_reliable
+    async def _get_transactions_batch(self, tx_hashes: Sequence[str]) -> list:
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        return await self._send_batch_requests([('blockchain.transaction.get', [tx_hash])
+                                                for tx_hash in tx_hashes])
+
     @best_effort_reliable
     @catch_server_exceptions
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
@@ -1220,6 +1336,11 @@ class Network(Logger):
     def start(self, jobs: List=None):
         self._jobs = jobs or []
         asyncio.run_coroutine_threadsafe(self._start(), self.asyncio_loop)
+        # keep notifying about the addresses watched before a restart
+        from .synchronizer import Notifier
+        registry_path = Notifier.get_registry_path(self.config)
+        if registry_path and os.path.exists(registry_path):
+            self.get_notifier()
 
     @log_exceptions
     async def _stop(self, full_shutdown=False):
@@ -1235,6 +1356,13 @@ class Network(Logger):
         self.server_queue = None
         if not full_shutdown:
             self.trigger_callback('network_updated')
+        else:
+            blockchain.sync_headers_files()
+            blockchain.write_fork_manifest(self.config)
+            blockchain.shutdown_pow_executor()
+            if self._notifier:
+                # closes its HTTP session, and saves the registry
+                await self._notifier.stop()
 
     def stop(self):
         assert self._loop_thread != threading.current_thread(), 'must not be called from network thread'
@@ -1281,6 +1409,11 @@ class Network(Logger):
                     self.logger.info(f"disconnecting from {iface.server}. too many connected "
                                      f"servers already in bucket {iface.bucket_based_on_ipaddress()}")
                     await self._close_interface(iface)
+        async def maybe_write_fork_manifest():
+            now = time.time()
+            if blockchain.is_fork_manifest_dirty() and now - self.fork_manifest_time > FORK_MANIFEST_INTERVAL:
+                self.fork_manifest_time = now
+                await run_in_thread(blockchain.write_fork_manifest, self.config)
         async def maintain_main_interface():
             await self._ensure_there_is_a_main_interface()
             if self.is_connected():
@@ -1293,6 +1426,9 @@ class Network(Logger):
                 await maybe_queue_new_interfaces_to_be_launched_later()
                 await maintain_healthy_spread_of_connected_servers()
                 await maintain_main_interface()
+                # both fsync, keep them off the event loop
+                await run_in_thread(functools.partial(blockchain.sync_headers_files, only_due=True))
+                await maybe_write_fork_manifest()
             except asyncio.CancelledError:
                 # suppress spurious cancellations
                 group = self.main_taskgroup
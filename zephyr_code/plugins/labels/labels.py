@@ -104,7 +104,7 @@ class LabelsPlugin(BasePlugin):
         bundle = {"labels": [],
                   "walletId": wallet_id,
                   "walletNonce": self.get_nonce(wallet)}
-        for key, value in wallet.labels.items():
+        for key, value in wallet.db.get_copy('labels').items():
             try:
                 encoded_key = self.encode(wallet, key)
                 encoded_value = self.encode(wallet, value)
@@ -146,11 +146,11 @@ class LabelsPlugin(BasePlugin):
 
         for key, value in result.items():
             if force or not wallet.labels.get(key):
-                wallet.labels[key] = value
+                # not set_label, which would push the label back to the server
+                wallet.db.put_item(('labels', key), value)
 
         self.logger.info(f"received {len(response)} labels")
         # do not write to disk because we're in a daemon thread
-        wallet.storage.put('labels', wallet.labels)
         self.set_nonce(wallet, response["nonce"] + 1)
         self.on_pulled(wallet)
 
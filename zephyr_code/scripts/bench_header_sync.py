@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Benchmark of header catch-up against a local stand-in ElectrumX server.
+# The server serves a synthetic regtest chain and delays every
+# 'blockchain.block.headers' response to simulate network latency.
+# The same chain is synced once per download window.
+#
+# usage: bench_header_sync.py [num_headers] [latency_ms] [window ...]
+
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+
+from aiorpcx import RPCSession, Server
+from aiorpcx.jsonrpc import handler_invocation
+
+from zephyr_code import constants
+from zephyr_code.crypto import sha256d
+from zephyr_code.network import Network
+from zephyr_code.simple_config import SimpleConfig
+from zephyr_code.util import bfh, bh2u, create_and_start_event_loop
+
+
+# regtest genesis, version 1 so it is stored as an 80 byte header
+GENESIS_HEADER = bfh("0100000000000000000000000000000000000000000000000000000000000000000000009bc36d2ba74b96d57bf98bebdf25d1dc2977ae7773273a1014e98bf2e2f62e1bbb2eac56f0ff0f1edfa62400")
+
+
+def make_chain(num_headers):
+    headers = [GENESIS_HEADER]
+    prev_hash = bfh(constants.net.GENESIS)[::-1]
+    for height in range(1, num_headers):
+        header = ((4).to_bytes(4, 'little') + prev_hash + bytes(32)
+                  + (1454124731 + 60 * height).to_bytes(4, 'little')
+                  + (0x1e0ffff0).to_bytes(4, 'little')
+                  + height.to_bytes(4, 'little') + bytes(32))
+        headers.append(header)
+        prev_hash = sha256d(header)
+    return headers
+
+
+class StandInSession(RPCSession):
+
+    headers = []
+    latency = 0.
+
+    async def handle_request(self, request):
+        handler = getattr(self, 'on_' + request.method.replace('.', '_'), None)
+        return await handler_invocation(handler, request)()
+
+    def tip(self):
+        height = len(self.headers) - 1
+        return {'height': height, 'hex': bh2u(self.headers[height])}
+
+    async def on_server_version(self, client_name, protocol_version):
+        return ['stand-in', '1.4']
+
+    async def on_server_ping(self):
+        return None
+
+    async def on_server_banner(self):
+        return ''
+
+    async def on_server_donation_address(self):
+        return ''
+
+    async def on_server_peers_subscribe(self):
+        return []
+
+    async def on_blockchain_relayfee(self):
+        return 0.0001
+
+    async def on_blockchain_estimatefee(self, number):
+        return -1
+
+    async def on_mempool_get_fee_histogram(self):
+        return []
+
+    async def on_blockchain_headers_subscribe(self):
+        return self.tip()
+
+    async def on_blockchain_block_header(self, height):
+        await asyncio.sleep(self.latency)
+        return bh2u(self.headers[height])
+
+    async def on_blockchain_block_headers(self, start_height, count):
+        await asyncio.sleep(self.latency)
+        chunk = self.headers[start_height:start_height + count]
+        return {'hex': bh2u(b''.join(chunk)), 'count': len(chunk), 'max': 2016}
+
+
+def sync_once(port, window, tip):
+    data_dir = tempfile.mkdtemp()
+    try:
+        config = SimpleConfig({'electrum_path': data_dir,
+                               'server': f'127.0.0.1:{port}:t',
+                               'oneserver': True,
+                               'auto_connect': False,
+                               'header_download_window': window})
+        network = Network(config)
+        t0 = time.perf_counter()
+        network.start()
+        while network.get_local_height() < tip:
+            time.sleep(0.01)
+        dt = time.perf_counter() - t0
+        network.stop()
+        return dt
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 20 * 2016
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 100) / 1000
+    windows = [int(x) for x in sys.argv[3:]] or [1, 4, 8]
+    constants.set_regtest()
+    StandInSession.headers = make_chain(num_headers)
+    StandInSession.latency = latency
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    server = Server(StandInSession, '127.0.0.1', 0, loop=loop)
+    asyncio.run_coroutine_threadsafe(server.listen(), loop).result()
+    port = server.server.sockets[0].getsockname()[1]
+    try:
+        print(f"syncing {num_headers} headers, {latency * 1000:.0f} ms latency")
+        results = {}
+        for window in windows:
+            results[window] = sync_once(port, window, num_headers - 1)
+            print(f"window {window:<3} {results[window]:8.3f} s")
+        base = results[windows[0]]
+        for window in windows[1:]:
+            print(f"window {window} speedup: {base / results[window]:.1f}x")
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Benchmark of header reads over a synthetic headers file.
+# Compares the previous open/seek/read access pattern with Blockchain.read_header.
+#
+# usage: bench_headers.py [num_headers]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from zephyr_code import constants
+from zephyr_code.blockchain import Blockchain, deserialize_header, ZC_HEADER_SIZE
+from zephyr_code.simple_config import SimpleConfig
+
+
+def make_headers_file(path, num_headers):
+    with open(path, 'wb') as f:
+        for height in range(num_headers):
+            version = (4).to_bytes(4, 'little')
+            body = os.urandom(64)
+            timestamp = (1454124731 + 60 * height).to_bytes(4, 'little')
+            bits = (0x1e0ffff0).to_bytes(4, 'little')
+            nonce = height.to_bytes(4, 'little')
+            checkpoint = bytes(32)
+            f.write(version + body + timestamp + bits + nonce + checkpoint)
+
+
+def read_with_file_seek(path, num_headers):
+    for height in range(num_headers):
+        with open(path, 'rb') as f:
+            f.seek(height * ZC_HEADER_SIZE)
+            h = f.read(ZC_HEADER_SIZE)
+        deserialize_header(h, height)
+
+
+def read_with_blockchain(chain, num_headers):
+    for height in range(num_headers):
+        chain.read_header(height)
+
+
+def timed(name, func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    dt = time.perf_counter() - t0
+    print(f"{name:<24} {dt:8.3f} s")
+    return dt
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    constants.set_regtest()
+    data_dir = tempfile.mkdtemp()
+    try:
+        config = SimpleConfig({'electrum_path': data_dir})
+        chain = Blockchain(config=config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        make_headers_file(chain.path(), num_headers)
+        chain.update_size()
+        print(f"reading {num_headers} headers")
+        before = timed("open/seek/read", read_with_file_seek, chain.path(), num_headers)
+        after = timed("Blockchain.read_header", read_with_blockchain, chain, num_headers)
+        print(f"speedup: {before / after:.1f}x")
+        chain.close_mmap()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
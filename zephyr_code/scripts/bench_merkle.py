@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of merkle branch verification.
+# Compares running the full tx parser on every inner node with
+# SPV.hash_merkle_root, which only parses nodes that pass a structural check.
+#
+# usage: bench_merkle.py [num_proofs] [branch_length]
+
+import os
+import sys
+import time
+
+from zephyr_code.bitcoin import hash_decode, hash_encode
+from zephyr_code.crypto import sha256d
+from zephyr_code.transaction import Transaction
+from zephyr_code.util import bh2u
+from zephyr_code.verifier import SPV, InnerNodeOfSpvProofIsValidTx
+
+
+def make_proofs(num_proofs, branch_length):
+    proofs = []
+    for i in range(num_proofs):
+        tx_hash = bh2u(os.urandom(32))
+        branch = [bh2u(os.urandom(32)) for j in range(branch_length)]
+        pos = int.from_bytes(os.urandom(4), 'little') % (1 << branch_length)
+        proofs.append((branch, tx_hash, pos))
+    return proofs
+
+
+def hash_merkle_root_full_parse(merkle_branch, tx_hash, leaf_pos_in_tree):
+    # previous implementation: deserialize every inner node
+    h = hash_decode(tx_hash)
+    for i, item in enumerate(merkle_branch):
+        item = hash_decode(item)
+        h = sha256d(item + h) if ((leaf_pos_in_tree >> i) & 1) else sha256d(h + item)
+        tx = Transaction(bh2u(h))
+        try:
+            tx.deserialize()
+        except:
+            pass
+        else:
+            raise InnerNodeOfSpvProofIsValidTx()
+    return hash_encode(h)
+
+
+def timed(name, func, proofs):
+    t0 = time.perf_counter()
+    roots = [func(*proof) for proof in proofs]
+    dt = time.perf_counter() - t0
+    print(f"{name:<20} {len(proofs) / dt:10.0f} proofs/s")
+    return dt, roots
+
+
+def main():
+    num_proofs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    branch_length = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    proofs = make_proofs(num_proofs, branch_length)
+    print(f"verifying {num_proofs} proofs with {branch_length} inner nodes each")
+    before, roots_before = timed("full parse", hash_merkle_root_full_parse, proofs)
+    after, roots_after = timed("structural check", SPV.hash_merkle_root, proofs)
+    assert roots_before == roots_after
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
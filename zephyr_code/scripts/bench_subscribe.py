@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Benchmark of scripthash subscription against a local stand-in ElectrumX server.
+# Every 'blockchain.scripthash.subscribe' response is delayed to simulate
+# server and network latency. The same addresses are subscribed once per
+# batch size; batch size 1 is the one-request-per-address behaviour.
+#
+# usage: bench_subscribe.py [num_addresses] [latency_ms] [batch_size ...]
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import concurrent.futures
+
+from aiorpcx import Server
+
+from zephyr_code import constants
+from zephyr_code.bitcoin import hash160_to_p2pkh
+from zephyr_code.network import Network
+from zephyr_code.simple_config import SimpleConfig
+from zephyr_code.synchronizer import SynchronizerBase
+from zephyr_code.util import create_and_start_event_loop
+
+from bench_header_sync import StandInSession, make_chain
+
+
+class SubscribeSession(StandInSession):
+
+    async def on_blockchain_scripthash_subscribe(self, scripthash):
+        await asyncio.sleep(self.latency)
+        return None
+
+
+class Subscriber(SynchronizerBase):
+
+    def __init__(self, network, addresses):
+        self.addresses = addresses
+        SynchronizerBase.__init__(self, network)
+
+    async def main(self):
+        for addr in self.addresses:
+            await self._add_address(addr)
+
+    async def _on_address_status(self, addr, status):
+        pass
+
+
+def subscribe_once(port, batch_size, addresses):
+    data_dir = tempfile.mkdtemp()
+    try:
+        config = SimpleConfig({'electrum_path': data_dir,
+                               'server': f'127.0.0.1:{port}:t',
+                               'oneserver': True,
+                               'auto_connect': False,
+                               'subscription_batch_size': batch_size})
+        network = Network(config)
+        network.start()
+        while not network.is_connected():
+            time.sleep(0.01)
+        t0 = time.perf_counter()
+        subscriber = Subscriber(network, addresses)
+        while subscriber.num_requests_sent_and_answered()[1] < len(addresses):
+            time.sleep(0.01)
+        dt = time.perf_counter() - t0
+        asyncio.run_coroutine_threadsafe(subscriber.stop(), network.asyncio_loop).result()
+        try:
+            network.stop()
+        except concurrent.futures.TimeoutError:
+            pass  # slow teardown, the measurement is done
+        return dt
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def main():
+    num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    batch_sizes = [int(x) for x in sys.argv[3:]] or [1, 100]
+    constants.set_regtest()
+    SubscribeSession.headers = make_chain(10)
+    SubscribeSession.latency = latency
+    addresses = [hash160_to_p2pkh(os.urandom(20)) for i in range(num_addresses)]
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    server = Server(SubscribeSession, '127.0.0.1', 0, loop=loop)
+    asyncio.run_coroutine_threadsafe(server.listen(), loop).result()
+    port = server.server.sockets[0].getsockname()[1]
+    try:
+        print(f"subscribing {num_addresses} addresses, {latency * 1000:.0f} ms latency")
+        results = {}
+        for batch_size in batch_sizes:
+            results[batch_size] = subscribe_once(port, batch_size, addresses)
+            print(f"batch size {batch_size:<5} {results[batch_size]:8.3f} s")
+        base = results[batch_sizes[0]]
+        for batch_size in batch_sizes[1:]:
+            print(f"batch size {batch_size} speedup: {base / results[batch_size]:.1f}x")
+    finally:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Benchmark of the wallet DB backends on a synthetic wallet: load time,
+# peak RSS and per-operation latency of JsonDB (full and incremental
+# writes) against SqliteDB. Every backend is measured in a fresh process.
+#
+# usage: bench_wallet_db.py [num_transactions]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import subprocess
+
+from zephyr_code.json_db import FINAL_SEED_VERSION
+from zephyr_code.sqlite_db import convert_json_wallet
+from zephyr_code.storage import WalletStorage
+from zephyr_code.util import TxMinedInfo
+
+NUM_SAMPLES = 1000
+NUM_WRITES = 20
+
+
+def random_hash():
+    return os.urandom(32).hex()
+
+
+def make_wallet(path, num_txs):
+    txids = [random_hash() for i in range(num_txs)]
+    addresses = ['D' + os.urandom(16).hex() for i in range(max(1, num_txs // 2))]
+    data = {'seed_version': FINAL_SEED_VERSION, 'wallet_type': 'standard',
+            'addresses': {'receiving': addresses, 'change': []},
+            'txi': {}, 'txo': {}, 'transactions': {}, 'spent_outpoints': {},
+            'addr_history': {addr: [] for addr in addresses},
+            'verified_tx3': {}, 'tx_fees': {}}
+    for i, txid in enumerate(txids):
+        addr = addresses[i // 2]
+        height = 1000 + i
+        data['transactions'][txid] = os.urandom(225).hex()  # the size of a typical p2pkh tx
+        data['txo'][txid] = {addr: [[0, 100000 + i, False]]}
+        if i > 0:
+            prev = txids[i - 1]
+            data['txi'][txid] = {addresses[(i - 1) // 2]: [[prev + ':0', 100000 + i - 1]]}
+            data['spent_outpoints'][prev] = {'0': txid}
+        data['addr_history'][addr].append([txid, height])
+        data['verified_tx3'][txid] = [height, 1500000000 + i, 1, random_hash()]
+        data['tx_fees'][txid] = 226
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(data, indent=4, sort_keys=True))
+    return txids, addresses
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def per_op_us(func, args):
+    t0 = time.perf_counter()
+    for a in args:
+        func(*a)
+    return (time.perf_counter() - t0) / len(args) * 1e6
+
+
+def run_child(path, incremental, ids_path):
+    t0 = time.perf_counter()
+    storage = WalletStorage(path, manual_upgrades=True, incremental=incremental)
+    db = storage.db
+    db.load_addresses('standard')
+    load_time = time.perf_counter() - t0
+    rss = max_rss_mb()
+    with open(ids_path) as f:
+        txids, addresses = json.load(f)
+    samples = random.sample(range(len(txids)), min(NUM_SAMPLES, len(txids)))
+    ops = {
+        'get_txo_addr': per_op_us(db.get_txo_addr, [(txids[i], addresses[i // 2]) for i in samples]),
+        'get_addr_history': per_op_us(db.get_addr_history, [(addresses[i // 2],) for i in samples]),
+        'get_verified_tx': per_op_us(db.get_verified_tx, [(txids[i],) for i in samples]),
+        'get_transaction': per_op_us(db.get_transaction, [(txids[i],) for i in samples]),
+        'get_tx_fee': per_op_us(db.get_tx_fee, [(txids[i],) for i in samples]),
+    }
+    def verify_and_write(txid):
+        db.add_verified_tx(txid, TxMinedInfo(height=10**6, timestamp=0, txpos=0, header_hash='00' * 32))
+        storage.write()
+    ops['add_verified_tx+write'] = per_op_us(verify_and_write, [(txids[i],) for i in samples[:NUM_WRITES]])
+    return {'load_s': load_time, 'rss_mb': rss, 'ops_us': ops}
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        print(json.dumps(run_child(sys.argv[2], sys.argv[3] == '1', sys.argv[4])))
+        return
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data_dir = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(data_dir, 'wallet.json')
+        sqlite_path = os.path.join(data_dir, 'wallet.sqlite')
+        ids_path = os.path.join(data_dir, 'ids.json')
+        print(f"generating a wallet with {num_txs} transactions")
+        txids, addresses = make_wallet(json_path, num_txs)
+        with open(ids_path, 'w') as f:
+            json.dump([txids, addresses], f)
+        t0 = time.perf_counter()
+        convert_json_wallet(WalletStorage(json_path, manual_upgrades=True), sqlite_path)
+        print(f"converted to SQLite in {time.perf_counter() - t0:.1f} s")
+        results = {}
+        for name, path, incremental in [('json', json_path, False),
+                                        ('json incremental', json_path, True),
+                                        ('sqlite', sqlite_path, False)]:
+            # every run writes, start from a copy of the original
+            run_path = path + '.run'
+            shutil.copyfile(path, run_path)
+            out = subprocess.check_output([sys.executable, __file__, '--child', run_path,
+                                           '1' if incremental else '0', ids_path],
+                                          stderr=subprocess.DEVNULL)
+            results[name] = json.loads(out)
+            os.remove(run_path)
+        names = list(results)
+        print(f"{'':24}" + ''.join(f"{name:>18}" for name in names))
+        print(f"{'load time (s)':24}" + ''.join(f"{results[n]['load_s']:18.2f}" for n in names))
+        print(f"{'peak RSS (MB)':24}" + ''.join(f"{results[n]['rss_mb']:18.1f}" for n in names))
+        for op in results['json']['ops_us']:
+            print(f"{op + ' (us)':24}" + ''.join(f"{results[n]['ops_us'][op]:18.1f}" for n in names))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
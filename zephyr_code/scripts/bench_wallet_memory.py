@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Memory benchmark of the in-memory wallet history on a synthetic wallet:
+# the size of each history section as plain JSON data (hex strings and
+# nested lists, as in the wallet file) against the compact representation
+# JsonDB keeps after load_transactions, and the time to dump both.
+#
+# usage: bench_wallet_memory.py [num_transactions]
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+from zephyr_code.json_db import JsonDB
+from zephyr_code.scripts.bench_wallet_db import make_wallet
+
+SECTIONS = ('transactions', 'txi', 'txo', 'spent_outpoints')
+
+
+def deep_size(obj, seen):
+    """Size of obj and of everything it refers to, not counting objects in seen."""
+    size = 0
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        if id(x) in seen:
+            continue
+        seen.add(id(x))
+        size += sys.getsizeof(x)
+        if isinstance(x, dict):
+            stack.extend(x.keys())
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple, set)):
+            stack.extend(x)
+        elif hasattr(x, '__slots__'):
+            stack.extend(getattr(x, name) for name in x.__slots__)
+    return size
+
+
+def measure(load, dump):
+    tracemalloc.start()
+    data = load()
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # keys are shared between sections, count them in the first one
+    seen = set()
+    sizes = {name: deep_size(data[name], seen) for name in SECTIONS}
+    t0 = time.perf_counter()
+    dump()
+    return {'traced': traced, 'sections': sizes, 'dump_s': time.perf_counter() - t0}
+
+
+def main():
+    num_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    data_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(data_dir, 'wallet.json')
+        print(f"generating a wallet with {num_txs} transactions")
+        make_wallet(path, num_txs)
+        with open(path, 'r', encoding='utf-8') as f:
+            s = f.read()
+        results = {}
+        data = None
+        def load_json():
+            nonlocal data
+            data = json.loads(s)
+            return data
+        results['json'] = measure(load_json, lambda: json.dumps(data, indent=4, sort_keys=True))
+        data = None
+        db = None
+        def load_db():
+            nonlocal db
+            db = JsonDB(s, manual_upgrades=True)
+            return db.data
+        results['JsonDB'] = measure(load_db, lambda: db.dump())
+        names = list(results)
+        print(f"{'':24}" + ''.join(f"{name:>12}" for name in names))
+        for section in SECTIONS:
+            print(f"{section + ' (MB)':24}" + ''.join(f"{results[n]['sections'][section] / 1e6:12.1f}" for n in names))
+        print(f"{'whole wallet (MB)':24}" + ''.join(f"{results[n]['traced'] / 1e6:12.1f}" for n in names))
+        print(f"{'dump (s)':24}" + ''.join(f"{results[n]['dump_s']:12.2f}" for n in names))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+# Convert a JSON wallet file to the SQLite backend. The JSON file is left
+# untouched; the new file can be opened like any other wallet file.
+
+import sys
+
+from zephyr_code.storage import WalletStorage
+from zephyr_code.sqlite_db import convert_json_wallet, is_sqlite_file
+from zephyr_code.util import print_msg, WalletFileException
+
+
+try:
+    src, dst = sys.argv[1:3]
+except ValueError:
+    print("usage: wallet_to_sqlite <json_wallet_path> <sqlite_wallet_path>")
+    sys.exit(1)
+
+if is_sqlite_file(src):
+    print_msg(f"{src} is already an SQLite wallet")
+    sys.exit(1)
+storage = WalletStorage(src, manual_upgrades=True)
+if not storage.file_exists():
+    print_msg(f"{src} does not exist")
+    sys.exit(1)
+try:
+    convert_json_wallet(storage, dst)
+except WalletFileException as e:
+    print_msg(f"error: {e}")
+    sys.exit(1)
+print_msg(f"wrote {dst}")
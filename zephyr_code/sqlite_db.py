@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2015 Thomas Voegtlin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import sqlite3
+from typing import Optional
+
+from .util import profiler, WalletFileException, TxMinedInfo, history_status
+from .transaction import Transaction
+from .json_db import JsonDB, JsonDBJsonEncoder, TxoRecord, FINAL_SEED_VERSION
+
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# keys of JsonDB.data kept in tables instead of the JSON document
+HISTORY_KEYS = ('txi', 'txo', 'transactions', 'spent_outpoints',
+                'addr_history', 'verified_tx3', 'tx_fees')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS txi (
+    tx_hash TEXT NOT NULL, address TEXT NOT NULL, prevout TEXT NOT NULL, value INTEGER NOT NULL,
+    PRIMARY KEY (tx_hash, address, prevout));
+CREATE TABLE IF NOT EXISTS txo (
+    tx_hash TEXT NOT NULL, address TEXT NOT NULL, n INTEGER NOT NULL, value INTEGER NOT NULL,
+    is_coinbase INTEGER NOT NULL,
+    PRIMARY KEY (tx_hash, address, n));
+CREATE TABLE IF NOT EXISTS transactions (tx_hash TEXT PRIMARY KEY, raw TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS spent_outpoints (
+    prevout_hash TEXT NOT NULL, prevout_n TEXT NOT NULL, tx_hash TEXT NOT NULL,
+    PRIMARY KEY (prevout_hash, prevout_n));
+CREATE INDEX IF NOT EXISTS spent_outpoints_tx_hash ON spent_outpoints (tx_hash);
+CREATE TABLE IF NOT EXISTS addr_history (address TEXT PRIMARY KEY, history TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS verified_tx (
+    tx_hash TEXT PRIMARY KEY, height INTEGER NOT NULL, timestamp INTEGER,
+    txpos INTEGER, header_hash TEXT);
+CREATE INDEX IF NOT EXISTS verified_tx_height ON verified_tx (height, tx_hash);
+CREATE TABLE IF NOT EXISTS tx_fees (tx_hash TEXT PRIMARY KEY, fee INTEGER);
+"""
+
+
+def is_sqlite_file(path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+class SqliteDB(JsonDB):
+    """A JsonDB that keeps the wallet history in indexed SQLite tables,
+    so that it does not have to be loaded into memory. The rest of the
+    JSON document is kept in memory as usual, and stored in the kv table.
+
+    Changes are made in an SQLite transaction, which commit() ends, so
+    that storage.write() saves them like it does for JsonDB.
+    SQLite wallets do not support storage encryption.
+    """
+
+    def __init__(self, path, *, manual_upgrades):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        rows = self.conn.execute("SELECT key, value FROM kv").fetchall()
+        raw = '{%s}' % ', '.join('%s: %s' % (json.dumps(k), v) for k, v in rows) if rows else ''
+        JsonDB.__init__(self, raw, manual_upgrades=manual_upgrades)
+
+    modifier = JsonDB.modifier
+    locked = JsonDB.locked
+
+    def _changed_table(self):
+        # history modifiers write to the tables, not to the JSON document
+        self._num_changes += 1
+
+    @locked
+    def commit(self):
+        paths, self._changed_paths = self._changed_paths, set()
+        untracked, self._untracked_changes = self._untracked_changes, False
+        keys = set(self.data) if untracked else {path[0] for path in paths}
+        for key in keys:
+            if key in self.data:
+                value = json.dumps(self.data[key], cls=JsonDBJsonEncoder)
+                self.conn.execute("REPLACE INTO kv (key, value) VALUES (?, ?)", (key, value))
+            else:
+                self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        if untracked:
+            self.conn.execute("DELETE FROM kv WHERE key NOT IN (%s)" % ','.join('?' * len(self.data)),
+                              list(self.data))
+        self.conn.commit()
+
+    @locked
+    def close(self):
+        self.conn.close()
+
+    @locked
+    def dump(self):
+        data = dict(self.data)
+        data.update(self._dump_history())
+        return json.dumps(data, indent=4, sort_keys=True, cls=JsonDBJsonEncoder)
+
+    def _dump_history(self):
+        """Return the tables in the layout JsonDB keeps them in."""
+        h = {key: {} for key in HISTORY_KEYS}
+        for tx_hash, address, prevout, value in self.conn.execute("SELECT * FROM txi"):
+            h['txi'].setdefault(tx_hash, {}).setdefault(address, []).append((prevout, value))
+        for tx_hash, address, n, value, is_coinbase in self.conn.execute("SELECT * FROM txo"):
+            h['txo'].setdefault(tx_hash, {}).setdefault(address, []).append((n, value, bool(is_coinbase)))
+        h['transactions'] = dict(self.conn.execute("SELECT tx_hash, raw FROM transactions"))
+        for prevout_hash, prevout_n, tx_hash in self.conn.execute("SELECT * FROM spent_outpoints"):
+            h['spent_outpoints'].setdefault(prevout_hash, {})[prevout_n] = tx_hash
+        for address, hist in self.conn.execute("SELECT address, history FROM addr_history"):
+            h['addr_history'][address] = json.loads(hist)
+        for tx_hash, *info in self.conn.execute("SELECT * FROM verified_tx"):
+            h['verified_tx3'][tx_hash] = info
+        h['tx_fees'] = dict(self.conn.execute("SELECT tx_hash, fee FROM tx_fees"))
+        return h
+
+    @modifier
+    def put(self, key, value):
+        if key in HISTORY_KEYS:
+            raise WalletFileException(f"{key} is stored in tables by the SQLite backend")
+        return JsonDB.put(self, key, value)
+
+    @modifier
+    def put_item(self, path, value):
+        if path[0] in HISTORY_KEYS:
+            raise WalletFileException(f"{path[0]} is stored in tables by the SQLite backend")
+        return JsonDB.put_item(self, path, value)
+
+    def requires_upgrade(self):
+        # tables are only created from wallets at the final version
+        return False
+
+    def upgrade(self):
+        raise WalletFileException("SQLite wallets cannot be upgraded, convert an upgraded JSON wallet")
+
+    @profiler
+    def load_transactions(self):
+        self._called_load_transactions = True
+        self._addr_history_status = {}  # address -> history_status(history of address), filled lazily
+        # remove unreferenced tx
+        self.conn.execute("DELETE FROM transactions WHERE tx_hash NOT IN (SELECT tx_hash FROM txi)"
+                          " AND tx_hash NOT IN (SELECT tx_hash FROM txo)")
+        # remove unreferenced outpoints
+        self.conn.execute("DELETE FROM spent_outpoints WHERE tx_hash NOT IN (SELECT tx_hash FROM transactions)")
+
+    def remove_unreferenced_data(self, lock):
+        pass  # done by load_transactions, which is fast with SQLite
+
+    @locked
+    def get_txi(self, tx_hash):
+        return [r[0] for r in self.conn.execute(
+            "SELECT address FROM txi WHERE tx_hash = ? GROUP BY address ORDER BY MIN(rowid)", (tx_hash,))]
+
+    @locked
+    def get_txo(self, tx_hash):
+        return [r[0] for r in self.conn.execute(
+            "SELECT address FROM txo WHERE tx_hash = ? GROUP BY address ORDER BY MIN(rowid)", (tx_hash,))]
+
+    @locked
+    def get_txi_addr(self, tx_hash, address):
+        return list(self.conn.execute(
+            "SELECT prevout, value FROM txi WHERE tx_hash = ? AND address = ? ORDER BY rowid", (tx_hash, address)))
+
+    @locked
+    def get_txo_addr(self, tx_hash, address):
+        return tuple(TxoRecord(n, v, bool(is_coinbase)) for n, v, is_coinbase in self.conn.execute(
+            "SELECT n, value, is_coinbase FROM txo WHERE tx_hash = ? AND address = ? ORDER BY rowid", (tx_hash, address)))
+
+    @modifier
+    def add_txi_addr(self, tx_hash, addr, ser, v):
+        self.conn.execute("INSERT OR IGNORE INTO txi VALUES (?, ?, ?, ?)", (tx_hash, addr, ser, v))
+        self._changed_table()
+
+    @modifier
+    def add_txo_addr(self, tx_hash, addr, n, v, is_coinbase):
+        self.conn.execute("INSERT OR IGNORE INTO txo VALUES (?, ?, ?, ?, ?)",
+                          (tx_hash, addr, n, v, bool(is_coinbase)))
+        self._changed_table()
+
+    @locked
+    def list_txi(self):
+        return [r[0] for r in self.conn.execute("SELECT DISTINCT tx_hash FROM txi")]
+
+    @locked
+    def list_txo(self):
+        return [r[0] for r in self.conn.execute("SELECT DISTINCT tx_hash FROM txo")]
+
+    @modifier
+    def remove_txi(self, tx_hash):
+        self.conn.execute("DELETE FROM txi WHERE tx_hash = ?", (tx_hash,))
+        self._changed_table()
+
+    @modifier
+    def remove_txo(self, tx_hash):
+        self.conn.execute("DELETE FROM txo WHERE tx_hash = ?", (tx_hash,))
+        self._changed_table()
+
+    @locked
+    def list_spent_outpoints(self):
+        return list(self.conn.execute("SELECT prevout_hash, prevout_n FROM spent_outpoints"))
+
+    @locked
+    def get_spent_outpoints(self, prevout_hash):
+        return [r[0] for r in self.conn.execute(
+            "SELECT prevout_n FROM spent_outpoints WHERE prevout_hash = ?", (prevout_hash,))]
+
+    @locked
+    def get_spent_outpoint(self, prevout_hash, prevout_n):
+        r = self.conn.execute("SELECT tx_hash FROM spent_outpoints WHERE prevout_hash = ? AND prevout_n = ?",
+                              (prevout_hash, str(prevout_n))).fetchone()
+        return r[0] if r else None
+
+    @modifier
+    def remove_spent_outpoint(self, prevout_hash, prevout_n):
+        self.conn.execute("DELETE FROM spent_outpoints WHERE prevout_hash = ? AND prevout_n = ?",
+                          (prevout_hash, str(prevout_n)))
+        self._changed_table()
+
+    @modifier
+    def set_spent_outpoint(self, prevout_hash, prevout_n, tx_hash):
+        self.conn.execute("REPLACE INTO spent_outpoints VALUES (?, ?, ?)", (prevout_hash, str(prevout_n), tx_hash))
+        self._changed_table()
+
+    @modifier
+    def add_transaction(self, tx_hash: str, tx: Transaction) -> None:
+        assert isinstance(tx, Transaction)
+        self.conn.execute("REPLACE INTO transactions VALUES (?, ?)", (tx_hash, str(tx)))
+        self._changed_table()
+
+    @modifier
+    def remove_transaction(self, tx_hash) -> Optional[Transaction]:
+        tx = self.get_transaction(tx_hash)
+        self.conn.execute("DELETE FROM transactions WHERE tx_hash = ?", (tx_hash,))
+        self._changed_table()
+        return tx
+
+    @locked
+    def get_transaction(self, tx_hash: str) -> Optional[Transaction]:
+        r = self.conn.execute("SELECT raw FROM transactions WHERE tx_hash = ?", (tx_hash,)).fetchone()
+        return Transaction(r[0]) if r else None
+
+    @locked
+    def list_transactions(self):
+        return [r[0] for r in self.conn.execute("SELECT tx_hash FROM transactions")]
+
+    @locked
+    def get_history(self):
+        return [r[0] for r in self.conn.execute("SELECT address FROM addr_history")]
+
+    @locked
+    def is_addr_in_history(self, addr):
+        # does not mean history is non-empty!
+        return self.conn.execute("SELECT 1 FROM addr_history WHERE address = ?", (addr,)).fetchone() is not None
+
+    @locked
+    def get_addr_history(self, addr):
+        r = self.conn.execute("SELECT history FROM addr_history WHERE address = ?", (addr,)).fetchone()
+        return json.loads(r[0]) if r else []
+
+    @locked
+    def get_addr_history_status(self, addr):
+        """Return the status of the stored history of addr, as the server reports it."""
+        if addr not in self._addr_history_status:
+            self._addr_history_status[addr] = history_status(self.get_addr_history(addr))
+        return self._addr_history_status[addr]
+
+    @modifier
+    def set_addr_history(self, addr, hist):
+        self.conn.execute("REPLACE INTO addr_history VALUES (?, ?)", (addr, json.dumps(hist)))
+        self._addr_history_status.pop(addr, None)
+        self._changed_table()
+
+    @modifier
+    def remove_addr_history(self, addr):
+        self.conn.execute("DELETE FROM addr_history WHERE address = ?", (addr,))
+        self._addr_history_status.pop(addr, None)
+        self._changed_table()
+
+    @locked
+    def list_verified_tx(self):
+        return [r[0] for r in self.conn.execute("SELECT tx_hash FROM verified_tx")]
+
+    @locked
+    def list_verified_tx_above_height(self, height):
+        """Return the txids of verified txs mined above height, lowest first."""
+        return [r[0] for r in self.conn.execute(
+            "SELECT tx_hash FROM verified_tx WHERE height > ? ORDER BY height, tx_hash", (height,))]
+
+    @locked
+    def get_verified_tx(self, txid):
+        r = self.conn.execute("SELECT height, timestamp, txpos, header_hash FROM verified_tx"
+                              " WHERE tx_hash = ?", (txid,)).fetchone()
+        if r is None:
+            return None
+        height, timestamp, txpos, header_hash = r
+        return TxMinedInfo(height=height,
+                           conf=None,
+                           timestamp=timestamp,
+                           txpos=txpos,
+                           header_hash=header_hash)
+
+    @modifier
+    def add_verified_tx(self, txid, info):
+        self.conn.execute("REPLACE INTO verified_tx VALUES (?, ?, ?, ?, ?)",
+                          (txid, info.height, info.timestamp, info.txpos, info.header_hash))
+        self._changed_table()
+
+    @modifier
+    def remove_verified_tx(self, txid):
+        self.conn.execute("DELETE FROM verified_tx WHERE tx_hash = ?", (txid,))
+        self._changed_table()
+
+    @locked
+    def is_in_verified_tx(self, txid):
+        return self.conn.execute("SELECT 1 FROM verified_tx WHERE tx_hash = ?", (txid,)).fetchone() is not None
+
+    @modifier
+    def update_tx_fees(self, d):
+        self.conn.executemany("REPLACE INTO tx_fees VALUES (?, ?)", d.items())
+        self._changed_table()
+
+    @locked
+    def get_tx_fee(self, txid):
+        r = self.conn.execute("SELECT fee FROM tx_fees WHERE tx_hash = ?", (txid,)).fetchone()
+        return r[0] if r else None
+
+    @modifier
+    def remove_tx_fee(self, txid):
+        self.conn.execute("DELETE FROM tx_fees WHERE tx_hash = ?", (txid,))
+        self._changed_table()
+
+    @modifier
+    def clear_history(self):
+        for table in ('txi', 'txo', 'transactions', 'spent_outpoints', 'addr_history', 'verified_tx', 'tx_fees'):
+            self.conn.execute(f"DELETE FROM {table}")
+        self._addr_history_status.clear()
+        self._changed_table()
+
+    @locked
+    def import_history(self, data):
+        """Insert the history of a JSON wallet, as laid out in JsonDB.data."""
+        c = self.conn
+        c.executemany("INSERT OR IGNORE INTO txi VALUES (?, ?, ?, ?)",
+                      ((tx_hash, addr, ser, v)
+                       for tx_hash, d in data.get('txi', {}).items()
+                       for addr, lst in d.items() for ser, v in lst))
+        c.executemany("INSERT OR IGNORE INTO txo VALUES (?, ?, ?, ?, ?)",
+                      ((tx_hash, addr, n, v, bool(is_coinbase))
+                       for tx_hash, d in data.get('txo', {}).items()
+                       for addr, lst in d.items() for n, v, is_coinbase in lst))
+        c.executemany("REPLACE INTO transactions VALUES (?, ?)",
+                      ((tx_hash, str(raw)) for tx_hash, raw in data.get('transactions', {}).items()))
+        c.executemany("REPLACE INTO spent_outpoints VALUES (?, ?, ?)",
+                      ((prevout_hash, str(n), tx_hash)
+                       for prevout_hash, d in data.get('spent_outpoints', {}).items()
+                       for n, tx_hash in d.items()))
+        c.executemany("REPLACE INTO addr_history VALUES (?, ?)",
+                      ((addr, json.dumps(hist)) for addr, hist in data.get('addr_history', {}).items()))
+        c.executemany("REPLACE INTO verified_tx VALUES (?, ?, ?, ?, ?)",
+                      ((tx_hash, *info) for tx_hash, info in data.get('verified_tx3', {}).items()))
+        c.executemany("REPLACE INTO tx_fees VALUES (?, ?)", data.get('tx_fees', {}).items())
+        self._addr_history_status.clear()
+        self._modified = True
+
+
+def convert_json_wallet(storage, path):
+    """Write the wallet of a decrypted JSON storage to a new SQLite file at path."""
+    if storage.is_encrypted():
+        raise WalletFileException("SQLite wallets do not support storage encryption, "
+                                  "disable it before converting")
+    if os.path.exists(path):
+        raise WalletFileException(f"{path} already exists")
+    json_db = storage.db
+    if json_db.requires_upgrade():
+        json_db.upgrade()  # in memory only, the JSON wallet is left as is
+    assert json_db.get_seed_version() == FINAL_SEED_VERSION
+    data = json.loads(json_db.dump())
+    temp_path = "%s.tmp.%s" % (path, os.getpid())
+    db = SqliteDB(temp_path, manual_upgrades=True)
+    try:
+        for key, value in data.items():
+            if key not in HISTORY_KEYS:
+                db.put(key, value)
+        db.import_history(data)
+        db.commit()
+    finally:
+        db.close()
+    os.replace(temp_path, path)
@@ -23,6 +23,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
 import threading
 import stat
 import hashlib
@@ -34,6 +35,7 @@ from .util import profiler, InvalidPassword, WalletFileException, bfh, standardi
 from .plugin import run_hook, plugin_loaders
 
 from .json_db import JsonDB
+from .sqlite_db import SqliteDB, is_sqlite_file
 from .logging import Logger
 
 
@@ -45,25 +47,45 @@ def get_derivation_used_for_hw_device_encryption():
 # storage encryption version
 STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW = range(0, 3)
 
+# Incremental storage: changes are appended to the wallet file, after the
+# snapshot written by a full write, one line per record. Lines of the
+# snapshot can't start with this character, neither in JSON nor in base64.
+LOG_RECORD_PREFIX = '@'
+LOG_MIN_COMPACTION_SIZE = 1 << 20  # bytes; the log is also allowed to grow to the snapshot size
 
 
 class WalletStorage(Logger):
 
-    def __init__(self, path, *, manual_upgrades=False):
+    def __init__(self, path, *, manual_upgrades=False, incremental=False):
+        """If incremental is set, writes append the changes to the file
+        instead of rewriting it. Files with appended changes are read
+        either way.
+        """
         Logger.__init__(self)
         self.lock = threading.RLock()
         self.path = standardize_path(path)
         self._file_exists = self.path and os.path.exists(self.path)
+        self.incremental = incremental
+        self._log_records = []  # raw records read after the snapshot
+        self._snapshot_size = 0
+        self._log_size = 0
+        self._snapshot_needed = True  # until the file matches the db
 
         DB_Class = JsonDB
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
-        if self.file_exists():
+        if self.file_exists() and is_sqlite_file(self.path):
+            self._encryption_version = STO_EV_PLAINTEXT
+            self.db = SqliteDB(self.path, manual_upgrades=manual_upgrades)
+            self.load_plugins()
+        elif self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
+            self._read_log()
             self._encryption_version = self._init_encryption_version()
             if not self.is_encrypted():
-                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades)
+                log = self._parse_log_records(lambda record: record)
+                self.db = DB_Class(self.raw, manual_upgrades=manual_upgrades, log=log)
                 if self.db.upgrade_done:
                     try:
                         self.backup_old_version()
@@ -92,6 +114,36 @@ class WalletStorage(Logger):
         with self.lock:
             self._write()
 
+    def _read_log(self):
+        """Split self.raw into the snapshot and the records appended to it."""
+        i = self.raw.find('\n' + LOG_RECORD_PREFIX)
+        if i < 0:
+            self._snapshot_size = len(self.raw)
+            return
+        lines = self.raw[i+1:].split('\n')
+        self.raw = self.raw[:i]
+        self._snapshot_size = len(self.raw)
+        self._log_records = lines
+        self._log_size = sum(len(line) + 1 for line in lines)
+
+    def _parse_log_records(self, decrypt):
+        log = []
+        for record in self._log_records:
+            # a record is unreadable if appending it was interrupted
+            try:
+                assert record.startswith(LOG_RECORD_PREFIX)
+                ops = json.loads(decrypt(record[len(LOG_RECORD_PREFIX):]))
+                assert isinstance(ops, list)
+            except Exception as e:
+                # later records may depend on this one, drop them too
+                self.logger.warning(f'ignoring unreadable wallet log record and what follows: {repr(e)}')
+                break
+            log.append(ops)
+        # a full write is not needed until the log gets compacted,
+        # unless it has to replace unreadable records
+        self._snapshot_needed = len(log) < len(self._log_records)
+        return log
+
     def _write(self):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
@@ -99,6 +151,32 @@ class WalletStorage(Logger):
         if not self.db.modified():
             return
         self.db.commit()
+        if isinstance(self.db, SqliteDB):
+            # changes are saved in place by commit()
+            self.db.set_modified(False)
+            return
+        changes = self.db.dump_changes()
+        if (self.incremental and changes is not None and not self._snapshot_needed
+                and self._log_size < max(LOG_MIN_COMPACTION_SIZE, self._snapshot_size)):
+            self._append(changes)
+        else:
+            self._write_snapshot()
+        self.db.set_modified(False)
+
+    def _append(self, changes: str):
+        s = '\n' + LOG_RECORD_PREFIX + self.encrypt_before_writing(changes)
+        try:
+            with open(self.path, "a", encoding='utf-8') as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            # the record may be partly written, rewrite the file next time
+            self._snapshot_needed = True
+            raise
+        self._log_size += len(s)
+
+    def _write_snapshot(self):
         s = self.encrypt_before_writing(self.db.dump())
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
@@ -112,8 +190,10 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._snapshot_size = len(s)
+        self._log_size = 0
+        self._snapshot_needed = False
         self.logger.info(f"saved {self.path}")
-        self.db.set_modified(False)
 
     def file_exists(self):
         return self._file_exists
@@ -187,7 +267,9 @@ class WalletStorage(Logger):
             s = None
         self.pubkey = ec_key.get_public_key_hex()
         s = s.decode('utf8')
-        self.db = JsonDB(s, manual_upgrades=True)
+        log = self._parse_log_records(
+            lambda record: zlib.decompress(ec_key.decrypt_message(record, enc_magic)).decode('utf8'))
+        self.db = JsonDB(s, manual_upgrades=True, log=log)
         self.load_plugins()
 
     def encrypt_before_writing(self, plaintext: str) -> str:
@@ -216,13 +298,16 @@ class WalletStorage(Logger):
         if enc_version is None:
             enc_version = self._encryption_version
         if password and enc_version != STO_EV_PLAINTEXT:
+            if isinstance(self.db, SqliteDB):
+                raise WalletFileException('SQLite wallets do not support storage encryption')
             ec_key = self.get_eckey_from_password(password)
             self.pubkey = ec_key.get_public_key_hex()
             self._encryption_version = enc_version
         else:
             self.pubkey = None
             self._encryption_version = STO_EV_PLAINTEXT
-        # make sure next storage.write() saves changes
+        # make sure next storage.write() saves changes, with the new key
+        self._snapshot_needed = True
         self.db.set_modified(True)
 
     def requires_upgrade(self):
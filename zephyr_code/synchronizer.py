@@ -22,19 +22,23 @@
 # ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import os
+import json
 import asyncio
-import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple
+import heapq
+import itertools
+import urllib.parse
+from typing import Dict, List, Optional, Set, TYPE_CHECKING, Tuple
 from collections import defaultdict
 import logging
 
-from aiorpcx import TaskGroup, run_in_thread, RPCError
+from aiorpcx import run_in_thread, RPCError
 
 from .transaction import Transaction
-from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer
+from .util import make_aiohttp_session, NetworkJobOnDefaultServer, history_status
 from .bitcoin import address_to_scripthash, is_address
 from .network import UntrustedServerReturnedError
-from .logging import Logger
+from .logging import get_logger, Logger
 from .interface import GracefulDisconnect
 
 if TYPE_CHECKING:
@@ -42,16 +46,26 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+_logger = get_logger(__name__)
+
+
 class SynchronizerFailure(Exception): pass
 
 
-def history_status(h):
-    if not h:
-        return None
-    status = ''
-    for tx_hash, height in h:
-        status += tx_hash + ':%d:' % height
-    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+SUBSCRIPTION_BATCH_SIZE = 100  # addresses per JSON-RPC batch
+SUBSCRIPTION_BATCH_WINDOW = 4  # batches in flight
+
+TX_BATCH_SIZE = 20  # transactions per JSON-RPC batch
+TX_REQUEST_CONCURRENCY = 4  # batches in flight
+# order in which missing transactions are fetched
+TX_PRIORITY_PARENT = 0  # funds a transaction the wallet has or is fetching
+TX_PRIORITY_DEFAULT = 1
+
+NOTIFIER_MAX_CONNECTIONS = 100  # HTTP connections shared by all webhook deliveries
+NOTIFIER_CONNECTIONS_PER_HOST = 8
+NOTIFIER_MAX_ATTEMPTS = 6  # per delivery, before giving up
+NOTIFIER_RETRY_DELAY = 1  # seconds, doubled after every failed attempt
+NOTIFIER_SAVE_INTERVAL = 5  # seconds between writes of a changed registry
 
 
 class SynchronizerBase(NetworkJobOnDefaultServer):
@@ -68,6 +82,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         self.requested_addrs = set()
         self.scripthash_to_address = {}
         self._processed_some_notifications = False  # so that we don't miss them
+        self._state_changed = asyncio.Event()  # set when requests get answered
         self._reset_request_counters()
         # Queues
         self.add_queue = asyncio.Queue()
@@ -101,22 +116,43 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
+        config = self.network.config
+        batch_size = max(1, int(config.get('subscription_batch_size', SUBSCRIPTION_BATCH_SIZE)))
+        window = asyncio.Semaphore(max(1, int(config.get('subscription_batch_window',
+                                                         SUBSCRIPTION_BATCH_WINDOW))))
+
+        async def subscribe_to_addresses(addrs):
             try:
-                await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
-            self._requests_answered += 1
-            self.requested_addrs.remove(addr)
+                hashes = []
+                for addr in addrs:
+                    h = address_to_scripthash(addr)
+                    self.scripthash_to_address[h] = addr
+                    hashes.append(h)
+                self._requests_sent += len(addrs)
+                try:
+                    if len(hashes) == 1:
+                        await self.session.subscribe('blockchain.scripthash.subscribe', hashes, self.status_queue)
+                    else:
+                        await self.session.subscribe_batch('blockchain.scripthash.subscribe',
+                                                           [[h] for h in hashes], self.status_queue)
+                except RPCError as e:
+                    if e.message == 'history too large':  # no unique error code
+                        raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+                    raise
+                self._requests_answered += len(addrs)
+                for addr in addrs:
+                    self.requested_addrs.remove(addr)
+                self._state_changed.set()
+            finally:
+                window.release()
 
         while True:
-            addr = await self.add_queue.get()
-            await self.group.spawn(subscribe_to_address, addr)
+            addrs = [await self.add_queue.get()]
+            # addresses queued while we wait for the window go in the same batch
+            await window.acquire()
+            while len(addrs) < batch_size and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            await self.group.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
@@ -124,6 +160,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             addr = self.scripthash_to_address[h]
             await self.group.spawn(self._on_address_status, addr, status)
             self._processed_some_notifications = True
+            self._state_changed.set()
 
     def num_requests_sent_and_answered(self) -> Tuple[int, int]:
         return self._requests_sent, self._requests_answered
@@ -143,23 +180,43 @@ class Synchronizer(SynchronizerBase):
     def __init__(self, wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         SynchronizerBase.__init__(self, wallet.network)
+        self._synchronized_height = None
+        wallet.network.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
 
     def _reset(self):
         super()._reset()
-        self.requested_tx = {}
+        self._need_synchronize = True  # wallet.synchronize might create addresses
+        self.requested_tx = {}  # txid -> height, of txs queued or being fetched
         self.requested_histories = {}
+        # wallet-wide queue of txs to fetch, consumed by _fetch_txs
+        self._tx_queue = []  # heap of (priority, seq, txid)
+        self._tx_queue_seq = itertools.count()
+        self._tx_queue_priority = {}  # txid -> priority, of the live entry in self._tx_queue
+        self._txs_queued = asyncio.Event()
+        self._tx_allow_not_found = set()  # txids the server may not know about
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    async def stop(self):
+        self.network.unregister_callback(self._on_blockchain_updated)
+        await super().stop()
+
+    def _on_blockchain_updated(self, event, *args):
+        # addresses age as blocks arrive, see address_is_old
+        height = self.network.get_local_height()
+        if height != self._synchronized_height:
+            self._synchronized_height = height
+            self._need_synchronize = True
+            self._state_changed.set()
+
     def is_up_to_date(self):
         return (not self.requested_addrs
                 and not self.requested_histories
                 and not self.requested_tx)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        if self.wallet.db.get_addr_history_status(addr) == status:
             return
         if addr in self.requested_histories:
             return
@@ -184,61 +241,113 @@ class Synchronizer(SynchronizerBase):
         else:
             # Store received history
             self.wallet.receive_history_callback(addr, hist, tx_fees)
+            if self.wallet.is_in_gap_limit_window(addr):
+                self._need_synchronize = True
             # Request transactions we don't have
             await self._request_missing_txs(hist)
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.pop(addr)
+        self._state_changed.set()
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             if self.wallet.db.get_transaction(tx_hash):
                 continue
-            transaction_hashes.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
-
-        if not transaction_hashes: return
-        async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
-
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        self._requests_sent += 1
-        try:
-            result = await self.network.get_transaction(tx_hash)
-        except UntrustedServerReturnedError as e:
-            # most likely, "No such mempool or blockchain transaction"
             if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
-        finally:
-            self._requests_answered += 1
-        tx = Transaction(result)
-        try:
-            tx.deserialize()  # see if raises
-        except Exception as e:
-            # possible scenarios:
-            # 1: server is sending garbage
-            # 2: there is a bug in the deserialization code
-            # 3: there was a segwit-like upgrade that changed the tx structure
-            #    that we don't know about
-            raise SynchronizerFailure(f"cannot deserialize transaction {tx_hash}") from e
-        if tx_hash != tx.txid():
-            raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
+                self._tx_allow_not_found.add(tx_hash)
+            is_parent = bool(self.wallet.db.get_spent_outpoints(tx_hash))
+            self._queue_tx(tx_hash, TX_PRIORITY_PARENT if is_parent else TX_PRIORITY_DEFAULT)
+
+    def _queue_tx(self, tx_hash, priority):
+        self._tx_queue_priority[tx_hash] = priority
+        heapq.heappush(self._tx_queue, (priority, next(self._tx_queue_seq), tx_hash))
+        self._txs_queued.set()
+
+    def _prioritize_tx(self, tx_hash):
+        """Move a queued tx ahead, as a tx we have spends from it."""
+        if self._tx_queue_priority.get(tx_hash, TX_PRIORITY_PARENT) > TX_PRIORITY_PARENT:
+            self._queue_tx(tx_hash, TX_PRIORITY_PARENT)  # the old entry becomes stale
+
+    def _take_tx_batch(self):
+        batch = []
+        batch_size = max(1, int(self.network.config.get('tx_batch_size', TX_BATCH_SIZE)))
+        while self._tx_queue and len(batch) < batch_size:
+            priority, seq, tx_hash = heapq.heappop(self._tx_queue)
+            if self._tx_queue_priority.get(tx_hash) != priority:
+                continue  # stale
+            del self._tx_queue_priority[tx_hash]
+            batch.append(tx_hash)
+        if not self._tx_queue:
+            self._txs_queued.clear()
+        return batch
+
+    async def _fetch_txs(self):
+        """Worker that fetches queued transactions in batches."""
+        while True:
+            await self._txs_queued.wait()
+            tx_hashes = self._take_tx_batch()
+            if not tx_hashes:
+                continue
+            self._requests_sent += len(tx_hashes)
+            try:
+                results = await self.network.get_transactions(tx_hashes)
+            finally:
+                self._requests_answered += len(tx_hashes)
+            found = []
+            for tx_hash, result in zip(tx_hashes, results):
+                if isinstance(result, UntrustedServerReturnedError):
+                    # most likely, "No such mempool or blockchain transaction"
+                    if tx_hash not in self._tx_allow_not_found:
+                        raise result
+                    self.requested_tx.pop(tx_hash)
+                    self._tx_allow_not_found.discard(tx_hash)
+                    self._state_changed.set()
+                else:
+                    found.append((tx_hash, result))
+            txs = await run_in_thread(self._deserialize_txs, found)
+            for (tx_hash, raw), tx in zip(found, txs):
+                self._receive_tx(tx_hash, tx)
+
+    @classmethod
+    def _deserialize_txs(cls, items):
+        txs = []
+        for tx_hash, raw in items:
+            tx = Transaction(raw)
+            try:
+                tx.deserialize()  # see if raises
+            except Exception as e:
+                # possible scenarios:
+                # 1: server is sending garbage
+                # 2: there is a bug in the deserialization code
+                # 3: there was a segwit-like upgrade that changed the tx structure
+                #    that we don't know about
+                raise SynchronizerFailure(f"cannot deserialize transaction {tx_hash}") from e
+            if tx_hash != tx.txid():
+                raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
+            txs.append(tx)
+        return txs
+
+    def _receive_tx(self, tx_hash, tx):
         tx_height = self.requested_tx.pop(tx_hash)
+        self._tx_allow_not_found.discard(tx_hash)
+        for txin in tx.inputs():
+            self._prioritize_tx(txin['prevout_hash'])
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.raw)}")
         # callbacks
         self.wallet.network.trigger_callback('new_transaction', self.wallet, tx)
+        self._state_changed.set()
 
     async def main(self):
         self.wallet.set_up_to_date(False)
+        for i in range(max(1, int(self.network.config.get('tx_request_concurrency',
+                                                          TX_REQUEST_CONCURRENCY)))):
+            await self.group.spawn(self._fetch_txs)
         # request missing txns, if any
         for addr in self.wallet.db.get_history():
             history = self.wallet.db.get_addr_history(addr)
@@ -249,10 +358,15 @@ class Synchronizer(SynchronizerBase):
         # add addresses to bootstrap
         for addr in self.wallet.get_addresses():
             await self._add_address(addr)
-        # main loop
+        # main loop, woken up by _state_changed
+        self._state_changed.set()
         while True:
-            await asyncio.sleep(0.1)
-            await run_in_thread(self.wallet.synchronize)
+            await self._state_changed.wait()
+            await asyncio.sleep(0.1)  # coalesce bursts of changes
+            self._state_changed.clear()
+            if self._need_synchronize:
+                self._need_synchronize = False
+                await run_in_thread(self.wallet.synchronize)
             up_to_date = self.is_up_to_date()
             if (up_to_date != self.wallet.is_up_to_date()
                     or up_to_date and self._processed_some_notifications):
@@ -265,33 +379,218 @@ class Synchronizer(SynchronizerBase):
 
 class Notifier(SynchronizerBase):
     """Watch addresses. Every time the status of an address changes,
-    an HTTP POST is sent to the corresponding URL.
+    an HTTP POST is sent to the corresponding URLs.
+
+    The watched addresses, and the status last delivered to each URL, are
+    kept in the data directory, so they survive restarts, and a status is
+    not sent again when the server reports it after a restart. Deliveries
+    share one pooled HTTP session, are coalesced per URL and address, and
+    are retried with exponential backoff.
     """
-    def __init__(self, network):
+    def __init__(self, network: 'Network'):
+        config = network.config
+        self._registry_path = self.get_registry_path(config)
+        self.watched_addresses = self._read_registry(self._registry_path)  # type: Dict[str, List[str]]
+        # addr -> url -> status last delivered
+        self._delivered = self._read_delivered(self._registry_path, self.watched_addresses)  # type: Dict[str, Dict[str, str]]
+        self._registry_dirty = False
         SynchronizerBase.__init__(self, network)
-        self.watched_addresses = defaultdict(list)  # type: Dict[str, List[str]]
         self.start_watching_queue = asyncio.Queue()
+        self.max_attempts = max(1, int(config.get('notifier_max_attempts', NOTIFIER_MAX_ATTEMPTS)))
+        self._max_connections = max(1, int(config.get('notifier_max_connections', NOTIFIER_MAX_CONNECTIONS)))
+        self._connections_per_host = max(1, int(config.get('notifier_connections_per_host',
+                                                           NOTIFIER_CONNECTIONS_PER_HOST)))
+        self._http_session = None  # created on first delivery
+        self._connection_slots = asyncio.Semaphore(self._max_connections)
+        # host -> (semaphore, deliveries using it), only for hosts with deliveries in progress
+        self._host_slots = {}  # type: Dict[str, Tuple[asyncio.Semaphore, int]]
+        # (url, addr) -> latest status, for deliveries queued or being retried
+        self._pending_deliveries = {}  # type: Dict[Tuple[str, str], str]
+        # deliveries outlive the connection to the server, so they are not in self.group
+        self._delivery_tasks = set()  # type: Set[asyncio.Future]
+        self._metrics = defaultdict(int)  # type: Dict[str, int]
+
+    @staticmethod
+    def get_registry_path(config) -> Optional[str]:
+        return os.path.join(config.path, "notifications") if config.path else None
+
+    @staticmethod
+    def _read_registry(path) -> Dict[str, List[str]]:
+        watched_addresses = defaultdict(list)
+        if not path or not os.path.exists(path):
+            return watched_addresses
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                data = json.loads(f.read())
+            for addr, urls in data.items():
+                if is_address(addr) and urls:
+                    watched_addresses[addr] = [str(url) for url in urls]
+        except Exception as e:
+            _logger.warning(f"could not read notification registry {path}: {repr(e)}")
+        return watched_addresses
+
+    @staticmethod
+    def _read_delivered(registry_path, watched_addresses) -> Dict[str, Dict[str, str]]:
+        path = registry_path + "_delivered" if registry_path else None
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                data = json.loads(f.read())
+            return {addr: {url: str(status) for url, status in statuses.items()
+                           if url in watched_addresses.get(addr, [])}
+                    for addr, statuses in data.items() if addr in watched_addresses}
+        except Exception as e:
+            _logger.warning(f"could not read delivered notifications {path}: {repr(e)}")
+            return {}
+
+    @staticmethod
+    def _write_json(path, data):
+        s = json.dumps(data, indent=4, sort_keys=True)
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        with open(temp_path, "w", encoding='utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def save_registry(self):
+        if not self._registry_path or not self._registry_dirty:
+            return
+        self._registry_dirty = False
+        self._write_json(self._registry_path, self.watched_addresses)
+        self._write_json(self._registry_path + "_delivered", self._delivered)
+
+    async def _save_registry_periodically(self):
+        try:
+            while True:
+                await asyncio.sleep(NOTIFIER_SAVE_INTERVAL)
+                self.save_registry()
+        finally:
+            self.save_registry()
+
+    def _watch(self, addr: str, url: str) -> bool:
+        """Add or, if url is empty, remove a watch. Returns whether
+        the address has to be subscribed to.
+        """
+        if not url:
+            if self.watched_addresses.pop(addr, None) is not None:
+                self._delivered.pop(addr, None)
+                self._registry_dirty = True
+            return False
+        if url not in self.watched_addresses[addr]:
+            self.watched_addresses[addr].append(url)
+            self._registry_dirty = True
+        return True
 
     async def main(self):
+        await self.group.spawn(self._save_registry_periodically())
         # resend existing subscriptions if we were restarted
-        for addr in self.watched_addresses:
+        for addr in list(self.watched_addresses):
             await self._add_address(addr)
         # main loop
         while True:
             addr, url = await self.start_watching_queue.get()
-            self.watched_addresses[addr].append(url)
-            await self._add_address(addr)
+            if self._watch(addr, url):
+                await self._add_address(addr)
 
     async def _on_address_status(self, addr, status):
         self.logger.info(f'new status for addr {addr}')
-        headers = {'content-type': 'application/json'}
-        data = {'address': addr, 'status': status}
-        for url in self.watched_addresses[addr]:
-            try:
-                async with make_aiohttp_session(proxy=self.network.proxy, headers=headers) as session:
-                    async with session.post(url, json=data, headers=headers) as resp:
-                        await resp.text()
-            except Exception as e:
-                self.logger.info(str(e))
-            else:
-                self.logger.info(f'Got Response for {addr}')
+        for url in self.watched_addresses.get(addr, []):
+            key = (url, addr)
+            coalesced = key in self._pending_deliveries
+            if not coalesced and self._delivered.get(addr, {}).get(url) == status:
+                # e.g. the status the server sends when we subscribe after a restart
+                self._metrics['unchanged'] += 1
+                continue
+            self._pending_deliveries[key] = status
+            if coalesced:
+                # the queued delivery picks up the latest status
+                self._metrics['coalesced'] += 1
+                continue
+            task = asyncio.ensure_future(self._deliver(url, addr))
+            self._delivery_tasks.add(task)
+            task.add_done_callback(self._delivery_tasks.discard)
+
+    async def _deliver(self, url: str, addr: str):
+        key = (url, addr)
+        host = urllib.parse.urlsplit(url).netloc
+        host_slots = self._get_host_slots(host)
+        attempt = 0
+        try:
+            while True:
+                status = self._pending_deliveries[key]
+                attempt += 1
+                async with self._connection_slots, host_slots:
+                    delivered = await self._post(url, {'address': addr, 'status': status})
+                if delivered:
+                    self._metrics['delivered'] += 1
+                    if url in self.watched_addresses.get(addr, []):
+                        self._delivered.setdefault(addr, {})[url] = status
+                        self._registry_dirty = True
+                    if self._pending_deliveries[key] == status:
+                        return
+                    attempt = 0  # the status changed meanwhile, deliver that too
+                    continue
+                if attempt >= self.max_attempts:
+                    self.logger.info(f'giving up notifying {url} about {addr}')
+                    self._metrics['failed'] += 1
+                    return
+                self._metrics['retried'] += 1
+                await asyncio.sleep(NOTIFIER_RETRY_DELAY * 2 ** (attempt - 1))
+        finally:
+            self._pending_deliveries.pop(key, None)
+            self._release_host_slots(host)
+
+    def _get_host_slots(self, host: str) -> asyncio.Semaphore:
+        """Connection slots shared by the deliveries to host. Every
+        call must be followed by one to _release_host_slots.
+        """
+        slots, users = self._host_slots.get(host, (None, 0))
+        if slots is None:
+            slots = asyncio.Semaphore(self._connections_per_host)
+        self._host_slots[host] = (slots, users + 1)
+        return slots
+
+    def _release_host_slots(self, host: str) -> None:
+        slots, users = self._host_slots[host]
+        if users > 1:
+            self._host_slots[host] = (slots, users - 1)
+        else:
+            # idle, so that hosts notified once are not kept forever
+            del self._host_slots[host]
+
+    async def _post(self, url: str, data: dict) -> bool:
+        try:
+            async with self._get_http_session().post(url, json=data) as resp:
+                await resp.read()
+                if resp.status < 400:
+                    return True
+                self.logger.info(f'notifying {url} failed: HTTP {resp.status}')
+        except Exception as e:
+            self.logger.info(f'notifying {url} failed: {repr(e)}')
+        return False
+
+    def _get_http_session(self):
+        if self._http_session is None:
+            headers = {'content-type': 'application/json'}
+            self._http_session = make_aiohttp_session(proxy=self.network.proxy, headers=headers,
+                                                      limit=self._max_connections,
+                                                      limit_per_host=self._connections_per_host)
+        return self._http_session
+
+    def get_metrics(self) -> Dict[str, int]:
+        metrics = {k: self._metrics[k] for k in ('delivered', 'retried', 'failed', 'coalesced', 'unchanged')}
+        metrics['pending'] = len(self._pending_deliveries)
+        metrics['watched_addresses'] = len(self.watched_addresses)
+        return metrics
+
+    async def stop(self):
+        await super().stop()
+        for task in list(self._delivery_tasks):
+            task.cancel()
+        await asyncio.gather(*self._delivery_tasks, return_exceptions=True)
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+        self.save_registry()
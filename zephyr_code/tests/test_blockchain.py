@@ -1,10 +1,13 @@
 import shutil
 import tempfile
 import os
+import random
+from unittest import mock
 
 from zephyr_code import constants, blockchain
 from zephyr_code.simple_config import SimpleConfig
-from zephyr_code.blockchain import Blockchain, deserialize_header, hash_header
+from zephyr_code.blockchain import (Blockchain, DGWWindow, deserialize_header, serialize_header,
+                                   hash_header, hash_padded_header, pad_chunk, work_of_target, MAX_TARGET)
 from zephyr_code.util import bh2u, bfh, make_dir
 
 from zephyr_code.tests.cases import SequentialTestCase
@@ -341,3 +344,300 @@ class TestBlockchain(SequentialTestCase):
 
         for b in (chain_u, chain_l, chain_z):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
+
+    def test_read_header_after_truncating_write(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        self.assertEqual(None, chain_u.read_header(0))
+
+        self._append_header(chain_u, self.HEADERS['A'])
+        self._append_header(chain_u, self.HEADERS['B'])
+        self._append_header(chain_u, self.HEADERS['C'])
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+
+        chain_u.write(chain_u._read_raw_header(0), 1 * 112)
+        self.assertEqual(1, chain_u.height())
+        self.assertEqual(None, chain_u.read_header(2))
+        self.assertEqual(hash_header(self.HEADERS['A']), hash_header(chain_u.read_header(1)))
+
+    def test_header_cache(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        hits, misses = chain_u.header_cache_info()[:2]
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_u.get_hash(5))
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_u.get_hash(5))
+        self.assertEqual(hits + 1, chain_u.header_cache_info().hits)
+        self.assertEqual(misses + 1, chain_u.header_cache_info().misses)
+
+        # overwriting a header must not serve the stale cached hash
+        chain_u.write(chain_u._read_raw_header(4), 5 * 112)
+        self.assertEqual(hash_header(self.HEADERS['E']), chain_u.get_hash(5))
+        # results are copies; callers cannot corrupt the cache
+        chain_u.read_header(5)['timestamp'] = 0
+        self.assertEqual(self.HEADERS['E']['timestamp'], chain_u.read_header(5)['timestamp'])
+
+    def test_dgw_window_matches_get_target_dgw_v3(self):
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        rnd = random.Random(42)
+        timestamp = 1454124731
+        with open(chain.path(), 'wb') as f:
+            for height in range(2100):
+                # irregular spacing, to exercise both timespan clamps
+                timestamp += rnd.choice([rnd.randint(-30, 20), rnd.randint(40, 90), rnd.randint(200, 600)])
+                header = {'version': 3, 'prev_block_hash': '00' * 32, 'merkle_root': '00' * 32,
+                          'timestamp': timestamp, 'nonce': height,
+                          'bits': Blockchain.target_to_bits(rnd.randint(MAX_TARGET // 10000, MAX_TARGET))}
+                f.write(bfh(serialize_header(header)).ljust(112, b'\x00'))
+        chain.update_size()
+
+        window = DGWWindow.from_chain(chain, 0)
+        for height in range(2100):
+            self.assertEqual(chain.get_target_dgw_v3(height, {'empty': True}), window.next_target(), height)
+            header = chain.read_header(height)
+            window.push(header['timestamp'], header['bits'])
+        window = DGWWindow.from_chain(chain, 2016)
+        self.assertEqual(chain.get_target(2016), window.next_target())
+
+        chain.write(bytes(112), 2000 * 112, truncate=False)  # zeroed header, as in the checkpoint region
+        with self.assertRaises(blockchain.MissingHeader):
+            DGWWindow.from_chain(chain, 2016).next_target()
+
+    def test_hash_padded_header(self):
+        Blockchain(config=self.config, forkpoint=0, parent=None,
+                   forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        for name, header in self.HEADERS.items():
+            raw = bfh(serialize_header(header)).ljust(112, b'\x00')
+            self.assertEqual(hash_header(header), hash_padded_header(raw), name)
+        zc_header = deserialize_header(bytes([4, 0, 0, 0]) + bytes(range(108)), 300)
+        raw = bfh(serialize_header(zc_header))
+        self.assertEqual(112, len(raw))
+        self.assertEqual(hash_header(zc_header), hash_padded_header(raw))
+
+    def test_connect_chunk_pads_short_headers(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+
+        short_headers = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEF')
+        zc_header = bytes([4, 0, 0, 0]) + bytes(range(108))
+        padded = pad_chunk(short_headers + zc_header)
+        self.assertEqual(7 * 112, len(padded))
+        self.assertEqual(short_headers[80:160] + bytes(32), padded[112:224])
+        self.assertEqual(zc_header, padded[6*112:])
+
+        self.assertTrue(chain_u.connect_chunk(0, short_headers.hex()))
+        self.assertEqual(5, chain_u.height())
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_u.get_hash(5))
+        self.assertFalse(chain_u.connect_chunk(0, short_headers[:400].hex() + short_headers[:80].hex()))
+
+    def test_pow_check_in_worker_processes(self):
+        constants.set_testnet()
+        try:
+            config = SimpleConfig({'electrum_path': self.data_dir, 'header_verification_workers': 2})
+            chain = Blockchain(config=config, forkpoint=0, parent=None,
+                               forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            data = pad_chunk(b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEF'))
+            self.assertEqual([hash_header(self.HEADERS[name]) for name in 'ABCDEF'],
+                             chain._check_pow_in_workers(0, bytes(data)))
+            data[2 * 112 + 76] ^= 1  # nonce of C
+            with self.assertRaises(Exception):
+                chain._check_pow_in_workers(0, bytes(data))
+        finally:
+            blockchain.shutdown_pow_executor()
+            constants.set_regtest()
+
+    def test_chainwork_index(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        work = lambda name: work_of_target(Blockchain.bits_to_target(self.HEADERS[name]['bits']))
+        self.assertEqual(sum(work(name) for name in 'ABCDEF'), chain_u.get_chainwork())
+        self.assertEqual(work('A') + work('B'), chain_u.get_chainwork(1))
+        self.assertTrue(os.path.exists(chain_u.chainwork_index_path()))
+
+        # a valid index is reused as is
+        chain_u.close_mmap()
+        with mock.patch.object(Blockchain, '_target_of_raw_header', side_effect=AssertionError):
+            chain_u = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                 forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            self.assertEqual(sum(work(name) for name in 'ABCDEF'), chain_u.get_chainwork())
+
+        # an index that does not match the headers file is rebuilt
+        chain_u.close_mmap()
+        with open(chain_u.path(), 'r+b') as f:
+            f.truncate(4 * 112)
+            f.seek(4 * 112)
+            f.write(bfh(serialize_header(self.HEADERS['A'])).ljust(112, b'\x00'))
+        chain_u = Blockchain(config=self.config, forkpoint=0, parent=None,
+                             forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        # A's bits claim more work than DGW expects at height 4, which is not credited
+        self.assertEqual(sum(work(name) for name in 'ABCDB'), chain_u.get_chainwork())
+
+        # overwritten headers are re-indexed
+        chain_u.write(chain_u._read_raw_header(0), 1 * 112)
+        self.assertEqual(1, chain_u.height())
+        self.assertEqual(work('A') + work('B'), chain_u.get_chainwork())
+
+    @mock.patch.object(blockchain, 'CHAINWORK_SYNC_LIMIT', 2)
+    @mock.patch.object(blockchain, 'CHAINWORK_BATCH_SIZE', 1)
+    def test_chainwork_index_built_in_thread(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        exact = chain_u.get_chainwork()
+        chain_u.close_mmap()
+        os.unlink(chain_u.chainwork_index_path())
+        with mock.patch.object(blockchain.threading.Thread, 'start') as start:
+            chain_u = Blockchain(config=self.config, forkpoint=0, parent=None,
+                                 forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        start.assert_called_once_with()
+        # estimated from the first header until the index is built
+        self.assertFalse(chain_u.is_chainwork_indexed(0))
+        work_a = work_of_target(Blockchain.bits_to_target(self.HEADERS['A']['bits']))
+        self.assertEqual(6 * work_a, chain_u.get_chainwork())
+        blockchain._fork_manifest_dirty = False
+        chain_u._build_chainwork_index()
+        self.assertIsNone(chain_u._chainwork_thread)
+        self.assertTrue(chain_u.is_chainwork_indexed(5))
+        self.assertEqual(exact, chain_u.get_chainwork())
+        self.assertTrue(blockchain.is_fork_manifest_dirty())
+
+    def test_forged_bits_do_not_win_fork_choice(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQRSTU':
+            self._append_header(chain_u, self.HEADERS[name])
+        # bits are not verified after POS_BLOCK (nor on regtest): a single
+        # header claiming a tiny target would carry more work than the whole chain
+        forged = dict(self.HEADERS['G'], bits=0x03008000)
+        chain_f = chain_u.fork(forged)
+        self.assertEqual(0, chain_u.forkpoint)
+        self.assertIs(chain_u, chain_f.parent)
+        self.assertEqual(chain_u.get_chainwork(5) + work_of_target(MAX_TARGET), chain_f.get_chainwork())
+        self.assertLess(chain_f.get_chainwork(), chain_u.get_chainwork())
+
+    def test_write_behind_and_torn_headers(self):
+        config = SimpleConfig({'electrum_path': self.data_dir, 'headers_fsync_interval': 3600})
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        with mock.patch('zephyr_code.blockchain.os.fsync') as fsync:
+            for name in 'ABC':
+                self._append_header(chain_u, self.HEADERS[name])
+            self.assertEqual(0, fsync.call_count)
+            blockchain.sync_headers_files(only_due=True)
+            self.assertEqual(0, fsync.call_count)
+            fsync.side_effect = OSError('fsync failed')
+            with self.assertRaises(OSError):
+                blockchain.sync_headers_files()
+            fsync.side_effect = None
+            blockchain.sync_headers_files()
+            self.assertEqual(2, fsync.call_count)
+            blockchain.sync_headers_files()
+            self.assertEqual(2, fsync.call_count)
+
+        # a crash may leave a header that is all zeroes, or only partly written
+        chain_u.close_mmap()
+        with open(chain_u.path(), 'ab') as f:
+            f.write(bytes(112))
+            f.write(bfh(serialize_header(self.HEADERS['D']))[:50])
+        chain_u = Blockchain(config=config, forkpoint=0, parent=None,
+                             forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        self.assertEqual(2, chain_u.height())
+        self.assertEqual(3 * 112, os.path.getsize(chain_u.path()))
+        self.assertTrue(chain_u.can_connect(self.HEADERS['D']))
+
+    def test_header_time_index(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQ':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        self._append_header(chain_l, self.HEADERS['H'])
+
+        for name in 'ABCDEFOPQ':
+            header = self.HEADERS[name]
+            self.assertEqual(header['timestamp'], chain_u.get_timestamp(header['block_height']))
+        self.assertEqual(self.HEADERS['H']['timestamp'], chain_l.get_timestamp(7))
+        self.assertEqual(self.HEADERS['F']['timestamp'], chain_l.get_timestamp(5))
+        self.assertIsNone(chain_u.get_timestamp(9))
+
+        self.assertEqual(0, chain_u.get_height_at_timestamp(0))
+        self.assertEqual(1, chain_u.get_height_at_timestamp(self.HEADERS['B']['timestamp']))
+        self.assertEqual(2, chain_u.get_height_at_timestamp(self.HEADERS['B']['timestamp'] + 1))
+        self.assertEqual(9, chain_u.get_height_at_timestamp(self.HEADERS['Q']['timestamp'] + 1))
+        self.assertEqual(6, chain_l.get_height_at_timestamp(self.HEADERS['G']['timestamp']))
+        self.assertEqual(8, chain_l.get_height_at_timestamp(self.HEADERS['H']['timestamp'] + 1))
+
+        # truncating writes are reflected; the older timestamp now at
+        # height 1 does not move height_at_timestamp back below height 1
+        chain_u.write(chain_u._read_raw_header(2) + chain_u._read_raw_header(0), 1 * 112)
+        self.assertEqual(self.HEADERS['A']['timestamp'], chain_u.get_timestamp(2))
+        self.assertIsNone(chain_u.get_timestamp(3))
+        self.assertEqual(1, chain_u.get_height_at_timestamp(self.HEADERS['B']['timestamp'] + 1))
+        self.assertEqual(3, chain_u.get_height_at_timestamp(self.HEADERS['C']['timestamp'] + 1))
+
+    def test_fork_manifest(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQRS':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJ':
+            self._append_header(chain_l, self.HEADERS[name])
+        chain_z = chain_l.fork(self.HEADERS['M'])
+        self.assertEqual([chain_l], chain_u.get_direct_children())
+        self.assertEqual([chain_z], chain_l.get_direct_children())
+        self.assertTrue(blockchain.is_fork_manifest_dirty())
+        blockchain.write_fork_manifest(self.config)
+        self.assertFalse(blockchain.is_fork_manifest_dirty())
+
+        def read_blockchains():
+            for b in blockchain.blockchains.values():
+                b.close_mmap()
+            blockchain.blockchains = {}
+            blockchain.read_blockchains(self.config)
+            return sorted(blockchain.blockchains.values(), key=lambda b: b.forkpoint)
+
+        # chains in the manifest are not checked again
+        with mock.patch.object(Blockchain, 'can_connect', side_effect=AssertionError):
+            chain_u, chain_l, chain_z = read_blockchains()
+        self.assertEqual([chain_l], chain_u.get_direct_children())
+        self.assertEqual([chain_z], chain_l.get_direct_children())
+        self.assertEqual(hash_header(self.HEADERS['M']), chain_z.get_hash(9))
+        self.assertEqual(hash_header(self.HEADERS['I']), chain_z.get_hash(8))
+
+        # a chain that changed since is checked as usual
+        self._append_header(chain_l, self.HEADERS['K'])
+        with mock.patch.object(Blockchain, 'can_connect', autospec=True, side_effect=Blockchain.can_connect) as can_connect:
+            chain_u, chain_l, chain_z = read_blockchains()
+        self.assertEqual(1, can_connect.call_count)
+        self.assertEqual(10, chain_l.height())
+
+        # entries written against other checkpoints do not match
+        blockchain.write_fork_manifest(self.config)
+        entry = blockchain.read_fork_manifest(self.config)[os.path.basename(chain_u.path())]
+        self.assertTrue(chain_u.matches_manifest_entry(entry))
+        with mock.patch.object(constants.net, 'CHECKPOINTS', [['00' * 32, 0]]):
+            self.assertFalse(chain_u.matches_manifest_entry(entry))
@@ -1,11 +1,16 @@
 import asyncio
 import tempfile
+import threading
 import unittest
 
+from aiorpcx import Notification
+from aiorpcx.jsonrpc import RPCError
+
 from zephyr_code import constants
 from zephyr_code.simple_config import SimpleConfig
 from zephyr_code import blockchain
-from zephyr_code.interface import Interface
+from zephyr_code.interface import Interface, NotificationSession
+from zephyr_code.network import SharedBatchRequests
 from zephyr_code.crypto import sha256
 from zephyr_code.util import bh2u
 
@@ -16,6 +21,9 @@ class MockTaskGroup:
 class MockNetwork:
     main_taskgroup = MockTaskGroup()
     asyncio_loop = asyncio.get_event_loop()
+    interfaces = {}
+    interfaces_lock = threading.Lock()
+    def trigger_callback(self, event, *args): return
 
 class MockInterface(Interface):
     def __init__(self, config):
@@ -113,6 +121,146 @@ class TestNetwork(unittest.TestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_pipelined_catchup_connects_chunks_in_order(self):
+        self.config.set_key('header_download_window', 3)
+        ifa = self.interface
+        ifa.tip = 5 * 2016 + 20
+        in_flight, max_in_flight, connected = [0], [0], []
+        async def mock_fetch_chunk(index, tip=None):
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            # later chunks answer first
+            await asyncio.sleep(0.01 * (5 - index))
+            in_flight[0] -= 1
+            count = min(2016, tip - index * 2016 + 1)
+            return {'hex': str(index), 'count': count}
+        def mock_connect_chunk(index, hexdata):
+            self.assertEqual(str(index), hexdata)
+            connected.append(index)
+            return True
+        ifa._fetch_chunk = mock_fetch_chunk
+        ifa.blockchain.connect_chunk = mock_connect_chunk
+        res = asyncio.get_event_loop().run_until_complete(ifa.sync_until(0, next_height=5 * 2016 + 20))
+        self.assertEqual(('catchup', 5 * 2016 + 21), res)
+        self.assertEqual([0, 1, 2, 3, 4, 5], connected)
+        self.assertEqual(3, max_in_flight[0])
+        self.assertEqual({}, ifa._prefetched_chunks)
+
+    def test_pipelined_catchup_survives_failing_source(self):
+        self.config.set_key('header_download_window', 4)
+        ifa = self.interface
+        ifa.tip = 3 * 2016 + 20
+        class FailingSource:
+            def diagnostic_name(self): return 'failing'
+            async def _send_chunk_request(self, index, tip=None):
+                raise RPCError(1, 'no headers for you')
+        ifa._chunk_sources = lambda last_height: [ifa, FailingSource()]
+        fetched = []
+        async def mock_fetch_chunk(index, tip=None):
+            fetched.append(index)
+            return {'hex': str(index), 'count': min(2016, tip - index * 2016 + 1)}
+        ifa._fetch_chunk = mock_fetch_chunk
+        ifa.blockchain.connect_chunk = lambda index, hexdata: True
+        res = asyncio.get_event_loop().run_until_complete(ifa.sync_until(0, next_height=3 * 2016 + 20))
+        self.assertEqual(('catchup', 3 * 2016 + 21), res)
+        # odd chunks were assigned to the failing source, and refetched from ours
+        self.assertEqual([0, 1, 2, 3], sorted(fetched))
+        # the prefetch tasks belong to the interface's group, and none outlive sync_until
+        self.assertEqual(4, len(ifa.group._done))
+        self.assertEqual(set(), ifa.group._pending)
+
+
+class TestNotificationSession(unittest.TestCase):
+
+    def test_subscribe_batch(self):
+        session = NotificationSession()
+        session.cache[session.get_hashable_key_for_rpc_call('m', ['cached'])] = 'c'
+        sent = []
+        async def send_batch_requests(requests):
+            sent.append(requests)
+            return ['a', RPCError(1, 'history too large')]
+        session.send_batch_requests = send_batch_requests
+        queue = asyncio.Queue()
+        with self.assertRaises(RPCError):
+            asyncio.get_event_loop().run_until_complete(
+                session.subscribe_batch('m', [['a'], ['cached'], ['bad']], queue))
+        # only uncached requests are sent, and successful ones are delivered
+        self.assertEqual([[('m', ['a']), ('m', ['bad'])]], sent)
+        self.assertEqual([['a', 'a'], ['cached', 'c']], [queue.get_nowait() for i in range(queue.qsize())])
+        key = session.get_hashable_key_for_rpc_call('m', ['bad'])
+        self.assertEqual([queue], session.subscriptions[key])
+        self.assertNotIn(key, session.cache)
+
+    def test_shared_subscriptions(self):
+        session = NotificationSession()
+        sent = []
+        answer = asyncio.Event()
+        async def send_batch_requests(requests):
+            sent.append(requests)
+            await answer.wait()
+            return ['status_' + params[0] for method, params in requests]
+        session.send_batch_requests = send_batch_requests
+        q1, q2 = asyncio.Queue(), asyncio.Queue()
+        async def subscribe_both():
+            t1 = asyncio.ensure_future(session.subscribe_batch('m', [['a'], ['b']], q1))
+            await asyncio.sleep(0)
+            t2 = asyncio.ensure_future(session.subscribe_batch('m', [['b'], ['a']], q2))
+            await asyncio.sleep(0)
+            answer.set()
+            await asyncio.gather(t1, t2)
+        asyncio.get_event_loop().run_until_complete(subscribe_both())
+        # the second subscriber waited for the first request
+        self.assertEqual([[('m', ['a']), ('m', ['b'])]], sent)
+        self.assertEqual([['b', 'status_b'], ['a', 'status_a']], [q2.get_nowait() for i in range(2)])
+        # subscriptions are dropped when the last queue unsubscribes
+        key = session.get_hashable_key_for_rpc_call('m', ['a'])
+        session.unsubscribe(q1)
+        self.assertEqual([q2], session.subscriptions[key])
+        session.unsubscribe(q2)
+        self.assertNotIn(key, session.subscriptions)
+        self.assertNotIn(key, session.cache)
+        # later notifications from the server are ignored
+        session.close = None  # would be called on an unexpected notification
+        asyncio.get_event_loop().run_until_complete(
+            session.handle_request(Notification('m', ['a', 'status_a2'])))
+        self.assertNotIn(key, session.subscriptions)
+
+
+class TestSharedBatchRequests(unittest.TestCase):
+
+    def test_requests_are_shared(self):
+        requested = []
+        fail = [True]
+        async def request_batch(keys):
+            requested.append(list(keys))
+            await asyncio.sleep(0.01)
+            if keys == ['x'] and fail[0]:
+                fail[0] = False
+                raise Exception('disconnected')
+            return [k.upper() for k in keys]
+        shared = SharedBatchRequests(request_batch, cache_size=2)
+        async def get_all():
+            t1 = asyncio.ensure_future(shared.get(['a', 'b']))
+            await asyncio.sleep(0)
+            t2 = asyncio.ensure_future(shared.get(['b', 'c', 'a']))
+            return await asyncio.gather(t1, t2)
+        loop = asyncio.get_event_loop()
+        self.assertEqual([['A', 'B'], ['B', 'C', 'A']], loop.run_until_complete(get_all()))
+        self.assertEqual([['a', 'b'], ['c']], requested)
+        # least recently used key 'a' was evicted
+        self.assertEqual(['B', 'C', 'A'], loop.run_until_complete(shared.get(['b', 'c', 'a'])))
+        self.assertEqual(['a'], requested[-1])
+        # a waiter retries when the request it waited for fails
+        async def get_failing():
+            t1 = asyncio.ensure_future(shared.get(['x']))
+            await asyncio.sleep(0)
+            t2 = asyncio.ensure_future(shared.get(['x']))
+            with self.assertRaises(Exception):
+                await t1
+            return await t2
+        self.assertEqual(['X'], loop.run_until_complete(get_failing()))
+        self.assertEqual([['x'], ['x']], requested[-2:])
+
 
 if __name__=="__main__":
     constants.set_regtest()
@@ -0,0 +1,138 @@
+import os
+import json
+import shutil
+import tempfile
+
+from zephyr_code.json_db import JsonDB
+from zephyr_code.sqlite_db import SqliteDB, convert_json_wallet, is_sqlite_file
+from zephyr_code.storage import WalletStorage, STO_EV_USER_PW
+from zephyr_code.transaction import Transaction
+from zephyr_code.util import TxMinedInfo, WalletFileException
+
+from zephyr_code.tests.cases import SequentialTestCase
+
+
+SIGNED_TX = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+TXID = Transaction(SIGNED_TX).txid()
+PARENT_TXID = '3140eb24b43386f35ba69e3875eb6c93130ac66201d01c58f598defc949a5c2a'
+
+
+def fill(db):
+    db.load_addresses('standard')
+    db.put('wallet_type', 'standard')
+    db.put('labels', {'addr0': 'label'})
+    db.add_receiving_address('addr0')
+    db.add_change_address('addr1')
+    db.add_txi_addr(TXID, 'addr0', PARENT_TXID + ':0', 1000)
+    db.add_txo_addr(TXID, 'addr1', 0, 900, False)
+    db.add_txo_addr(TXID, 'addr1', 0, 900, False)
+    db.add_transaction(TXID, Transaction(SIGNED_TX))
+    db.set_spent_outpoint(PARENT_TXID, 0, TXID)
+    db.set_addr_history('addr0', [(TXID, 10)])
+    db.set_addr_history('addr1', [(TXID, 10)])
+    db.set_addr_history('addr2', [])
+    db.add_verified_tx(TXID, TxMinedInfo(height=10, timestamp=1000, txpos=1, header_hash='00' * 32))
+    db.add_verified_tx(PARENT_TXID, TxMinedInfo(height=5, timestamp=900, txpos=0, header_hash='11' * 32))
+    db.update_tx_fees({TXID: 100})
+
+
+def read(db):
+    return {
+        'txi': db.get_txi(TXID),
+        'txo': db.get_txo(TXID),
+        'txi_addr': db.get_txi_addr(TXID, 'addr0'),
+        'txo_addr': db.get_txo_addr(TXID, 'addr1'),
+        'list_txi': db.list_txi(),
+        'list_txo': db.list_txo(),
+        'spent': db.list_spent_outpoints(),
+        'spent_by': db.get_spent_outpoint(PARENT_TXID, 0),
+        'tx': str(db.get_transaction(TXID)),
+        'txs': db.list_transactions(),
+        'history': sorted(db.get_history()),
+        'in_history': db.is_addr_in_history('addr2'),
+        'addr_history': [tuple(x) for x in db.get_addr_history('addr0')],
+        'status': db.get_addr_history_status('addr0'),
+        'verified': db.get_verified_tx(TXID),
+        'above': db.list_verified_tx_above_height(4),
+        'fee': db.get_tx_fee(TXID),
+        'labels': db.get('labels'),
+        'receiving': db.get_receiving_addresses(),
+        'change': db.get_change_addresses(),
+    }
+
+
+class TestSqliteDB(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.user_dir, 'wallet.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+        super().tearDown()
+
+    def test_same_results_as_json_db(self):
+        json_db = JsonDB('', manual_upgrades=False)
+        sqlite_db = SqliteDB(self.path, manual_upgrades=False)
+        fill(json_db)
+        fill(sqlite_db)
+        self.assertEqual(read(json_db), read(sqlite_db))
+        for db in json_db, sqlite_db:
+            db.remove_spent_outpoint(PARENT_TXID, '0')
+            db.remove_verified_tx(PARENT_TXID)
+            db.remove_addr_history('addr2')
+            db.remove_tx_fee(TXID)
+        self.assertEqual(read(json_db), read(sqlite_db))
+        for db in json_db, sqlite_db:
+            db.clear_history()
+        self.assertEqual(read(json_db), read(sqlite_db))
+
+    def test_changes_are_saved_on_write(self):
+        storage = WalletStorage(self.path)
+        storage.db = SqliteDB(self.path, manual_upgrades=False)
+        fill(storage.db)
+        storage.write()
+        storage.db.put('labels', {})
+        storage.db.remove_txi(TXID)
+        storage.db.close()  # without writing
+        self.assertTrue(is_sqlite_file(self.path))
+        storage = WalletStorage(self.path, manual_upgrades=True)
+        self.assertIsInstance(storage.db, SqliteDB)
+        storage.db.load_addresses('standard')
+        self.assertEqual({'addr0': 'label'}, storage.get('labels'))
+        self.assertEqual(['addr0'], storage.db.get_txi(TXID))
+        self.assertEqual(['addr0'], storage.db.get_receiving_addresses())
+        with self.assertRaises(WalletFileException):
+            storage.set_password('secret', enc_version=STO_EV_USER_PW)
+
+    def test_convert_json_wallet(self):
+        json_path = os.path.join(self.user_dir, 'wallet.json')
+        storage = WalletStorage(json_path)
+        fill(storage.db)
+        storage.write()
+        storage = WalletStorage(json_path, manual_upgrades=True)
+        convert_json_wallet(storage, self.path)
+        with self.assertRaises(WalletFileException):
+            convert_json_wallet(storage, self.path)
+        converted = WalletStorage(self.path, manual_upgrades=True)
+        converted.db.load_addresses('standard')
+        storage.db.load_addresses('standard')
+        self.assertEqual(read(storage.db), read(converted.db))
+        # the getters return the same types, not just equal contents
+        for name, getter, args in (('txi_addr', 'get_txi_addr', (TXID, 'addr0')),
+                                   ('txo_addr', 'get_txo_addr', (TXID, 'addr1'))):
+            expected = getattr(storage.db, getter)(*args)
+            result = getattr(converted.db, getter)(*args)
+            self.assertEqual(expected, result, name)
+            self.assertIs(type(expected), type(result), name)
+            self.assertEqual([type(x) for x in expected], [type(x) for x in result], name)
+        def normalize(db):
+            # sets are dumped in no particular order
+            d = json.loads(db.dump())
+            for name in ('txi', 'txo'):
+                for tx in d[name].values():
+                    for addr in tx:
+                        tx[addr] = sorted(tx[addr])
+            return d
+        self.assertEqual(normalize(storage.db), normalize(converted.db))
@@ -0,0 +1,237 @@
+import os
+import shutil
+import asyncio
+import logging
+import tempfile
+from unittest import mock
+
+from aiorpcx.jsonrpc import RPCError
+
+from zephyr_code import synchronizer
+from zephyr_code.synchronizer import Synchronizer, Notifier
+from zephyr_code.network import Network, UntrustedServerReturnedError
+from zephyr_code.transaction import Transaction
+
+from zephyr_code.tests.cases import SequentialTestCase
+
+
+# spends output 0 of 3140eb24b43386f35ba69e3875eb6c93130ac66201d01c58f598defc949a5c2a
+SIGNED_TX = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+SIGNED_TXID = Transaction(SIGNED_TX).txid()
+PARENT_TXID = '3140eb24b43386f35ba69e3875eb6c93130ac66201d01c58f598defc949a5c2a'
+
+
+class MockDB:
+    def __init__(self, spent):
+        self.spent = spent
+    def get_transaction(self, tx_hash):
+        return None
+    def get_spent_outpoints(self, tx_hash):
+        return ['0'] if tx_hash in self.spent else []
+
+
+class MockNetwork:
+    def __init__(self):
+        self.config = {'tx_batch_size': 2}
+        self.batches = []
+        self.responses = {}
+    async def get_transactions(self, tx_hashes):
+        self.batches.append(list(tx_hashes))
+        if len(self.batches) > 1:
+            await asyncio.Future()  # only answer the first batch
+        return [self.responses[tx_hash] for tx_hash in tx_hashes]
+    def trigger_callback(self, event, *args):
+        pass
+
+
+class MockWallet:
+    def __init__(self, spent=()):
+        self.db = MockDB(spent)
+        self.network = MockNetwork()
+        self.received = []
+    def receive_tx_callback(self, tx_hash, tx, tx_height):
+        self.received.append((tx_hash, tx_height))
+
+
+class TestTxFetchPipeline(SequentialTestCase):
+
+    def _make_synchronizer(self, wallet):
+        synchronizer = Synchronizer.__new__(Synchronizer)
+        synchronizer.logger = logging.getLogger(__name__)
+        synchronizer.wallet = wallet
+        synchronizer.network = wallet.network
+        synchronizer._reset()
+        return synchronizer
+
+    def _request(self, synchronizer, hist, **kwargs):
+        asyncio.get_event_loop().run_until_complete(
+            synchronizer._request_missing_txs(hist, **kwargs))
+
+    def test_parents_are_fetched_first(self):
+        s = self._make_synchronizer(MockWallet(spent={'cc'}))
+        self._request(s, [('aa', 1), ('bb', 2), ('cc', 3), ('aa', 1)])
+        self.assertEqual({'aa': 1, 'bb': 2, 'cc': 3}, s.requested_tx)
+        # a tx we received spends from 'bb'
+        s._prioritize_tx('bb')
+        self.assertEqual(['cc', 'bb'], s._take_tx_batch())
+        self.assertEqual(['aa'], s._take_tx_batch())
+        self.assertFalse(s._txs_queued.is_set())
+        self.assertEqual([], s._take_tx_batch())
+
+    def test_fetch_batch(self):
+        wallet = MockWallet()
+        s = self._make_synchronizer(wallet)
+        not_found = UntrustedServerReturnedError(original_exception=RPCError(2, 'not found'))
+        wallet.network.responses = {SIGNED_TXID: SIGNED_TX, 'dd': not_found}
+        self._request(s, [('dd', 4), (SIGNED_TXID, 5)], allow_server_not_finding_tx=True)
+        self._request(s, [('ee', 6), (PARENT_TXID, 3)])
+        async def fetch():
+            task = asyncio.ensure_future(s._fetch_txs())
+            while len(wallet.network.batches) < 2:
+                await asyncio.sleep(0.01)
+            task.cancel()
+        asyncio.get_event_loop().run_until_complete(fetch())
+        self.assertEqual([(SIGNED_TXID, 5)], wallet.received)
+        self.assertEqual(4, s._requests_sent)
+        # the parent of the received tx went ahead of 'ee'
+        self.assertEqual([['dd', SIGNED_TXID], [PARENT_TXID, 'ee']], wallet.network.batches)
+        self.assertEqual({PARENT_TXID: 3, 'ee': 6}, s.requested_tx)
+
+
+class MockConfig(dict):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+
+class MockNotifierNetwork:
+    def __init__(self, path):
+        self.asyncio_loop = asyncio.get_event_loop()
+        self.config = MockConfig(path)
+        self.interface = None
+        self.proxy = None
+    def register_callback(self, callback, events):
+        pass
+    def unregister_callback(self, callback):
+        pass
+
+
+class TestNotifier(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self._retry_delay = synchronizer.NOTIFIER_RETRY_DELAY
+        synchronizer.NOTIFIER_RETRY_DELAY = 0
+
+    def tearDown(self):
+        synchronizer.NOTIFIER_RETRY_DELAY = self._retry_delay
+        shutil.rmtree(self.data_dir)
+        super().tearDown()
+
+    def _run(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def _make_notifier(self, responses=()):
+        notifier = Notifier(MockNotifierNetwork(self.data_dir))
+        notifier.posted = []
+        responses = list(responses)
+        async def post(url, data):
+            notifier.posted.append((url, data['address'], data['status']))
+            await asyncio.sleep(0)
+            return responses.pop(0) if responses else True
+        notifier._post = post
+        return notifier
+
+    def test_registry_survives_restart(self):
+        addr = 'DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh'
+        notifier = self._make_notifier()
+        self.assertTrue(notifier._watch(addr, 'http://a'))
+        self.assertTrue(notifier._watch(addr, 'http://b'))
+        self.assertTrue(notifier._watch(addr, 'http://a'))
+        self._run(notifier.stop())
+        notifier = self._make_notifier()
+        self.assertEqual({addr: ['http://a', 'http://b']}, notifier.watched_addresses)
+        self.assertFalse(notifier._watch(addr, ''))
+        notifier.save_registry()
+        self.assertEqual({}, Notifier._read_registry(os.path.join(self.data_dir, 'notifications')))
+
+    def test_deliveries_are_coalesced_and_retried(self):
+        addr = 'DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh'
+        notifier = self._make_notifier(responses=[False, True, True])
+        notifier._watch(addr, 'http://a')
+        async def notify():
+            await notifier._on_address_status(addr, 'status1')
+            await notifier._on_address_status(addr, 'status2')
+            await notifier._on_address_status(addr, 'status3')
+            await asyncio.gather(*notifier._delivery_tasks)
+        self._run(notify())
+        # one delivery of the latest status, retried after the failed first attempt
+        self.assertEqual([('http://a', addr, 'status3')] * 2, notifier.posted)
+        self.assertEqual({'delivered': 1, 'retried': 1, 'failed': 0, 'coalesced': 2, 'unchanged': 0,
+                          'pending': 0, 'watched_addresses': 1}, notifier.get_metrics())
+        # connection slots are not kept for idle hosts
+        self.assertEqual({}, notifier._host_slots)
+
+    def test_delivery_gives_up(self):
+        addr = 'DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh'
+        notifier = self._make_notifier(responses=[False] * 10)
+        notifier._watch(addr, 'http://a')
+        async def notify():
+            await notifier._on_address_status(addr, 'status1')
+            await asyncio.gather(*notifier._delivery_tasks)
+        self._run(notify())
+        self.assertEqual(notifier.max_attempts, len(notifier.posted))
+        metrics = notifier.get_metrics()
+        self.assertEqual((0, 1, 0), (metrics['delivered'], metrics['failed'], metrics['pending']))
+
+    def test_unchanged_status_is_not_delivered_again(self):
+        addr = 'DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh'
+        notifier = self._make_notifier()
+        notifier._watch(addr, 'http://a')
+        async def notify(notifier, status):
+            await notifier._on_address_status(addr, status)
+            await asyncio.gather(*notifier._delivery_tasks)
+        self._run(notify(notifier, 'status1'))
+        self._run(notify(notifier, 'status1'))
+        self.assertEqual([('http://a', addr, 'status1')], notifier.posted)
+        self._run(notifier.stop())
+        # the server sends the same status again when we subscribe after a restart
+        notifier = self._make_notifier()
+        notifier._watch(addr, 'http://b')
+        self._run(notify(notifier, 'status1'))
+        self.assertEqual([('http://b', addr, 'status1')], notifier.posted)
+        self.assertEqual(1, notifier.get_metrics()['unchanged'])
+        self._run(notify(notifier, 'status2'))
+        self.assertEqual(3, len(notifier.posted))
+        # unwatching forgets the delivered statuses
+        notifier._watch(addr, '')
+        notifier._watch(addr, 'http://a')
+        self._run(notify(notifier, 'status2'))
+        self.assertEqual(('http://a', addr, 'status2'), notifier.posted[-1])
+
+    def test_network_start_resumes_watching(self):
+        network = mock.Mock(config=MockConfig(self.data_dir))
+        with mock.patch.object(asyncio, 'run_coroutine_threadsafe'):
+            Network.start(network)
+        network.get_notifier.assert_not_called()
+        notifier = self._make_notifier()
+        notifier._watch('DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh', 'http://a')
+        notifier.save_registry()
+        with mock.patch.object(asyncio, 'run_coroutine_threadsafe'):
+            Network.start(network)
+        network.get_notifier.assert_called_once_with()
+
+    def test_network_stop_stops_notifier(self):
+        network = mock.Mock()
+        async def noop():
+            pass
+        network.main_taskgroup.cancel_remaining = noop
+        network._notifier = notifier = self._make_notifier()
+        notifier._watch('DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh', 'http://a')
+        notifier._http_session = session = mock.Mock(close=mock.Mock(side_effect=noop))
+        with mock.patch.multiple('zephyr_code.blockchain', sync_headers_files=mock.DEFAULT,
+                                 write_fork_manifest=mock.DEFAULT, shutdown_pow_executor=mock.DEFAULT):
+            self._run(Network._stop(network, full_shutdown=True))
+        session.close.assert_called_once_with()
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir, 'notifications')))
@@ -1,7 +1,7 @@
 from decimal import Decimal
 
 from zephyr_code.util import (format_satoshis, format_fee_satoshis, parse_URI,
-                                is_hash256_str)
+                                is_hash256_str, LRUCache)
 
 from zephyr_code.tests.cases import SequentialTestCase
 
@@ -104,3 +104,13 @@ class TestUtil(SequentialTestCase):
         self.assertFalse(is_hash256_str('qweqwe'))
         self.assertFalse(is_hash256_str(None))
         self.assertFalse(is_hash256_str(7))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3  # evicts 'b', the least recently used
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(['a', 'c'], list(cache.keys()))
+        self.assertEqual((1, 1, 2, 2), cache.cache_info())
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import random
+from unittest import mock
+
+from aiorpcx.jsonrpc import RPCError, JSONRPC, ProtocolError
+
+from zephyr_code import verifier
+from zephyr_code.verifier import SPV, InnerNodeOfSpvProofIsValidTx, _has_tx_structure
+from zephyr_code.transaction import deserialize
+from zephyr_code.crypto import sha256d
+from zephyr_code.util import bh2u
+from zephyr_code.network import UntrustedServerReturnedError
+from zephyr_code.interface import GracefulDisconnect, RequestTimedOut
+
+from zephyr_code.tests.cases import SequentialTestCase
+
+
+class MockChain:
+    def __init__(self, height):
+        self._height = height
+    def height(self):
+        return self._height
+    def read_header(self, height):
+        return {'block_height': height} if height <= self._height else None
+
+
+class MockWallet:
+    def __init__(self, unverified):
+        self.unverified = unverified
+    def get_unverified_tx_height(self, tx_hash):
+        return self.unverified.get(tx_hash)
+    def remove_unverified_tx(self, tx_hash, tx_height):
+        if self.unverified.get(tx_hash) == tx_height:
+            self.unverified.pop(tx_hash)
+
+
+class MockNetwork:
+    asyncio_loop = asyncio.get_event_loop()
+
+    def __init__(self):
+        self.config = {'merkle_batch_size': 2}
+        self.batches = []
+        self.responses = []
+        self.chunks = []
+        self.chunk_response = None
+
+    async def request_chunk(self, height, tip=None, *, can_return_early=False):
+        self.chunks.append(height)
+        return self.chunk_response
+
+    async def get_merkles_for_transactions(self, txs):
+        self.batches.append(list(txs))
+        return self.responses.pop(0)
+
+
+class TestSPVQueue(SequentialTestCase):
+
+    def _make_spv(self, unverified, local_height):
+        spv = SPV.__new__(SPV)
+        spv.network = MockNetwork()
+        spv.wallet = MockWallet(unverified)
+        spv.logger = logging.getLogger(__name__)
+        spv.requested = []
+        spv._reset()
+        spv.blockchain = MockChain(local_height)
+        async def verify_proof(tx_hash, tx_height, merkle):
+            spv.requested_merkle.discard(tx_hash)
+            spv.requested.append((tx_hash, merkle))
+        spv._verify_proof = verify_proof
+        for tx_hash, tx_height in unverified.items():
+            spv._add_pending_tx(tx_hash, tx_height)
+        return spv
+
+    def _request_proofs(self, spv):
+        asyncio.get_event_loop().run_until_complete(spv._request_proofs())
+
+    def _queued_proofs(self, spv):
+        return [(tx_hash, tx_height) for tx_height, tx_hash in sorted(spv._proof_queue)]
+
+    def test_proofs_queued_lowest_height_first(self):
+        spv = self._make_spv({'c': 30, 'a': 10, 'b': 20, 'future': 100}, local_height=50)
+        self.assertTrue(spv._wakeup.is_set())
+        self._request_proofs(spv)
+        self.assertEqual(['a', 'b', 'c'], sorted(spv.requested_merkle))
+        self.assertTrue(spv._proofs_queued.is_set())
+        self.assertEqual([('a', 10), ('b', 20)], spv._take_proof_batch())
+        # 'future' waits for its header
+        self.assertEqual([(100, 'future')], spv._pending)
+        # a repeated notification does not request the proof again
+        spv._add_pending_tx('a', 10)
+        self._request_proofs(spv)
+        self.assertEqual([('c', 30)], spv._take_proof_batch())
+        self.assertFalse(spv._proofs_queued.is_set())
+        # in flight entries are kept until their request resolves
+        self.assertEqual([(10, 'a'), (100, 'future')], sorted(spv._pending))
+        spv.requested_merkle.clear()
+        spv.merkle_roots['a'] = 'root'
+        self._request_proofs(spv)
+        self.assertEqual([(100, 'future')], spv._pending)
+
+    def test_stale_entries_are_skipped(self):
+        spv = self._make_spv({'a': 10, 'b': 20}, local_height=50)
+        spv.wallet.unverified['a'] = 15  # mined again at another height
+        spv._add_pending_tx('a', 15)
+        del spv.wallet.unverified['b']  # no longer unverified
+        self._request_proofs(spv)
+        self.assertEqual([('a', 15)], self._queued_proofs(spv))
+        self.assertEqual([], spv._pending)
+
+    @mock.patch.object(verifier, 'MERKLE_RETRY_DELAY', 0)
+    def test_batched_fetch_with_retry(self):
+        spv = self._make_spv({'a': 10, 'b': 20, 'c': 30}, local_height=50)
+        self._request_proofs(spv)
+        busy = UntrustedServerReturnedError(original_exception=RPCError(JSONRPC.SERVER_BUSY, 'busy'))
+        not_found = UntrustedServerReturnedError(original_exception=RPCError(1, 'not in block'))
+        spv.network.responses = [
+            [{'merkle': 'a'}, busy],
+            [{'merkle': 'b'}, not_found],
+        ]
+        async def fetch():
+            task = asyncio.ensure_future(spv._fetch_proofs())
+            while spv.requested_merkle:
+                await asyncio.sleep(0)
+            task.cancel()
+        asyncio.get_event_loop().run_until_complete(fetch())
+        # the retried request goes back in height order
+        self.assertEqual([[('a', 10), ('b', 20)], [('b', 20), ('c', 30)]], spv.network.batches)
+        self.assertEqual([('a', {'merkle': 'a'}), ('b', {'merkle': 'b'})], spv.requested)
+        self.assertNotIn('c', spv.wallet.unverified)
+
+    def test_in_flight_tx_mined_again_is_requested_after_not_found(self):
+        spv = self._make_spv({'a': 10}, local_height=50)
+        self._request_proofs(spv)
+        self.assertEqual([('a', 10)], spv._take_proof_batch())
+        # reorged to another height while the proof is being requested
+        spv.wallet.unverified['a'] = 15
+        spv._add_pending_tx('a', 15)
+        self._request_proofs(spv)
+        self.assertEqual([], self._queued_proofs(spv))
+        not_found = UntrustedServerReturnedError(original_exception=RPCError(1, 'not in block'))
+        spv.network.responses = [[not_found]]
+        spv._queue_proof('a', 10)
+        spv._wakeup.clear()
+        async def fetch():
+            task = asyncio.ensure_future(spv._fetch_proofs())
+            while spv.requested_merkle:
+                await asyncio.sleep(0)
+            task.cancel()
+        asyncio.get_event_loop().run_until_complete(fetch())
+        self.assertEqual({'a': 15}, spv.wallet.unverified)
+        self.assertTrue(spv._wakeup.is_set())
+        self._request_proofs(spv)
+        self.assertEqual([('a', 15)], self._queued_proofs(spv))
+
+    def test_missing_header_requests_chunk_once(self):
+        spv = self._make_spv({'a': 100, 'b': 101}, local_height=200)
+        spv.blockchain.read_header = lambda height: None
+        spv.group = mock.Mock()
+        spv.group.spawn = lambda coro: asyncio.ensure_future(coro)
+        async def request():
+            await spv._request_proofs()
+            await asyncio.sleep(0)
+        with mock.patch.object(verifier.constants.net, 'max_checkpoint', lambda: 10000):
+            spv._wakeup.clear()
+            asyncio.get_event_loop().run_until_complete(request())
+            self.assertEqual([0], spv.network.chunks)
+            self.assertEqual([(100, 'a'), (101, 'b')], sorted(spv._pending))
+            # already being downloaded: do not wake up to request it again
+            self.assertFalse(spv._wakeup.is_set())
+            spv.network.chunk_response = (True, 2016)
+            asyncio.get_event_loop().run_until_complete(request())
+            self.assertTrue(spv._wakeup.is_set())
+
+    def _fetch_until_error(self, spv):
+        with self.assertRaises(GracefulDisconnect):
+            asyncio.get_event_loop().run_until_complete(spv._fetch_proofs())
+
+    @mock.patch.object(verifier, 'MERKLE_RETRY_DELAY', 0)
+    @mock.patch.object(verifier, 'MERKLE_MAX_RETRIES', 2)
+    def test_retries_are_capped(self):
+        spv = self._make_spv({'a': 10}, local_height=50)
+        self._request_proofs(spv)
+        busy = UntrustedServerReturnedError(original_exception=RPCError(JSONRPC.SERVER_BUSY, 'busy'))
+        spv.network.responses = [[busy], [RequestTimedOut()], [busy]]
+        self._fetch_until_error(spv)
+        self.assertEqual(3, len(spv.network.batches))
+        self.assertEqual([], spv.requested)
+
+    def test_non_retryable_error_disconnects(self):
+        spv = self._make_spv({'a': 10}, local_height=50)
+        self._request_proofs(spv)
+        spv.network.responses = [[ProtocolError(0, 'bad response')]]
+        self._fetch_until_error(spv)
+        self.assertEqual(1, len(spv.network.batches))
+
+
+# 64 byte serializations the tx parser accepts
+TX_ONE_INPUT_NO_OUTPUTS = (bytes(4) + b'\x01' + bytes(36) + b'\x0d' + bytes(13) + bytes(4)
+                           + b'\x00' + bytes(4))
+TX_NO_INPUTS_SIX_OUTPUTS = bytes(4) + b'\x00' + b'\x06' + bytes(9 * 6) + bytes(4)
+
+
+class TestInnerNodeCheck(SequentialTestCase):
+
+    def _parses(self, raw):
+        try:
+            deserialize(bh2u(raw))
+        except Exception:
+            return False
+        return True
+
+    def test_inner_node_that_is_a_tx_is_rejected(self):
+        for raw in (TX_ONE_INPUT_NO_OUTPUTS, TX_NO_INPUTS_SIX_OUTPUTS):
+            self.assertEqual(64, len(raw))
+            self.assertTrue(_has_tx_structure(raw))
+            with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+                SPV._raise_if_valid_tx(raw)
+            with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+                SPV._raise_if_valid_tx(bh2u(raw))
+
+    def test_precheck_never_rejects_a_tx(self):
+        rnd = random.Random(42)
+        candidates = [TX_ONE_INPUT_NO_OUTPUTS, TX_NO_INPUTS_SIX_OUTPUTS]
+        for i in range(3000):
+            raw = bytearray(rnd.choice(candidates))
+            for j in range(rnd.randint(1, 3)):
+                raw[rnd.choice([4, 5, 41, 42, 46, 55, 59, rnd.randrange(64)])] = rnd.choice(
+                    [0, 1, 2, 6, 12, 13, 14, 0xfd, 0xfe, 0xff, rnd.randrange(256)])
+            candidates.append(bytes(raw))
+        candidates += [rnd.getrandbits(512).to_bytes(64, 'little') for i in range(3000)]
+        num_txs = 0
+        for raw in candidates:
+            parses = self._parses(raw)
+            num_txs += parses
+            if parses:
+                self.assertTrue(_has_tx_structure(raw), raw.hex())
+        self.assertGreater(num_txs, 20)
+
+    def test_hash_merkle_root(self):
+        tx_hash = '11' * 32
+        branch = ['22' * 32, '33' * 32]
+        root = SPV.hash_merkle_root(branch, tx_hash, 2)
+        h = bytes.fromhex(tx_hash)[::-1]
+        h = sha256d(h + bytes.fromhex(branch[0])[::-1])
+        h = sha256d(bytes.fromhex(branch[1])[::-1] + h)
+        self.assertEqual(h[::-1].hex(), root)
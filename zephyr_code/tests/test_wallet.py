@@ -5,17 +5,22 @@ import os
 import json
 from decimal import Decimal
 import time
+import tracemalloc
+import threading
+from unittest import mock
 
 from io import StringIO
-from zephyr_code.storage import WalletStorage
+from zephyr_code.storage import WalletStorage, STO_EV_USER_PW
 from zephyr_code.json_db import FINAL_SEED_VERSION
 from zephyr_code.wallet import (Abstract_Wallet, Standard_Wallet,
                                   create_new_wallet,
                                   restore_wallet_from_text, Imported_Wallet)
 from zephyr_code.exchange_rate import ExchangeBase, FxThread
-from zephyr_code.util import TxMinedInfo
-from zephyr_code.bitcoin import COIN
+from zephyr_code.util import TxMinedInfo, history_status
+from zephyr_code.bitcoin import COIN, serialize_privkey
+from zephyr_code import constants, keystore
 from zephyr_code.json_db import JsonDB
+from zephyr_code.transaction import Transaction
 
 from zephyr_code.tests.cases import SequentialTestCase
 
@@ -50,6 +55,9 @@ class WalletTestCase(SequentialTestCase):
 
 class TestWalletStorage(WalletTestCase):
 
+    PRIVKEYS = ['p2pkh:YNimAB1DHy2UrRN2ce8yNVaBHRpU7gjnqY2ogcGjFMMrdWJja5Rb',
+                serialize_privkey(bytes([1] * 32), True, 'p2pkh')]
+
     def test_read_dictionary_from_file(self):
 
         some_dict = {"a":"b", "c":"d"}
@@ -80,6 +88,110 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def _new_incremental_storage(self):
+        storage = WalletStorage(self.wallet_path, incremental=True)
+        storage.db.load_addresses('standard')
+        storage.put('wallet_type', 'standard')
+        storage.db.add_receiving_address('addr0')
+        storage.write()
+        return storage
+
+    def _reload(self, password=None):
+        storage = WalletStorage(self.wallet_path, manual_upgrades=True, incremental=True)
+        if password:
+            storage.decrypt(password)
+        storage.db.load_addresses('standard')
+        return storage
+
+    def test_incremental_write_appends_changes(self):
+        storage = self._new_incremental_storage()
+        size = os.path.getsize(self.wallet_path)
+        storage.put('labels', {'addr0': 'first'})
+        storage.db.add_receiving_address('addr1')
+        storage.db.set_addr_history('addr1', [('aa' * 32, 10)])
+        storage.db.update_tx_fees({'aa' * 32: 100})
+        storage.write()
+        storage.db.remove_addr_history('addr1')
+        storage.db.add_verified_tx('bb' * 32, TxMinedInfo(height=5, timestamp=1, txpos=2, header_hash='cc'))
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual(2, contents.count('\n@'))
+        self.assertTrue(os.path.getsize(self.wallet_path) - size < 1000)
+        db = self._reload().db
+        self.assertEqual({'addr0': 'first'}, db.get('labels'))
+        self.assertEqual(['addr0', 'addr1'], db.get_receiving_addresses())
+        self.assertFalse(db.is_addr_in_history('addr1'))
+        self.assertEqual(100, db.get_tx_fee('aa' * 32))
+        self.assertEqual(5, db.get_verified_tx('bb' * 32).height)
+        self.assertEqual(['bb' * 32], db.list_verified_tx_above_height(4))
+
+    def test_incremental_write_of_value_sharing_a_modified_container(self):
+        # as an imported keystore does: keypairs is modified in place,
+        # and put back in a new dict
+        storage = self._new_incremental_storage()
+        keystore = {'type': 'imported', 'keypairs': {'pubkey0': 'privkey0'}, 'pw_hash_version': 1}
+        storage.put('keystore', keystore)
+        storage.write()
+        keystore['keypairs']['pubkey1'] = 'privkey1'
+        storage.put('keystore', dict(keystore))
+        storage.write()
+        self.assertEqual({'pubkey0': 'privkey0', 'pubkey1': 'privkey1'},
+                         self._reload().get('keystore')['keypairs'])
+
+    def test_incremental_write_of_imported_private_key(self):
+        restore_wallet_from_text(self.PRIVKEYS[0], path=self.wallet_path, network=None)
+        storage = WalletStorage(self.wallet_path, incremental=True)
+        wallet = Imported_Wallet(storage)
+        addr = wallet.import_private_key(self.PRIVKEYS[1], None)
+        wallet.stop_threads()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual(1, f.read().count('\n@'))
+        wallet = Imported_Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual(2, len(wallet.keystore.keypairs))
+        self.assertEqual(self.PRIVKEYS[1], wallet.export_private_key(addr, None)[0])
+        wallet.stop_threads()
+
+    def test_incremental_write_ignores_torn_record(self):
+        storage = self._new_incremental_storage()
+        storage.put('a', 'b')
+        storage.write()
+        with open(self.wallet_path, "a") as f:
+            f.write('\n@[["set", ["a"], "c')
+        storage = self._reload()
+        self.assertEqual('b', storage.get('a'))
+        # the next write replaces the damaged file
+        storage.put('d', 'e')
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            self.assertEqual({'a': 'b', 'd': 'e'}, {k: v for k, v in json.loads(f.read()).items() if k in 'ad'})
+
+    def test_incremental_write_encrypted(self):
+        storage = self._new_incremental_storage()
+        storage.set_password('secret', enc_version=STO_EV_USER_PW)
+        storage.write()
+        storage.put('a', 'b')
+        storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        self.assertEqual(1, contents.count('\n@'))
+        self.assertNotIn('"a"', contents)
+        storage = self._reload(password='secret')
+        self.assertEqual('b', storage.get('a'))
+        self.assertEqual(['addr0'], storage.db.get_receiving_addresses())
+
+    def test_incremental_write_compacts_log(self):
+        storage = self._new_incremental_storage()
+        with mock.patch('zephyr_code.storage.LOG_MIN_COMPACTION_SIZE', 0):
+            for i in range(50):
+                storage.put('label', 'x' * 100 + str(i))
+                storage.write()
+        with open(self.wallet_path, "r") as f:
+            contents = f.read()
+        # the log never grows past the size of the snapshot
+        self.assertLess(contents.count('\n@'), 50)
+        self.assertEqual('x' * 100 + '49', self._reload().get('label'))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -96,9 +208,8 @@ class FakeFxThread:
     history_rate = FxThread.history_rate
 
 class FakeWallet:
-    def __init__(self, fiat_value):
+    def __init__(self):
         super().__init__()
-        self.fiat_value = fiat_value
         self.db = JsonDB("{}", manual_upgrades=True)
         self.db.transactions = self.db.verified_tx = {'abc':'Tx'}
 
@@ -109,8 +220,7 @@ class FakeWallet:
 
     default_fiat_value = Abstract_Wallet.default_fiat_value
     price_at_timestamp = Abstract_Wallet.price_at_timestamp
-    class storage:
-        put = lambda self, x: None
+    fiat_value = Abstract_Wallet.fiat_value
 
 txid = 'abc'
 ccy = 'TEST'
@@ -119,13 +229,16 @@ class TestFiat(SequentialTestCase):
     def setUp(self):
         super().setUp()
         self.value_sat = COIN
-        self.fiat_value = {}
-        self.wallet = FakeWallet(fiat_value=self.fiat_value)
+        self.wallet = FakeWallet()
         self.fx = FakeFxThread(FakeExchange(Decimal('1000.001')))
         default_fiat = Abstract_Wallet.default_fiat_value(self.wallet, txid, self.fx, self.value_sat)
         self.assertEqual(Decimal('1000.001'), default_fiat)
         self.assertEqual('1,000.00', self.fx.ccy_amount_str(default_fiat, commas=True))
 
+    @property
+    def fiat_value(self):
+        return self.wallet.fiat_value
+
     def test_save_fiat_and_reset(self):
         self.assertEqual(False, Abstract_Wallet.set_fiat_value(self.wallet, txid, ccy, '1000.01', self.fx, self.value_sat))
         saved = self.fiat_value[ccy][txid]
@@ -147,6 +260,325 @@ class TestFiat(SequentialTestCase):
         self.assertNotIn(ccy, self.fiat_value)
 
 
+class FakeHistoryWallet:
+    def __init__(self, history, heights_at_timestamps):
+        self.history = history
+        self.network = None
+        if heights_at_timestamps is not None:
+            chain = mock.Mock()
+            chain.get_height_at_timestamp.side_effect = lambda ts: heights_at_timestamps[ts]
+            self.network = mock.Mock()
+            self.network.blockchain.return_value = chain
+
+    def get_history(self, domain):
+        return self.history
+
+    _get_height_at_timestamp = Abstract_Wallet._get_height_at_timestamp
+    balance_at_timestamp = Abstract_Wallet.balance_at_timestamp
+
+
+class TestBalanceAtTimestamp(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        h = constants.net.max_checkpoint() + 100
+        # b is mined but not verified yet, so its timestamp is not known
+        self.history = [
+            ('a', TxMinedInfo(height=h, timestamp=2000), 10, 10),
+            ('b', TxMinedInfo(height=h + 1, timestamp=None), 5, 15),
+            ('c', TxMinedInfo(height=h + 2, timestamp=3000), 1, 16),
+            ('d', TxMinedInfo(height=0), 2, 18),
+        ]
+        # first heights with a timestamp >= 1801 and >= 3001, as the chain knows
+        self.heights = {1801: h, 3001: h + 3}
+
+    def test_uses_heights_of_the_local_chain(self):
+        wallet = FakeHistoryWallet(self.history, self.heights)
+        self.assertEqual(0, wallet.balance_at_timestamp(None, 1800))
+        self.assertEqual(16, wallet.balance_at_timestamp(None, 3000))
+
+    def test_falls_back_to_tx_timestamps_when_offline(self):
+        wallet = FakeHistoryWallet(self.history, None)
+        self.assertEqual(0, wallet.balance_at_timestamp(None, 1800))
+        self.assertEqual(10, wallet.balance_at_timestamp(None, 3000))
+
+    def test_falls_back_to_tx_timestamps_in_checkpoint_region(self):
+        wallet = FakeHistoryWallet(self.history, {1801: constants.net.max_checkpoint(), 3001: 1})
+        self.assertEqual(0, wallet.balance_at_timestamp(None, 1800))
+        self.assertEqual(10, wallet.balance_at_timestamp(None, 3000))
+
+
+class TestVerifiedTxIndex(SequentialTestCase):
+
+    def _info(self, height):
+        return TxMinedInfo(height=height, timestamp=0, txpos=0, header_hash='00' * 32)
+
+    def test_list_verified_tx_above_height(self):
+        db = JsonDB('', manual_upgrades=False)
+        for txid, height in (('c', 30), ('a', 10), ('b', 20), ('d', 20)):
+            db.add_verified_tx(txid, self._info(height))
+        self.assertEqual(['b', 'd', 'c'], db.list_verified_tx_above_height(10))
+        self.assertEqual([], db.list_verified_tx_above_height(30))
+        # re-verified at another height
+        db.add_verified_tx('c', self._info(5))
+        db.remove_verified_tx('b')
+        db.remove_verified_tx('unknown')
+        self.assertEqual(['c', 'a', 'd'], db.list_verified_tx_above_height(0))
+        # rebuilt when the db is loaded
+        db2 = JsonDB(db.dump(), manual_upgrades=False)
+        db2.load_transactions()
+        self.assertEqual(['a', 'd'], db2.list_verified_tx_above_height(5))
+        db2.clear_history()
+        self.assertEqual([], db2.list_verified_tx_above_height(0))
+
+
+class TestJsonDBGetPut(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = JsonDB('', manual_upgrades=False)
+        self.labels = {'%064x' % i: 'label %d' % i for i in range(1000)}
+        self.db.put('labels', self.labels)
+
+    def _peak_allocated(self, func, times=100):
+        tracemalloc.start()
+        try:
+            for i in range(times):
+                func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_get_does_not_copy(self):
+        self.assertIs(self.labels, self.db.get('labels'))
+        # a copy of the labels dict alone would take more than 30 kB
+        self.assertLess(self._peak_allocated(lambda: self.db.get('labels')), 5000)
+
+    def test_put_back_modified_value(self):
+        labels = self.db.get('labels')
+        labels['new'] = 'label'
+        self.db.dump_changes()
+        self.assertLess(self._peak_allocated(lambda: self.db.put('labels', labels)), 5000)
+        self.assertIn('"new"', self.db.dump_changes())
+        self.assertEqual('label', JsonDB(self.db.dump(), manual_upgrades=False).get('labels')['new'])
+
+    def test_put_records_changed_entries_of_dicts(self):
+        snapshot = self.db.dump()
+        self.db.dump_changes()
+        labels = dict(self.labels)
+        labels['new'] = 'label'
+        labels['%064x' % 1] = 'changed'
+        del labels['%064x' % 2]
+        self.assertTrue(self.db.put('labels', labels))
+        changes = json.loads(self.db.dump_changes())
+        self.assertEqual([["set", ["labels", '%064x' % 1], 'changed'],
+                          ["remove", ["labels", '%064x' % 2]],
+                          ["set", ["labels", "new"], "label"]], changes)
+        db = JsonDB(snapshot, manual_upgrades=False, log=[changes])
+        self.assertEqual(labels, db.get('labels'))
+        # putting an equal dict changes nothing
+        self.assertFalse(self.db.put('labels', dict(labels)))
+        self.assertEqual('[]', self.db.dump_changes())
+        # mostly new contents are recorded as a whole
+        self.assertTrue(self.db.put('labels', {'a': 'b'}))
+        self.assertEqual([["set", ["labels"], {'a': 'b'}]], json.loads(self.db.dump_changes()))
+
+    def test_put_rejects_unserializable_value(self):
+        self.assertFalse(self.db.put('labels', {'a': object()}))
+        self.assertIs(self.labels, self.db.get('labels'))
+        self.assertTrue(self.db.put('stored_height', 10))
+        self.assertFalse(self.db.put('stored_height', 10))
+
+    def test_put_item(self):
+        self.assertTrue(self.db.put_item(('labels', 'new'), 'label'))
+        self.assertFalse(self.db.put_item(('labels', 'new'), 'label'))
+        self.assertEqual('label', self.labels['new'])
+        self.assertTrue(self.db.put_item(('labels', 'new'), None))
+        self.assertFalse(self.db.put_item(('labels', 'new'), None))
+        self.assertNotIn('new', self.labels)
+        # dicts on the way are created when setting, not when removing
+        self.assertFalse(self.db.put_item(('fiat_value', 'EUR', 'txid'), None))
+        self.assertIsNone(self.db.get('fiat_value'))
+        self.assertTrue(self.db.put_item(('fiat_value', 'EUR', 'txid'), '1.00'))
+        self.assertEqual({'EUR': {'txid': '1.00'}}, self.db.get('fiat_value'))
+        self.assertFalse(self.db.put_item(('labels', 'bad'), object()))
+        self.assertNotIn('bad', self.labels)
+        self.assertIsNotNone(self.db.dump_changes())
+        self.assertEqual({'EUR': {'txid': '1.00'}},
+                         JsonDB(self.db.dump(), manual_upgrades=False).get('fiat_value'))
+
+    def test_put_item_while_dumping(self):
+        def put_items():
+            for i in range(20000):
+                self.db.put_item(('labels', 'x%d' % i), 'label')
+                self.db.put_item(('labels', 'x%d' % (i // 2)), None)
+        thread = threading.Thread(target=put_items)
+        thread.start()
+        try:
+            while thread.is_alive():
+                self.db.dump()
+                for key in self.db.get_copy('labels'):
+                    pass
+        finally:
+            thread.join()
+
+
+class TestWalletDicts(SequentialTestCase):
+
+    def test_keystore_does_not_share_dicts_with_db(self):
+        db = JsonDB('', manual_upgrades=False)
+        db.put('keystore', keystore.Imported_KeyStore({}).dump())
+        k = keystore.load_keystore(db, 'keystore')
+        k.import_privkey(TestWalletStorage.PRIVKEYS[0], None)
+        # not in the db until saved
+        self.assertEqual({}, db.get('keystore')['keypairs'])
+        db.put('keystore', k.dump())
+        self.assertEqual(k.keypairs, db.get('keystore')['keypairs'])
+        self.assertIsNot(k.keypairs, db.get('keystore')['keypairs'])
+
+    class Wallet:
+        labels = Abstract_Wallet.labels
+        receive_requests = Abstract_Wallet.receive_requests
+        set_label = Abstract_Wallet.set_label
+        def __init__(self):
+            self.db = JsonDB('', manual_upgrades=False)
+
+    def test_labels(self):
+        wallet = self.Wallet()
+        self.assertEqual({}, dict(wallet.labels))
+        self.assertTrue(wallet.set_label('addr', 'a\nlabel'))
+        self.assertFalse(wallet.set_label('addr', 'a label'))
+        self.assertEqual({'addr': 'a label'}, dict(wallet.labels))
+        with self.assertRaises(TypeError):
+            wallet.labels['addr'] = 'changed'
+        self.assertTrue(wallet.set_label('addr', ''))
+        self.assertFalse(wallet.set_label('addr', None))
+        self.assertEqual({}, dict(wallet.labels))
+        self.assertEqual({}, wallet.db.get('labels'))
+
+
+class TestLazyTransactions(SequentialTestCase):
+
+    RAW_TX = '01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000'
+
+    def _load(self, data):
+        data.setdefault('seed_version', FINAL_SEED_VERSION)
+        db = JsonDB(json.dumps(data), manual_upgrades=False)
+        db.load_transactions()
+        return db
+
+    def test_transactions_are_built_on_demand(self):
+        db = self._load({'transactions': {'aa': self.RAW_TX, 'bb': self.RAW_TX},
+                         'txo': {'aa': {'addr': [[0, 1000, False]]}}})
+        self.assertEqual(bytes.fromhex(self.RAW_TX), db.transactions['aa'])
+        self.assertEqual([(0, 1000, False)], list(db.get_txo_addr('aa', 'addr')))
+        tx = db.get_transaction('aa')
+        self.assertEqual(self.RAW_TX, str(tx))
+        self.assertIs(tx, db.get_transaction('aa'))
+        self.assertIsNone(db.get_transaction('cc'))
+        # raw transactions are dumped as hex
+        self.assertEqual(self.RAW_TX, json.loads(db.dump())['transactions']['bb'])
+        self.assertIs(tx, db.remove_transaction('aa'))
+        self.assertIsNone(db.get_transaction('aa'))
+
+    def test_least_recently_used_transactions_are_evicted(self):
+        db = self._load({})
+        with mock.patch('zephyr_code.json_db.TRANSACTION_CACHE_SIZE', 2):
+            txs = {tx_hash: Transaction(self.RAW_TX) for tx_hash in ('aa', 'bb', 'cc')}
+            db.add_transaction('aa', txs['aa'])
+            db.add_transaction('bb', txs['bb'])
+            db.get_transaction('aa')
+            db.add_transaction('cc', txs['cc'])
+            self.assertIs(txs['aa'], db.get_transaction('aa'))
+            self.assertIs(txs['cc'], db.get_transaction('cc'))
+            tx = db.get_transaction('bb')
+            self.assertIsNot(txs['bb'], tx)
+            self.assertEqual(self.RAW_TX, str(tx))
+
+    def test_remove_unreferenced_data(self):
+        data = {'transactions': {'aa': self.RAW_TX, 'bb': self.RAW_TX},
+                'txi': {'aa': {'addr': [['cc:0', 1000]]}},
+                'spent_outpoints': {'cc': {'0': 'aa', '1': 'bb'}, 'dd': {'0': 'ee'}}}
+        db = self._load(dict(data))
+        db.get_transaction('bb')
+        snapshot = db.dump()
+        db.dump_changes()
+        db.set_modified(False)
+        with mock.patch('zephyr_code.json_db.CLEANUP_CHUNK_SIZE', 1):
+            db.remove_unreferenced_data(threading.RLock())
+        self.assertEqual(['aa'], db.list_transactions())
+        self.assertIsNone(db.get_transaction('bb'))
+        self.assertEqual([('cc', '0')], db.list_spent_outpoints())
+        self.assertNotIn('dd', db.get('spent_outpoints'))
+        # the removals are saved, also incrementally
+        self.assertTrue(db.modified())
+        changes = json.loads(db.dump_changes())
+        db2 = JsonDB(snapshot, manual_upgrades=False, log=[changes])
+        db2.load_transactions()
+        self.assertEqual(['aa'], db2.list_transactions())
+        self.assertEqual([('cc', '0')], db2.list_spent_outpoints())
+
+
+class TestCompactHistory(SequentialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.history = {
+            'txi': {'aa' * 32: {'addr': [['bb' * 32 + ':1', 1000], ['cc' * 32 + ':0', 2000]]}},
+            'txo': {'aa' * 32: {'addr': [[0, 2900, False]]}},
+            'spent_outpoints': {'bb' * 32: {'1': 'aa' * 32}, 'cc' * 32: {'0': 'aa' * 32}},
+        }
+        data = dict(self.history, seed_version=FINAL_SEED_VERSION)
+        self.db = JsonDB(json.dumps(data), manual_upgrades=False)
+
+    def test_accessors(self):
+        db = self.db
+        self.assertEqual({('bb' * 32 + ':1', 1000), ('cc' * 32 + ':0', 2000)},
+                         set(db.get_txi_addr('aa' * 32, 'addr')))
+        self.assertEqual([(0, 2900, False)], list(db.get_txo_addr('aa' * 32, 'addr')))
+        self.assertEqual([], list(db.get_txo_addr('aa' * 32, 'addr2')))
+        self.assertEqual('aa' * 32, db.get_spent_outpoint('bb' * 32, 1))
+        self.assertEqual('aa' * 32, db.get_spent_outpoint('bb' * 32, '1'))
+        self.assertEqual(['1'], db.get_spent_outpoints('bb' * 32))
+        db.remove_spent_outpoint('bb' * 32, 1)
+        self.assertEqual([('cc' * 32, '0')], db.list_spent_outpoints())
+        # duplicates are ignored
+        db.add_txi_addr('aa' * 32, 'addr', 'bb' * 32 + ':1', 1000)
+        db.add_txo_addr('aa' * 32, 'addr', 0, 2900, False)
+        self.assertEqual(2, len(db.get_txi_addr('aa' * 32, 'addr')))
+        self.assertEqual(1, len(db.get_txo_addr('aa' * 32, 'addr')))
+
+    def test_compact_representation_is_dumped_as_json(self):
+        d = json.loads(self.db.dump())
+        self.assertEqual(self.history, {name: d[name] for name in self.history})
+        self.db.dump_changes()
+        self.db.set_spent_outpoint('dd' * 32, 2, 'aa' * 32)
+        self.db.add_txi_addr('ee' * 32, 'addr', 'dd' * 32 + ':2', 500)
+        changes = json.loads(self.db.dump_changes())
+        self.assertIn(['set', ['spent_outpoints', 'dd' * 32], {'2': 'aa' * 32}], changes)
+        self.assertIn(['set', ['txi', 'ee' * 32, 'addr'], [['dd' * 32 + ':2', 500]]], changes)
+
+
+class TestAddrHistoryStatus(SequentialTestCase):
+
+    def test_status_follows_history(self):
+        db = JsonDB('', manual_upgrades=False)
+        addr = 'addr'
+        self.assertIsNone(db.get_addr_history_status(addr))
+        hist = [('aa' * 32, 10), ('bb' * 32, 0)]
+        db.set_addr_history(addr, hist)
+        status = db.get_addr_history_status(addr)
+        self.assertEqual(history_status(hist), status)
+        self.assertEqual(status, db.get_addr_history_status(addr))
+        db.set_addr_history(addr, hist[:1])
+        self.assertEqual(history_status(hist[:1]), db.get_addr_history_status(addr))
+        db.remove_addr_history(addr)
+        self.assertIsNone(db.get_addr_history_status(addr))
+        db.set_addr_history(addr, hist)
+        db.clear_history()
+        self.assertIsNone(db.get_addr_history_status(addr))
+
+
 class TestCreateRestoreWallet(WalletTestCase):
 
     def test_create_new_wallet(self):
@@ -163,6 +595,20 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(d['seed'], wallet.keystore.get_seed(password))
         self.assertEqual(encrypt_file, wallet.storage.is_encrypted())
 
+    def test_gap_limit_window(self):
+        wallet = create_new_wallet(path=self.wallet_path)['wallet']
+        receiving = wallet.get_receiving_addresses()
+        change = wallet.get_change_addresses()
+        self.assertEqual(wallet.gap_limit, len(receiving))
+        self.assertTrue(all(map(wallet.is_in_gap_limit_window, receiving + change)))
+        wallet.create_new_address(False)
+        self.assertFalse(wallet.is_in_gap_limit_window(receiving[0]))
+        self.assertTrue(wallet.is_in_gap_limit_window(receiving[1]))
+        self.assertTrue(wallet.is_in_gap_limit_window(change[0]))
+        imported = restore_wallet_from_text('DRWitZjTupNRGhGrztniNi9GDH3JmVT3kh',
+                                            path=self.wallet_path + '2')['wallet']
+        self.assertFalse(imported.is_in_gap_limit_window(imported.get_addresses()[0]))
+
     def test_restore_wallet_from_text_mnemonic(self):
         text = 'twenty oil method educate cloud reunion worry stay turtle nut volume fit'
         passphrase = ''
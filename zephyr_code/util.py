@@ -21,6 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import binascii
+import hashlib
 import os, sys, re, json
 from collections import defaultdict, OrderedDict
 from typing import NamedTuple, Union, TYPE_CHECKING, Tuple, Optional, Callable, Any
@@ -466,6 +467,18 @@ def bh2u(x: bytes) -> str:
     return x.hex()
 
 
+def history_status(h) -> Optional[str]:
+    """Electrum protocol status of an address history,
+    a list of (tx_hash, height).
+    """
+    if not h:
+        return None
+    status = ''
+    for tx_hash, height in h:
+        status += tx_hash + ':%d:' % height
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 def user_dir():
     if os.name == 'posix':
         return os.path.join(os.environ["HOME"], ".zephyr")
@@ -902,7 +915,8 @@ class TxMinedInfo(NamedTuple):
     header_hash: Optional[str] = None  # hash of block that mined tx
 
 
-def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
+def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None,
+                         limit=100, limit_per_host=0):
     if headers is None:
         headers = {'User-Agent': 'Zephyr'}
     if timeout is None:
@@ -920,9 +934,11 @@ def make_aiohttp_session(proxy: Optional[dict], headers=None, timeout=None):
             password=proxy.get('password', None),
             rdns=True,
             ssl=ssl_context,
+            limit=limit,
+            limit_per_host=limit_per_host,
         )
     else:
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
+        connector = aiohttp.TCPConnector(ssl=ssl_context, limit=limit, limit_per_host=limit_per_host)
 
     return aiohttp.ClientSession(headers=headers, timeout=timeout, connector=connector)
 
@@ -1077,6 +1093,45 @@ class OrderedDictWithIndex(OrderedDict):
         return ret
 
 
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class LRUCache(OrderedDict):
+    """An OrderedDict of bounded size that evicts the least recently
+    used key. Lookups through get() update the hit/miss counters.
+
+    Note: not thread-safe, callers have to hold their own lock.
+    """
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        assert maxsize > 0, maxsize
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key not in self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
     otherwise return None.'''
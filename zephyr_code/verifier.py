@@ -22,17 +22,18 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+import heapq
+from typing import Sequence, Optional, Union, TYPE_CHECKING
 
 import aiorpcx
 
-from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
+from .util import bh2u, bfh, TxMinedInfo, NetworkJobOnDefaultServer
 from .crypto import sha256d
 from .bitcoin import hash_decode, hash_encode
-from .transaction import Transaction
+from .transaction import Transaction, PARTIAL_TXN_HEADER_MAGIC
 from .blockchain import hash_header
-from .interface import GracefulDisconnect
-from .network import UntrustedServerReturnedError
+from .interface import GracefulDisconnect, RequestTimedOut
+from .network import UntrustedServerReturnedError, BestEffortRequestFailed
 from . import constants
 
 if TYPE_CHECKING:
@@ -46,64 +47,205 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+MERKLE_BATCH_SIZE = 50  # proofs per JSON-RPC batch
+MERKLE_REQUEST_CONCURRENCY = 2  # batches in flight
+MERKLE_RETRY_DELAY = 1  # seconds, doubled after every failed attempt
+MERKLE_MAX_RETRY_DELAY = 64
+MERKLE_MAX_RETRIES = 8  # per proof, before giving up on the server
+
+# server errors that mean "try again later" rather than "not in that block"
+RETRYABLE_SERVER_ERRORS = (aiorpcx.jsonrpc.JSONRPC.EXCESSIVE_RESOURCE_USAGE,
+                           aiorpcx.jsonrpc.JSONRPC.SERVER_BUSY)
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         NetworkJobOnDefaultServer.__init__(self, network)
+        network.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        # txs that might need a proof, lowest height first. Entries are
+        # checked against the wallet when popped, so stale ones are harmless.
+        self._pending = []  # heap of (tx_height, txid)
+        self._pending_heights = {}  # txid -> tx_height, of entries in self._pending
+        self._wakeup = asyncio.Event()
+        # proofs to fetch, lowest height first; consumed by _fetch_proofs
+        self._proof_queue = []  # heap of (tx_height, txid)
+        self._proofs_queued = asyncio.Event()
+        self._proof_retries = {}  # txid -> failed attempts, with this server
 
     async def _start_tasks(self):
         async with self.group as group:
             await group.spawn(self.main)
+            for i in range(self._merkle_request_concurrency()):
+                await group.spawn(self._fetch_proofs)
+
+    def _merkle_request_concurrency(self) -> int:
+        return max(1, int(self.network.config.get('merkle_request_concurrency',
+                                                   MERKLE_REQUEST_CONCURRENCY)))
+
+    def _merkle_batch_size(self) -> int:
+        return max(1, int(self.network.config.get('merkle_batch_size', MERKLE_BATCH_SIZE)))
+
+    async def stop(self):
+        self.network.unregister_callback(self._on_blockchain_updated)
+        await super().stop()
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    def add_pending_tx(self, tx_hash: str, tx_height: int) -> None:
+        """Tell the verifier about a tx that might need a proof.
+        Can be called from any thread.
+        """
+        if tx_height > 0:
+            self.network.asyncio_loop.call_soon_threadsafe(self._add_pending_tx, tx_hash, tx_height)
+
+    def _add_pending_tx(self, tx_hash: str, tx_height: int) -> None:
+        if self._pending_heights.get(tx_hash) == tx_height:
+            return
+        self._push_pending_tx(tx_hash, tx_height)
+        self._wakeup.set()
+
+    def _push_pending_tx(self, tx_hash: str, tx_height: int) -> None:
+        self._pending_heights[tx_hash] = tx_height
+        heapq.heappush(self._pending, (tx_height, tx_hash))
+
+    def _on_blockchain_updated(self, event, *args):
+        # new headers, or the network switched to another chain
+        self._wakeup.set()
+
     async def main(self):
         self.blockchain = self.network.blockchain()
+        for tx_hash, tx_height in self.wallet.get_unverified_txs().items():
+            self.add_pending_tx(tx_hash, tx_height)
         while True:
+            self._wakeup.clear()
             await self._maybe_undo_verifications()
             await self._request_proofs()
-            await asyncio.sleep(0.1)
+            await self._wakeup.wait()
 
     async def _request_proofs(self):
         local_height = self.blockchain.height()
-        unverified = self.wallet.get_unverified_txs()
-
-        for tx_hash, tx_height in unverified.items():
-            # do not request merkle branch if we already requested it
-            if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
+        in_flight = []
+        missing_headers = []
+        while self._pending and self._pending[0][0] <= local_height:
+            tx_height, tx_hash = heapq.heappop(self._pending)
+            if self._pending_heights.get(tx_hash) != tx_height:
+                continue  # superseded by an entry with another height
+            del self._pending_heights[tx_hash]
+            # skip if no longer unverified at this height
+            if self.wallet.get_unverified_tx_height(tx_hash) != tx_height:
+                continue
+            if tx_hash in self.merkle_roots:
                 continue
-            # or before headers are available
-            if tx_height <= 0 or tx_height > local_height:
+            # do not request merkle branch if we already requested it, but
+            # keep the entry: the request might be for another height
+            if tx_hash in self.requested_merkle:
+                in_flight.append((tx_hash, tx_height))
                 continue
             # if it's in the checkpoint region, we still might not have the header
             header = self.blockchain.read_header(tx_height)
             if header is None:
-                if tx_height < constants.net.max_checkpoint():
-                    await self.group.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+                missing_headers.append((tx_hash, tx_height))
                 continue
             # request now
-            self.logger.info(f'requested merkle {tx_hash}')
             self.requested_merkle.add(tx_hash)
-            await self.group.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            self._queue_proof(tx_hash, tx_height)
+        # retried on the next wakeup, e.g. when the request has resolved
+        for tx_hash, tx_height in in_flight:
+            self._push_pending_tx(tx_hash, tx_height)
+        # or when the chunk has been downloaded
+        chunks = set()
+        for tx_hash, tx_height in missing_headers:
+            self._push_pending_tx(tx_hash, tx_height)
+            if tx_height < constants.net.max_checkpoint():
+                chunks.add(tx_height // 2016)
+        for index in sorted(chunks):
+            await self.group.spawn(self._request_chunk(index * 2016))
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
+    async def _request_chunk(self, height):
+        res = await self.network.request_chunk(height, None, can_return_early=True)
+        # None if the chunk is already being downloaded. Waking up without
+        # new headers would only request the chunk again.
+        if res and res[1]:
+            self._wakeup.set()
+
+    def _queue_proof(self, tx_hash, tx_height):
+        heapq.heappush(self._proof_queue, (tx_height, tx_hash))
+        self._proofs_queued.set()
+
+    def _take_proof_batch(self):
+        batch = []
+        batch_size = self._merkle_batch_size()
+        while self._proof_queue and len(batch) < batch_size:
+            tx_height, tx_hash = heapq.heappop(self._proof_queue)
+            # dropped by remove_spv_proof_for_tx while queued
+            if tx_hash in self.requested_merkle:
+                batch.append((tx_hash, tx_height))
+        if not self._proof_queue:
+            self._proofs_queued.clear()
+        return batch
+
+    async def _fetch_proofs(self):
+        """Worker that fetches queued proofs in batches, lowest heights first.
+        Requests that failed in a way worth retrying are queued again after
+        an exponential backoff, at most MERKLE_MAX_RETRIES times. Any other
+        failure, or running out of retries, disconnects from the server.
+        """
+        retry_delay = MERKLE_RETRY_DELAY
+        while True:
+            await self._proofs_queued.wait()
+            batch = self._take_proof_batch()
+            if not batch:
+                continue
+            self.logger.info(f'requesting {len(batch)} merkle branches, '
+                             f'heights {batch[0][1]}-{batch[-1][1]}')
+            try:
+                results = await self.network.get_merkles_for_transactions(batch)
+            except (RequestTimedOut, BestEffortRequestFailed) as e:
+                self.logger.info(f'merkle batch failed: {repr(e)}')
+                results = [e] * len(batch)
+            retry = []
+            for (tx_hash, tx_height), result in zip(batch, results):
+                if isinstance(result, UntrustedServerReturnedError) \
+                        and getattr(result.original_exception, 'code', None) not in RETRYABLE_SERVER_ERRORS:
+                    self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                    self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                    self.requested_merkle.discard(tx_hash)
+                    self._proof_retries.pop(tx_hash, None)
+                    # it might have been mined again at another height
+                    self._wakeup.set()
+                elif isinstance(result, (UntrustedServerReturnedError, RequestTimedOut, BestEffortRequestFailed)):
+                    retries = self._proof_retries.get(tx_hash, 0) + 1
+                    if retries > MERKLE_MAX_RETRIES:
+                        raise GracefulDisconnect(f'merkle request for {tx_hash} failed '
+                                                 f'{retries} times, last: {repr(result)}')
+                    self._proof_retries[tx_hash] = retries
+                    retry.append((tx_hash, tx_height))
+                elif isinstance(result, Exception):
+                    raise GracefulDisconnect(f'merkle request for {tx_hash} failed: {repr(result)}')
+                else:
+                    self._proof_retries.pop(tx_hash, None)
+                    if tx_hash in self.requested_merkle:
+                        await self._verify_proof(tx_hash, tx_height, result)
+            if not retry:
+                retry_delay = MERKLE_RETRY_DELAY
+                continue
+            self.logger.info(f'retrying {len(retry)} merkle requests in {retry_delay} s')
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, MERKLE_MAX_RETRY_DELAY)
+            for tx_hash, tx_height in retry:
+                if tx_hash in self.requested_merkle:
+                    self._queue_proof(tx_hash, tx_height)
+
+    async def _verify_proof(self, tx_hash, tx_height, merkle):
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
         if tx_height != merkle.get('block_height'):
@@ -148,16 +290,20 @@ class SPV(NetworkJobOnDefaultServer):
 
         for i, item in enumerate(merkle_branch_bytes):
             h = sha256d(item + h) if ((leaf_pos_in_tree >> i) & 1) else sha256d(h + item)
-            cls._raise_if_valid_tx(bh2u(h))
+            cls._raise_if_valid_tx(h)
         return hash_encode(h)
 
     @classmethod
-    def _raise_if_valid_tx(cls, raw_tx: str):
+    def _raise_if_valid_tx(cls, raw_tx: Union[str, bytes]):
         # If an inner node of the merkle proof is also a valid tx, chances are, this is an attack.
         # https://lists.linuxfoundation.org/pipermail/bitcoin-dev/2018-June/016105.html
         # https://lists.linuxfoundation.org/pipermail/bitcoin-dev/attachments/20180609/9f4f5b1f/attachment-0001.pdf
         # https://bitcoin.stackexchange.com/questions/76121/how-is-the-leaf-node-weakness-in-merkle-trees-exploitable/76122#76122
-        tx = Transaction(raw_tx)
+        if isinstance(raw_tx, str):
+            raw_tx = bfh(raw_tx)
+        if not _has_tx_structure(raw_tx):
+            return  # the full parser would reject it too
+        tx = Transaction(bh2u(raw_tx))
         try:
             tx.deserialize()
         except:
@@ -176,15 +322,71 @@ class SPV(NetworkJobOnDefaultServer):
             for tx_hash in tx_hashes:
                 self.logger.info(f"redoing {tx_hash}")
                 self.remove_spv_proof_for_tx(tx_hash)
+                tx_height = self.wallet.get_unverified_tx_height(tx_hash)
+                if tx_height:
+                    self._add_pending_tx(tx_hash, tx_height)
 
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
         self.requested_merkle.discard(tx_hash)
+        self._proof_retries.pop(tx_hash, None)
+        # if the tx becomes unverified again, the wallet calls add_pending_tx
 
     def is_up_to_date(self):
         return not self.requested_merkle
 
 
+def _read_compact_size(raw: bytes, pos: int):
+    """Return (value, new position), or None if raw is too short."""
+    if pos >= len(raw):
+        return None
+    size = raw[pos]
+    if size < 253:
+        return size, pos + 1
+    width = 1 << (size - 252)  # 2, 4 or 8 bytes
+    if pos + 1 + width > len(raw):
+        return None
+    return int.from_bytes(raw[pos + 1:pos + 1 + width], 'little'), pos + 1 + width
+
+
+def _has_tx_structure(raw: bytes) -> bool:
+    """Cheap necessary condition for transaction.deserialize to accept raw.
+
+    Walks the version, inputs, outputs and locktime using only the length
+    fields, and checks they use up raw exactly. The version is not checked,
+    as the parser accepts any.
+    """
+    if raw[:len(PARTIAL_TXN_HEADER_MAGIC)] == PARTIAL_TXN_HEADER_MAGIC:
+        return True  # leave the partial format to the full parser
+    end = len(raw)
+    pos = 4  # version
+    r = _read_compact_size(raw, pos)
+    if r is None:
+        return False
+    n_vin, pos = r
+    if n_vin * 41 > end - pos:  # prevout, script length, sequence
+        return False
+    for i in range(n_vin):
+        r = _read_compact_size(raw, pos + 36)
+        if r is None:
+            return False
+        script_len, pos = r
+        pos += script_len + 4
+    r = _read_compact_size(raw, pos)
+    if r is None:
+        return False
+    n_vout, pos = r
+    if n_vout * 9 > end - pos:  # value, script length
+        return False
+    for i in range(n_vout):
+        r = _read_compact_size(raw, pos + 8)
+        if r is None:
+            return False
+        script_len, pos = r
+        pos += script_len
+    return pos + 4 == end  # locktime, and no junk after it
+
+
 def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
                           leaf_pos_in_tree: int, block_header: Optional[dict],
                           block_height: int) -> None:
@@ -38,7 +38,8 @@ import traceback
 from functools import partial
 from numbers import Number
 from decimal import Decimal
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple
+from types import MappingProxyType
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple, Mapping
 
 from .i18n import _
 from .util import (NotEnoughFunds, UserCancelled, profiler,
@@ -53,7 +54,7 @@ from . import keystore
 from .keystore import load_keystore, Hardware_KeyStore
 from .util import multisig_type
 from .storage import STO_EV_PLAINTEXT, STO_EV_USER_PW, STO_EV_XPUB_PW, WalletStorage
-from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
+from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32, constants
 from .transaction import Transaction, TxOutput, TxOutputHwInfo
 from .plugin import run_hook
 from .address_synchronizer import (AddressSynchronizer, TX_HEIGHT_LOCAL,
@@ -157,14 +158,15 @@ def get_locktime_for_new_transaction(network: 'Network') -> int:
     if not network:
         return 0
     chain = network.blockchain()
-    header = chain.header_at_tip()
-    if not header:
+    height = chain.height()
+    timestamp = chain.get_timestamp(height)
+    if not timestamp:
         return 0
     STALE_DELAY = 8 * 60 * 60  # in seconds
-    if header['timestamp'] + STALE_DELAY < time.time():
+    if timestamp + STALE_DELAY < time.time():
         return 0
     # discourage "fee sniping"
-    locktime = chain.height()
+    locktime = height
     # sometimes pick locktime a bit further back, to help privacy
     # of setups that need more time (offline/multisig/coinjoin/...)
     if random.randint(0, 9) == 0:
@@ -211,11 +213,8 @@ class Abstract_Wallet(AddressSynchronizer):
         # saved fields
         self.use_change            = storage.get('use_change', True)
         self.multiple_change       = storage.get('multiple_change', False)
-        self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses', []))
         self.frozen_coins          = set(storage.get('frozen_coins', []))  # set of txid:vout strings
-        self.fiat_value            = storage.get('fiat_value', {})
-        self.receive_requests      = storage.get('payment_requests', {})
 
         self.calc_unused_change_addresses()
 
@@ -268,21 +267,28 @@ class Abstract_Wallet(AddressSynchronizer):
     def is_deterministic(self):
         return self.keystore.is_deterministic()
 
+    # read-only views of dicts in the db; they are changed with
+    # db.put_item, under the db lock, see set_label
+    @property
+    def labels(self) -> Mapping[str, str]:
+        return MappingProxyType(self.db.get('labels', {}))
+
+    @property
+    def fiat_value(self) -> Mapping[str, dict]:
+        return MappingProxyType(self.db.get('fiat_value', {}))
+
+    @property
+    def receive_requests(self) -> Mapping[str, dict]:
+        return MappingProxyType(self.db.get('payment_requests', {}))
+
     def set_label(self, name, text = None):
-        changed = False
-        old_text = self.labels.get(name)
         if text:
             text = text.replace("\n", " ")
-            if old_text != text:
-                self.labels[name] = text
-                changed = True
         else:
-            if old_text is not None:
-                self.labels.pop(name)
-                changed = True
+            text = None
+        changed = self.db.put_item(('labels', name), text)
         if changed:
             run_hook('set_label', self, name, text)
-            self.storage.put('labels', self.labels)
         return changed
 
     def set_fiat_value(self, txid, ccy, text, fx, value_sat):
@@ -303,18 +309,8 @@ class Abstract_Wallet(AddressSynchronizer):
             except:
                 # garbage. not resetting, but not saving either
                 return False
-        if reset:
-            d = self.fiat_value.get(ccy, {})
-            if d and txid in d:
-                d.pop(txid)
-            else:
-                # avoid saving empty dict
-                return True
-        else:
-            if ccy not in self.fiat_value:
-                self.fiat_value[ccy] = {}
-            self.fiat_value[ccy][txid] = text
-        self.storage.put('fiat_value', self.fiat_value)
+        # removing a value that is not there does not save an empty dict
+        self.db.put_item(('fiat_value', ccy, txid), None if reset else text)
         return reset
 
     def get_fiat_value(self, txid, ccy):
@@ -431,13 +427,30 @@ class Abstract_Wallet(AddressSynchronizer):
                                       excluded_coins=self.frozen_coins)
         return c1-c2, u1-u2, x1-x2
 
+    def _get_height_at_timestamp(self, timestamp) -> Optional[int]:
+        """Height of the first block of our chain with a timestamp >= timestamp,
+        see Blockchain.get_height_at_timestamp. Returns None if offline, or
+        if the headers that would tell are not downloaded (checkpoint region).
+        """
+        if not self.network:
+            return None
+        height = self.network.blockchain().get_height_at_timestamp(int(timestamp))
+        if height <= constants.net.max_checkpoint() + 1:
+            return None
+        return height
+
     def balance_at_timestamp(self, domain, target_timestamp):
         # we assume that get_history returns items ordered by block height
-        # we also assume that block timestamps are monotonic (which is false...!)
         h = self.get_history(domain)
+        # the blocks below max_height were mined up to target_timestamp. This
+        # does not assume block timestamps are monotonic, the fallback does.
+        max_height = self._get_height_at_timestamp(target_timestamp + 1)
         balance = 0
         for tx_hash, tx_mined_status, value, balance in h:
-            if tx_mined_status.timestamp is None or tx_mined_status.timestamp > target_timestamp:
+            if max_height is not None:
+                if not 0 < tx_mined_status.height < max_height:
+                    return balance - value
+            elif tx_mined_status.timestamp is None or tx_mined_status.timestamp > target_timestamp:
                 return balance - value
         # return last balance
         return balance
@@ -457,13 +470,23 @@ class Abstract_Wallet(AddressSynchronizer):
         fiat_expenditures = Decimal(0)
         h = self.get_history(domain)
         now = time.time()
+        # mined transactions are filtered on the heights of the blocks at
+        # the timestamps, as block timestamps are not monotonic
+        from_timestamp_height = self._get_height_at_timestamp(from_timestamp) if from_timestamp else None
+        to_timestamp_height = self._get_height_at_timestamp(to_timestamp) if to_timestamp else None
         for tx_hash, tx_mined_status, value, balance in h:
             timestamp = tx_mined_status.timestamp
-            if from_timestamp and (timestamp or now) < from_timestamp:
+            height = tx_mined_status.height
+            if height > 0 and from_timestamp_height is not None:
+                if height < from_timestamp_height:
+                    continue
+            elif from_timestamp and (timestamp or now) < from_timestamp:
                 continue
-            if to_timestamp and (timestamp or now) >= to_timestamp:
+            if height > 0 and to_timestamp_height is not None:
+                if height >= to_timestamp_height:
+                    continue
+            elif to_timestamp and (timestamp or now) >= to_timestamp:
                 continue
-            height = tx_mined_status.height
             if from_height is not None and height < from_height:
                 continue
             if to_height is not None and height >= to_height:
@@ -1001,10 +1024,8 @@ class Abstract_Wallet(AddressSynchronizer):
         alias_privkey = self.export_private_key(alias_addr, password)[0]
         pr = paymentrequest.make_unsigned_request(req)
         paymentrequest.sign_request_with_alias(pr, alias, alias_privkey)
-        req['name'] = pr.pki_data
-        req['sig'] = bh2u(pr.signature)
-        self.receive_requests[key] = req
-        self.storage.put('payment_requests', self.receive_requests)
+        req = dict(req, name=pr.pki_data, sig=bh2u(pr.signature))
+        self.db.put_item(('payment_requests', key), req)
 
     def add_payment_request(self, req, config):
         addr = req['address']
@@ -1015,8 +1036,7 @@ class Abstract_Wallet(AddressSynchronizer):
 
         amount = req.get('amount')
         message = req.get('memo')
-        self.receive_requests[addr] = req
-        self.storage.put('payment_requests', self.receive_requests)
+        self.db.put_item(('payment_requests', addr), req)
         self.set_label(addr, message) # should be a default label
 
         rdir = config.get('requests_dir')
@@ -1039,9 +1059,10 @@ class Abstract_Wallet(AddressSynchronizer):
         return req
 
     def remove_payment_request(self, addr, config):
-        if addr not in self.receive_requests:
+        r = self.receive_requests.get(addr)
+        if r is None:
             return False
-        r = self.receive_requests.pop(addr)
+        self.db.put_item(('payment_requests', addr), None)
         rdir = config.get('requests_dir')
         if rdir:
             key = r.get('id', addr)
@@ -1049,11 +1070,10 @@ class Abstract_Wallet(AddressSynchronizer):
                 n = os.path.join(rdir, 'req', key[0], key[1], key, key + s)
                 if os.path.exists(n):
                     os.unlink(n)
-        self.storage.put('payment_requests', self.receive_requests)
         return True
 
     def get_sorted_requests(self, config):
-        keys = map(lambda x: (self.get_address_index(x), x), self.receive_requests.keys())
+        keys = map(lambda x: (self.get_address_index(x), x), self.db.get_copy('payment_requests'))
         sorted_keys = sorted(filter(lambda x: x[0] is not None, keys))
         return [self.get_payment_request(x[1], config) for x in sorted_keys]
 
@@ -1543,6 +1563,16 @@ class Deterministic_Wallet(Abstract_Wallet):
             self.synchronize_sequence(False)
             self.synchronize_sequence(True)
 
+    def is_in_gap_limit_window(self, address):
+        # synchronize_sequence only looks at the last gap-limit addresses
+        index = self.get_address_index(address)
+        if index is None:
+            return False
+        for_change, i = index
+        n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
+        limit = self.gap_limit_for_change if for_change else self.gap_limit
+        return i >= n - limit
+
     def is_beyond_limit(self, address):
         is_change, i = self.get_address_index(address)
         addr_list = self.get_change_addresses() if is_change else self.get_receiving_addresses()